@@ -7,99 +7,636 @@ License: MIT License
 """
 
 import os
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, Response, request, jsonify, render_template, send_from_directory, session, g, stream_with_context
 import fitz  # PyMuPDF
 import pypdf
+import rasterizer
+import pdf_engine
+import page_analysis
+import metrics
+import doccache
 import shutil
 import zipfile
+import gzip
+import zlib
+import mimetypes
 import io
+import re
+import hashlib
+import json
+import difflib
+import secrets
+import threading
+import time
+import contextlib
+import collections
+import cProfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 app = Flask(__name__)
 
 # --- 設定 ---
-UPLOAD_FOLDER = 'uploads'
+# セッションごとの作業領域（アップロード・履歴・出力）を置くフォルダ
+WORKSPACE_FOLDER = 'workspaces'
+# サムネイルはページ内容の指紋で管理するため、全セッションで共有する
 THUMBNAIL_FOLDER = 'thumbnails'
-OUTPUT_FOLDER = 'output'
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# マスキング画面で拡大表示するためのタイル画像（サムネイルと同じく全セッションで共有する）
+TILE_FOLDER = 'tiles'
+# 検索用に抽出したページの文字（ページ内容の指紋で管理し、全セッションで共有する）
+TEXT_FOLDER = 'text'
+# 白紙・重複ページの検出に使う、ページごとの解析結果（ページ内容の指紋で管理し、全セッションで共有する）
+ANALYSIS_FOLDER = 'analysis'
+app.config['WORKSPACE_FOLDER'] = WORKSPACE_FOLDER
 app.config['THUMBNAIL_FOLDER'] = THUMBNAIL_FOLDER
-app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
-# ファイルサイズ制限（50MB）
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
+app.config['TILE_FOLDER'] = TILE_FOLDER
+app.config['TEXT_FOLDER'] = TEXT_FOLDER
+app.config['ANALYSIS_FOLDER'] = ANALYSIS_FOLDER
+# 作業領域内のフォルダ名
+UPLOAD_FOLDER = 'uploads'
+OUTPUT_FOLDER = 'output'
+HISTORY_FOLDER = 'history'
+# 使われなくなった作業領域を削除するまでの時間（秒）
+app.config['WORKSPACE_TTL'] = int(os.environ.get('WORKSPACE_TTL', 2 * 60 * 60))
+# /upload で1回に受け付けるファイル数と、1ファイルの大きさの上限（50MB、これより大きいPDFは /uploads で分割してアップロードする）
+app.config['UPLOAD_BATCH_FILES'] = 5
+app.config['UPLOAD_FILE_MAX_BYTES'] = 50 * 1024 * 1024
+# 1回のリクエスト全体の大きさの上限（/upload で上限いっぱいのファイルをまとめて送れる大きさ）
+app.config['MAX_CONTENT_LENGTH'] = app.config['UPLOAD_BATCH_FILES'] * app.config['UPLOAD_FILE_MAX_BYTES'] + 1024 * 1024
+# 分割アップロードの1チャンクの大きさ（UPLOAD_FILE_MAX_BYTES 以下にする）と、1ファイルの大きさの上限（1GB）
+app.config['UPLOAD_CHUNK_BYTES'] = 8 * 1024 * 1024
+app.config['UPLOAD_MAX_BYTES'] = int(os.environ.get('UPLOAD_MAX_BYTES', 1024 * 1024 * 1024))
+# サムネイルの解像度
+app.config['THUMBNAIL_DPI'] = 72
+# サムネイルキャッシュのディスク使用量の上限（200MB）
+app.config['THUMBNAIL_CACHE_BYTES'] = 200 * 1024 * 1024
+# サムネイルのURLは内容の指紋なので、ブラウザには無期限にキャッシュさせる（1年）
+app.config['THUMBNAIL_MAX_AGE'] = 365 * 24 * 60 * 60
+# サムネイルをgzip圧縮した版も保存し、対応するブラウザにはそちらを返す
+app.config['THUMBNAIL_PRECOMPRESS'] = os.environ.get('THUMBNAIL_PRECOMPRESS', '0') == '1'
+# 操作のレスポンスに全ページのサムネイルを含めるページ数の上限（超える場合は /pages で表示する範囲ごとに取得する）
+app.config['THUMBNAIL_INLINE_PAGES'] = int(os.environ.get('THUMBNAIL_INLINE_PAGES', 200))
+# /pages で一度に取得できるページ数の上限
+app.config['PAGE_WINDOW_LIMIT'] = 200
+# ギャラリー表示用に、サムネイルを平均で何ページ分ずつ1枚のスプライト画像（アトラス）にまとめるか（0ならまとめない）
+app.config['THUMBNAIL_ATLAS_PAGES'] = int(os.environ.get('THUMBNAIL_ATLAS_PAGES', 50))
+# アトラスの1行に並べるページ数・縮小後の高さ（ピクセル）・JPEGの画質
+app.config['THUMBNAIL_ATLAS_COLUMNS'] = 10
+app.config['THUMBNAIL_ATLAS_HEIGHT'] = 200
+app.config['THUMBNAIL_ATLAS_QUALITY'] = 80
+# タイルの1辺のピクセル数と最大のズーム段階（段階 z の倍率は 2**z、0 が72 DPI）
+app.config['TILE_SIZE'] = 256
+app.config['TILE_MAX_ZOOM'] = 3
+# タイルキャッシュのディスク使用量の上限（100MB）
+app.config['TILE_CACHE_BYTES'] = 100 * 1024 * 1024
+# 抽出した文字のキャッシュのディスク使用量の上限（50MB）
+app.config['TEXT_CACHE_BYTES'] = 50 * 1024 * 1024
+# 白紙・重複ページの検出でページを解析するときの解像度と、解析結果のキャッシュのディスク使用量の上限（10MB）
+app.config['ANALYSIS_DPI'] = 36
+app.config['ANALYSIS_CACHE_BYTES'] = 10 * 1024 * 1024
+# ページ画像化の並列ワーカー数と、1ワーカーにまとめて渡すページ数
+app.config['RASTER_WORKERS'] = int(os.environ.get('RASTER_WORKERS', rasterizer.DEFAULT_WORKERS))
+app.config['RASTER_CHUNK_SIZE'] = int(os.environ.get('RASTER_CHUNK_SIZE', rasterizer.DEFAULT_CHUNK_SIZE))
+# バックグラウンドで同時に実行するジョブの数
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+# 開いたままにしておく文書の合計サイズの上限（ファイルサイズで見積もる、256MB）
+app.config['DOCUMENT_CACHE_BYTES'] = int(os.environ.get('DOCUMENT_CACHE_BYTES', 256 * 1024 * 1024))
 
 # フォルダが存在しない場合は作成
-for folder in [UPLOAD_FOLDER, THUMBNAIL_FOLDER, OUTPUT_FOLDER]:
+for folder in [WORKSPACE_FOLDER, THUMBNAIL_FOLDER, TILE_FOLDER, TEXT_FOLDER, ANALYSIS_FOLDER]:
     if not os.path.exists(folder):
         os.makedirs(folder)
 
-# 最初にアップロードされたファイル名を記録する変数
-original_filename = None
-
-# 履歴管理用フォルダ
-HISTORY_FOLDER = 'history'
-if not os.path.exists(HISTORY_FOLDER):
-    os.makedirs(HISTORY_FOLDER)
-
-# 履歴管理用変数
-history_stack = []  # 過去の状態を保存
-history_index = -1  # 現在の位置
+# 保持する履歴の数と、ページリスト全体を保存する間隔
+app.config['HISTORY_LIMIT'] = 20
+app.config['HISTORY_CHECKPOINT_INTERVAL'] = 10
+# 差分計算で詳細な比較を行うページ数の上限（これを超える範囲はまとめて置き換えとして記録する）
+_HISTORY_DIFF_LIMIT = 2000
+# この秒数より遅いリクエストのプロファイルを保存する（0なら保存しない）
+app.config['PROFILE_SLOW_REQUESTS'] = float(os.environ.get('PROFILE_SLOW_REQUESTS', 0))
+app.config['PROFILE_FOLDER'] = 'profiles'
+
+# --- 計測 ---
+# リクエストごとに処理段階（parse, transform, serialize, history, rasterize, response）の時間を測り、
+# Server-Timing ヘッダーで返すとともに /metrics で集計値を公開する。
+
+_metrics = metrics.Registry()
+_metrics.describe('pdf_request_duration_seconds', 'histogram', 'リクエスト全体の処理時間')
+_metrics.describe('pdf_phase_duration_seconds', 'histogram', '処理段階ごとの処理時間')
+_metrics.describe('pdf_pages_processed_total', 'counter', '処理したページ数')
+_metrics.describe('pdf_bytes_written_total', 'counter', 'ディスクに書き込んだバイト数')
+
+@contextlib.contextmanager
+def _phase(name):
+    """処理段階の時間を計測する（入れ子になった段階の時間は内側の段階だけに数える）
+
+    with 文でもデコレーターでも使える。計測中でなければ何もしない。
+    """
+    timings = g.get('phase_timings') if g else None
+    if timings is None:
+        yield
+        return
+    stack = g.phase_stack
+    stack.append(0.0)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        inner = stack.pop()
+        timings[name] = timings.get(name, 0.0) + elapsed - inner
+        if stack:
+            stack[-1] += elapsed
+
+def _timed_iter(iterable, name):
+    """要素を1つ取り出すごとに処理段階の時間として計測し、ページ数も数える"""
+    iterator = iter(iterable)
+    try:
+        while True:
+            with _phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            _count('pages', 1)
+            yield item
+    finally:
+        # 途中で打ち切られた場合も元のジェネレーターを閉じて後片付けさせる
+        if hasattr(iterator, 'close'):
+            iterator.close()
+
+def _count(name, amount):
+    """処理したページ数（pages）や書き込んだバイト数（bytes）を数える"""
+    counts = g.get('request_counts') if g else None
+    if counts is not None:
+        counts[name] = counts.get(name, 0) + amount
+
+def _count_written(path):
+    """書き込んだファイルのサイズを数える"""
+    _count('bytes', os.path.getsize(path))
+
+def _start_measurement():
+    g.phase_timings = {}
+    g.phase_stack = []
+    g.request_counts = {}
+    g.request_started = time.perf_counter()
+
+def _finish_measurement(route):
+    """計測値を集計に加え、(段階ごとの秒数, 全体の秒数) を返す"""
+    total = time.perf_counter() - g.request_started
+    timings = g.phase_timings
+    _metrics.observe('pdf_request_duration_seconds', total, route=route)
+    for phase, seconds in timings.items():
+        _metrics.observe('pdf_phase_duration_seconds', seconds, route=route, phase=phase)
+    counts = g.request_counts
+    if counts.get('pages'):
+        _metrics.inc('pdf_pages_processed_total', counts['pages'], route=route)
+    if counts.get('bytes'):
+        _metrics.inc('pdf_bytes_written_total', counts['bytes'], route=route)
+    return timings, total
+
+@app.before_request
+def _begin_request_measurement():
+    _start_measurement()
+    if app.config['PROFILE_SLOW_REQUESTS'] > 0:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def _end_request_measurement(response):
+    if g.get('phase_timings') is None or request.endpoint == 'metrics_endpoint':
+        return response
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+    route = request.endpoint or 'unknown'
+    timings, total = _finish_measurement(route)
+    response.headers['Server-Timing'] = ', '.join(
+        [f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in timings.items()]
+        + [f'total;dur={total * 1000:.1f}']
+    )
+    if profiler is not None and total >= app.config['PROFILE_SLOW_REQUESTS']:
+        # 遅かったリクエストのプロファイルを保存する（python -m pstats で確認できる）
+        os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+        filename = f'{time.strftime("%Y%m%d-%H%M%S")}_{route}_{int(total * 1000)}ms.prof'
+        profiler.dump_stats(os.path.join(app.config['PROFILE_FOLDER'], filename))
+    return response
+
+# --- 作業領域 ---
+# 状態はすべて作業領域のファイルに保存するため、どのワーカープロセスからでも同じセッションを扱える。
+
+class Workspace:
+    """セッションごとの作業領域（アップロード・履歴・出力と、履歴位置などの状態）"""
+
+    def __init__(self, workspace_id):
+        self.id = workspace_id
+        self.root = os.path.join(app.config['WORKSPACE_FOLDER'], workspace_id)
+        self.upload_folder = os.path.join(self.root, UPLOAD_FOLDER)
+        self.output_folder = os.path.join(self.root, OUTPUT_FOLDER)
+        self.history_folder = os.path.join(self.root, HISTORY_FOLDER)
+        for folder in [self.upload_folder, self.output_folder, self.history_folder]:
+            os.makedirs(folder, exist_ok=True)
+        self.state = self._load_state()
+
+    def _state_path(self):
+        return os.path.join(self.root, 'state.json')
+
+    def _load_state(self):
+        try:
+            with open(self._state_path(), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {
+                'original_filename': None,  # 最初にアップロードされたファイル名
+                'history_stack': [],        # 各操作の差分ファイル名
+                'history_index': -1         # 現在の位置
+            }
+
+    def save_state(self):
+        _write_json(self._state_path(), self.state)
+
+def _workspace():
+    """現在のリクエストの作業領域"""
+    return g.workspace
+
+# 署名鍵を自動生成して保存するファイル（配信・バージョン管理されるフォルダの外に置く）
+SECRET_KEY_FILE = os.environ.get('SECRET_KEY_FILE', os.path.join(os.path.expanduser('~'), '.pdf-page-editor', 'secret_key'))
+
+def _load_secret_key():
+    """セッションCookieの署名鍵（全ワーカーで共通にするため、環境変数またはファイルから読み込む）
+
+    環境変数 SECRET_KEY がなければ SECRET_KEY_FILE から読み込み、なければ作る（本人だけが読める権限にする）。
+    以前のバージョンが作業領域のフォルダに作った鍵があれば、その鍵を移して使い続ける。
+    """
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY']
+    key_path = SECRET_KEY_FILE
+    os.makedirs(os.path.dirname(key_path), mode=0o700, exist_ok=True)
+    legacy_path = os.path.join(WORKSPACE_FOLDER, '.secret_key')
+    if not os.path.exists(key_path):
+        try:
+            with open(legacy_path) as f:
+                new_key = f.read().strip()
+        except FileNotFoundError:
+            new_key = secrets.token_hex(32)
+        temp_path = f'{key_path}.{os.getpid()}.tmp'
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            f.write(new_key)
+        try:
+            # 複数のワーカーが同時に起動しても、最初に作られた鍵だけが使われるようにする
+            os.link(temp_path, key_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(legacy_path)
+    with open(key_path) as f:
+        return f.read().strip()
+
+app.secret_key = _load_secret_key()
+
+# fcntlが使えない環境（Windows）ではプロセス内のロックで代用する
+_workspace_thread_locks = {}
+_workspace_thread_locks_guard = threading.Lock()
+
+def _lock_workspace(workspace, blocking=True):
+    """作業領域を排他ロックする（取得できなければ None）"""
+    if fcntl:
+        handle = open(os.path.join(workspace.root, '.lock'), 'a')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return None
+        return handle
+    with _workspace_thread_locks_guard:
+        lock = _workspace_thread_locks.setdefault(workspace.id, threading.Lock())
+    return lock if lock.acquire(blocking) else None
+
+def _unlock_workspace(handle):
+    if fcntl:
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+    else:
+        handle.release()
+
+_last_workspace_sweep = 0.0
+
+def _remove_expired_workspaces():
+    """一定時間使われていない作業領域を削除する（10分に1回まで）"""
+    global _last_workspace_sweep
+    now = time.time()
+    if now - _last_workspace_sweep < 600:
+        return
+    _last_workspace_sweep = now
+    for entry in os.scandir(app.config['WORKSPACE_FOLDER']):
+        if not entry.is_dir() or now - entry.stat().st_mtime < app.config['WORKSPACE_TTL']:
+            continue
+        workspace = Workspace(entry.name)
+        # 使用中の作業領域は削除しない
+        handle = _lock_workspace(workspace, blocking=False)
+        if handle is None:
+            continue
+        try:
+            _documents.invalidate_folder(workspace.root)
+            shutil.rmtree(workspace.root, ignore_errors=True)
+        finally:
+            _unlock_workspace(handle)
+
+# 作業領域を使わないエンドポイント
+_WORKSPACE_FREE_ENDPOINTS = {'index', 'static', 'serve_thumbnail', 'metrics_endpoint'}
+# 作業領域をロックしないエンドポイント（ジョブ実行中でも応答する必要があるもの）
+# 分割アップロードのチャンクはそれぞれ別の位置に書き込むので、ロックせずに並行して受け付ける
+_WORKSPACE_UNLOCKED_ENDPOINTS = {'job_status', 'cancel_job', 'upload_chunk', 'upload_status'}
+# 作業領域を読むだけのエンドポイントもロックしない
+# （ページリストや状態は一時ファイル経由で置き換えて書くので、書きかけの状態が読まれることはない）
+_WORKSPACE_UNLOCKED_ENDPOINTS |= {'page_window', 'page_metadata', 'analyze_pages', 'search_text', 'page_tiles',
+                                  'serve_tile', 'history_status', 'get_original_filename', 'serve_output'}
+
+@app.before_request
+def _open_workspace():
+    """セッションの作業領域を開き、リクエストの間ロックする"""
+    _remove_expired_workspaces()
+    if request.endpoint in _WORKSPACE_FREE_ENDPOINTS:
+        return
+    workspace_id = session.get('workspace')
+    if not workspace_id or not re.fullmatch(r'[0-9a-f]{32}', workspace_id) \
+            or not os.path.isdir(os.path.join(app.config['WORKSPACE_FOLDER'], workspace_id)):
+        workspace_id = secrets.token_hex(16)
+        session['workspace'] = workspace_id
+    g.workspace = Workspace(workspace_id)
+    if request.endpoint not in _WORKSPACE_UNLOCKED_ENDPOINTS:
+        g.workspace_lock = _lock_workspace(g.workspace)
+    # 最終利用時刻を更新する
+    os.utime(g.workspace.root)
+
+@app.teardown_request
+def _close_workspace(exc):
+    handle = g.pop('workspace_lock', None)
+    if handle is not None:
+        _unlock_workspace(handle)
+
+# --- バックグラウンドジョブ ---
+# 重い処理はリクエストの外で実行し、ジョブIDをすぐに返す。
+# 進捗は作業領域の jobs/ フォルダに保存するため、どのワーカープロセスからでも参照・キャンセルできる。
+
+class JobCancelled(BaseException):
+    """ジョブがキャンセルされたことを表す（処理中の except Exception で握りつぶされないよう BaseException を継承）"""
+
+_job_executor = None
+_job_executor_lock = threading.Lock()
+
+def _get_job_executor():
+    global _job_executor
+    with _job_executor_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix='job')
+        return _job_executor
+
+def _job_path(workspace, job_id):
+    return os.path.join(workspace.root, 'jobs', f'{job_id}.json')
+
+def _load_job(workspace, job_id):
+    try:
+        with open(_job_path(workspace, job_id), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _no_progress(done, total):
+    """進捗を報告しない処理（同期実行）で使う進捗コールバック"""
+
+def _job_progress_reporter(workspace, job):
+    """ジョブの進捗を記録し、キャンセル要求があれば JobCancelled を送出するコールバックを作る"""
+    cancel_path = _job_path(workspace, job['id']) + '.cancel'
+    last_written = 0.0
+
+    def report(done, total):
+        nonlocal last_written
+        if os.path.exists(cancel_path):
+            raise JobCancelled()
+        job['pages_done'] = done
+        job['pages_total'] = total
+        # ページごとに書き込むと遅くなるため、0.5秒に1回だけ保存する
+        now = time.time()
+        if now - last_written >= 0.5 or done == total:
+            last_written = now
+            _write_json(_job_path(workspace, job['id']), job)
+    return report
+
+def _run_job(workspace_id, job, func, data):
+    """ジョブを実行する（ジョブ用スレッドで実行）"""
+    with app.app_context():
+        g.workspace = workspace = Workspace(workspace_id)
+        handle = _lock_workspace(workspace)
+        _start_measurement()
+        try:
+            job.update(status='running', started_at=time.time())
+            _write_json(_job_path(workspace, job['id']), job)
+            rv = func(data, _job_progress_reporter(workspace, job))
+            response, status_code = rv if isinstance(rv, tuple) else (rv, rv.status_code)
+            job.update(status='done' if status_code < 400 else 'failed', result=response.get_json(), status_code=status_code)
+        except JobCancelled:
+            job.update(status='cancelled')
+        except Exception as e:
+            job.update(status='failed', result={'error': str(e)}, status_code=500)
+        finally:
+            job['finished_at'] = time.time()
+            job['timings'], _ = _finish_measurement(f'job:{job["endpoint"]}')
+            _write_json(_job_path(workspace, job['id']), job)
+            _unlock_workspace(handle)
+
+def _run_operation(func, data):
+    """処理を実行する。data に async が指定されていればジョブとして登録し、ジョブIDを返す"""
+    if not data.get('async'):
+        return func(data, _no_progress)
+
+    workspace = _workspace()
+    os.makedirs(os.path.join(workspace.root, 'jobs'), exist_ok=True)
+    job = {
+        'id': secrets.token_hex(8),
+        'endpoint': request.path,
+        'status': 'queued',
+        'pages_done': 0,
+        'pages_total': None,
+        'created_at': time.time()
+    }
+    _write_json(_job_path(workspace, job['id']), job)
+    _get_job_executor().submit(_run_job, workspace.id, job, func, data)
+    return jsonify({'job_id': job['id'], 'status_url': f'/jobs/{job["id"]}'}), 202
 
 # --- ヘルパー関数 ---
+@_phase('history')
 def _save_history():
-    """現在のPDF状態を履歴に保存"""
-    global history_stack, history_index
+    """直前の状態から現在のページリストへの差分を履歴に保存
 
-    original_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
+    PDFやページリスト全体はコピーせず、変化したページの項目だけを記録する。
+    一定の操作回数ごとにページリスト全体（チェックポイント）も保存する。
+    """
+    workspace = _workspace()
+    state = workspace.state
 
-    if not os.path.exists(original_pdf_path):
+    if not os.path.exists(_manifest_path()):
         return
 
     # 現在より後の履歴を削除（新しい操作が行われた場合）
-    if history_index < len(history_stack) - 1:
-        for i in range(history_index + 1, len(history_stack)):
-            old_file = os.path.join(HISTORY_FOLDER, f'history_{i}.pdf')
+    if state['history_index'] < len(state['history_stack']) - 1:
+        for i in range(state['history_index'] + 1, len(state['history_stack'])):
+            old_file = os.path.join(workspace.history_folder, state['history_stack'][i])
             if os.path.exists(old_file):
                 os.remove(old_file)
-        history_stack = history_stack[:history_index + 1]
+        state['history_stack'] = state['history_stack'][:state['history_index'] + 1]
+
+    head = _load_history_head()
+    manifest = _load_manifest()
+    forward, backward = _diff_pages(head['pages'], manifest['pages'])
+    step = {
+        'forward': forward,
+        'backward': backward,
+        # 相手側の状態に存在しないソースの情報だけを持たせる
+        'forward_sources': _sources_of(forward, manifest, exclude=head['sources']),
+        'backward_sources': _sources_of(backward, head, exclude=manifest['sources']),
+        'checkpoint': None
+    }
 
     # 履歴に保存
-    history_index += 1
-    history_filename = f'history_{history_index}.pdf'
-    history_path = os.path.join(HISTORY_FOLDER, history_filename)
-    shutil.copy(original_pdf_path, history_path)
+    history_stack = state['history_stack']
+    state['history_index'] += 1
+    step_number = int(history_stack[-1].split('_')[1].split('.')[0]) + 1 if history_stack else 0
+    if step_number % app.config['HISTORY_CHECKPOINT_INTERVAL'] == 0:
+        step['checkpoint'] = {'pages': manifest['pages'], 'sources': manifest['sources']}
+    history_filename = f'history_{step_number}.json'
+    _write_json(os.path.join(workspace.history_folder, history_filename), step)
     history_stack.append(history_filename)
+    _write_json(_history_head_path(), manifest)
 
-    # 履歴が多すぎる場合は古いものを削除（最大20個）
-    if len(history_stack) > 20:
-        old_file = os.path.join(HISTORY_FOLDER, history_stack[0])
+    # 履歴が多すぎる場合は古いものを削除
+    if len(history_stack) > app.config['HISTORY_LIMIT']:
+        old_file = os.path.join(workspace.history_folder, history_stack[0])
         if os.path.exists(old_file):
             os.remove(old_file)
         history_stack.pop(0)
-        history_index -= 1
+        state['history_index'] -= 1
+
+    workspace.save_state()
+    _remove_unused_sources()
+
+@_phase('history')
+def _move_history(target_index):
+    """履歴の差分を適用して、target_index の状態のページリストを復元する"""
+    state = _workspace().state
+    history_stack = state['history_stack']
+    history_index = state['history_index']
+
+    manifest = _load_manifest()
+    if target_index < history_index:
+        # 戻る：現在の操作の逆差分を適用する
+        step = _load_history_step(history_stack[history_index])
+        target_step = _load_history_step(history_stack[target_index])
+        if target_step['checkpoint']:
+            manifest.update(target_step['checkpoint'])
+        else:
+            _apply_page_delta(manifest['pages'], step['backward'])
+            manifest['sources'].update(step['backward_sources'])
+    else:
+        # 進む：次の操作の差分を適用する
+        step = _load_history_step(history_stack[target_index])
+        if step['checkpoint']:
+            manifest.update(step['checkpoint'])
+        else:
+            _apply_page_delta(manifest['pages'], step['forward'])
+            manifest['sources'].update(step['forward_sources'])
+
+    _save_manifest(manifest)
+    _write_json(_history_head_path(), manifest)
+    state['history_index'] = target_index
+    _workspace().save_state()
+
+def _diff_pages(old, new):
+    """2つのページリストの差分を、順方向と逆方向の [開始, 終了, 置き換える項目] のリストで返す"""
+    # 前後の共通部分を除いてから比較する
+    start = 0
+    while start < min(len(old), len(new)) and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < min(len(old), len(new)) - start and old[-1 - end] == new[-1 - end]:
+        end += 1
+    old_middle = old[start:len(old) - end]
+    new_middle = new[start:len(new) - end]
+
+    if not old_middle and not new_middle:
+        return [], []
+    if len(old_middle) * len(new_middle) > _HISTORY_DIFF_LIMIT ** 2:
+        # 大きな並べ替えなどは詳細な比較をせず、範囲全体の置き換えとして記録する
+        return [[start, start + len(old_middle), new_middle]], [[start, start + len(new_middle), old_middle]]
+
+    def key(entry):
+        return (entry['source'], entry['index'], entry['rotation'])
+    matcher = difflib.SequenceMatcher(None, [key(e) for e in old_middle], [key(e) for e in new_middle], autojunk=False)
+    forward = []
+    backward = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        forward.append([start + i1, start + i2, new_middle[j1:j2]])
+        backward.append([start + j1, start + j2, old_middle[i1:i2]])
+    return forward, backward
+
+def _apply_page_delta(pages, delta):
+    """_diff_pages の差分をページリストに適用する（後ろから適用して位置のずれを防ぐ）"""
+    for start, end, entries in reversed(delta):
+        pages[start:end] = entries
+
+def _sources_of(delta, manifest, exclude):
+    """差分に含まれるページのソース情報のうち、exclude に含まれないものを返す"""
+    used = {entry['source'] for _, _, entries in delta for entry in entries}
+    return {source_id: manifest['sources'][source_id] for source_id in used if source_id not in exclude}
+
+def _history_head_path():
+    """履歴の現在位置のページリスト（次の差分の比較元）"""
+    return os.path.join(_workspace().history_folder, 'head.json')
+
+def _load_history_head():
+    try:
+        with open(_history_head_path(), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'version': 0, 'sources': {}, 'pages': []}
+
+def _load_history_step(history_filename):
+    with open(os.path.join(_workspace().history_folder, history_filename), encoding='utf-8') as f:
+        return json.load(f)
+
+def _write_json(path, data):
+    """JSONファイルを書き出す（書きかけの状態が読まれないよう一時ファイル経由で置き換える）"""
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    _count_written(temp_path)
+    os.replace(temp_path, path)
 
 def _regenerate_pdf_and_thumbnails(new_order, message):
-    """指定された順序でPDFを再生成し、サムネイルも更新する"""
-    original_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
-    if not os.path.exists(original_pdf_path):
+    """指定された順序にページリストを並べ替え、サムネイルも更新する"""
+    manifest = _load_manifest()
+    if not manifest['pages']:
         return jsonify({'error': 'PDFファイルがアップロードされていません'}), 400
 
     try:
-        reader = pypdf.PdfReader(original_pdf_path)
-        writer = pypdf.PdfWriter()
-
-        if not new_order and len(reader.pages) > 0:
-            new_order = range(len(reader.pages))
+        if not new_order:
+            new_order = range(len(manifest['pages']))
 
         for page_index in new_order:
-            if page_index >= len(reader.pages):
+            if not 0 <= page_index < len(manifest['pages']):
                 return jsonify({'error': f'無効なページ番号です: {page_index}'}), 400
-            writer.add_page(reader.pages[page_index])
 
-        temp_filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded_temp.pdf')
-        with open(temp_filepath, 'wb') as f:
-            writer.write(f)
-
-        os.remove(original_pdf_path)
-        os.rename(temp_filepath, original_pdf_path)
+        # PDFは書き換えず、ページリストだけを並べ替える
+        manifest['pages'] = [manifest['pages'][page_index] for page_index in new_order]
+        _save_manifest(manifest)
 
         # 操作後に履歴を保存
         _save_history()
@@ -109,34 +646,743 @@ def _regenerate_pdf_and_thumbnails(new_order, message):
     except Exception as e:
         return jsonify({'error': f'PDFの再生成中にエラーが発生しました: {str(e)}'}), 500
 
-def _generate_thumbnails_and_response(message, download_url=None):
-    """現在のuploaded.pdfからサムネイルを生成し、JSONレスポンスを返す"""
-    pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
-    try:
-        shutil.rmtree(app.config['THUMBNAIL_FOLDER'], ignore_errors=True)
-        os.makedirs(app.config['THUMBNAIL_FOLDER'])
-        doc = fitz.open(pdf_path)
-        page_count = len(doc)
-        thumbnail_urls = []
-        for i in range(page_count):
-            page = doc.load_page(i)
-            pix = page.get_pixmap(dpi=72)
-            thumb_path = os.path.join(app.config['THUMBNAIL_FOLDER'], f'page_{i}.png')
-            pix.save(thumb_path)
-            mtime = os.path.getmtime(thumb_path)
-            thumbnail_urls.append(f'/thumbnails/page_{i}.png?t={mtime}')
+# 並べ替え系の操作のページ順と、ページごとの編集（分割・黒塗り）はエンジンと共通
+_page_order = _phase('transform')(pdf_engine.page_order)
+
+def _mask_rects(masks, redact=False):
+    """ページに複数の領域を黒塗りする edit を作る"""
+    def edit(doc, page_number):
+        return pdf_engine.mask_page(doc[page_number], masks, redact)
+    return edit
+
+def _mask_edits(manifest, params):
+    """マスキングの引数から {ページ番号: edit} を作る
+
+    masks（領域ごとのページの選び方）・mask と interval・offset・search（その語句が現れるすべての箇所）を
+    組み合わせて指定でき、同じページに当たる領域はまとめて1回で黒塗りする。
+    """
+    redact = params.get('redact', False)  # 真なら下にある文字や画像も削除する
+    search = (params.get('search') or '').strip()
+    if 'mask' not in params and not params.get('masks') and not search:
+        raise ValueError('マスク領域が指定されていません')
+    return _region_edits(manifest, pdf_engine.mask_regions(len(manifest['pages']), params), search, redact)
+
+def _region_edits(manifest, regions, search, redact):
+    """{ページ番号: [領域, ...]} に語句（search）が現れる箇所を加え、{ページ番号: edit} を作る"""
+    if search:
+        hits = _search_hits(manifest, _search_pages(manifest, search), search)
+        for page_index, rects in hits.items():
+            regions.setdefault(page_index, []).extend(dict(rect, redact=redact) for rect in rects)
+    return {page_index: _mask_rects(rects) for page_index, rects in regions.items() if rects}
+
+@_phase('transform')
+def _derive_pages(manifest, edits, name, progress=_no_progress):
+    """指定したページだけを取り出して編集し、新しいソースとして差し替える
+
+    edits は {ページ番号: edit} の辞書。edit(doc, page_number) は doc のそのページをその場で編集し
+    （後ろにページを追加してもよい）、変更しなかった場合は False を返す。
+    対象外のページと変更されなかったページは元のソースを参照したまま残る。
+    """
+    page_indices = sorted(edits)
+    derived = {}
+    sources = {}
+    doc = fitz.open()
+    try:
+        with contextlib.ExitStack() as stack:
+            # 複数のスレッドが同じ文書を逆の順に待たないよう、ソースIDの順に開く
+            for source_id in sorted({manifest['pages'][page_index]['source'] for page_index in page_indices}):
+                sources[source_id] = stack.enter_context(_open_document(_source_path(source_id)))
+            for count, page_index in enumerate(page_indices):
+                progress(count, len(page_indices))
+                entry = manifest['pages'][page_index]
+                start = len(doc)
+                doc.insert_pdf(sources[entry['source']], from_page=entry['index'], to_page=entry['index'])
+                if entry['rotation']:
+                    page = doc[start]
+                    page.set_rotation((page.rotation + entry['rotation']) % 360)
+                if edits[page_index](doc, start):
+                    derived[page_index] = range(start, len(doc))
+                else:
+                    doc.delete_pages(start, len(doc) - 1)
+        progress(len(page_indices), len(page_indices))
+
+        if not derived:
+            return False
+        new_entries = _add_source_from_document(manifest, doc, name)
+    finally:
         doc.close()
+
+    pages = []
+    for page_index, entry in enumerate(manifest['pages']):
+        if page_index in derived:
+            pages.extend(new_entries[i] for i in derived[page_index])
+        else:
+            pages.append(entry)
+    manifest['pages'] = pages
+    return True
+
+# --- ページリスト（マニフェスト） ---
+# 編集中の文書は、アップロードされた元のPDF（ソース）を書き換えずに保持し、
+# 各ページが「どのソースの何ページ目を何度回転したものか」のリストとして表す。
+# PDFファイルはダウンロードや保存のときにだけ生成する。
+
+def _manifest_path():
+    return os.path.join(_workspace().upload_folder, 'manifest.json')
+
+def _source_path(source_id):
+    return os.path.join(_workspace().upload_folder, 'sources', f'{source_id}.pdf')
+
+def _metadata_path(source_id):
+    """ソースのページのメタデータ（ソースと同じ場所に置く）"""
+    return os.path.join(_workspace().upload_folder, 'sources', f'{source_id}.json')
+
+# ソースは内容のハッシュ値で管理していて書き換えないため、解析済みの文書をリクエストをまたいで開いたままにしておく
+_documents = doccache.DocumentCache(app.config['DOCUMENT_CACHE_BYTES'])
+
+def _open_document(path, kind='fitz'):
+    """文書キャッシュから文書を開く（with で使い、ブロック内でだけ使う）"""
+    _documents.max_bytes = app.config['DOCUMENT_CACHE_BYTES']
+    return _documents.open(path, kind)
+
+def _load_manifest():
+    """現在のページリストを読み込む（未アップロードの場合は空のリスト）"""
+    try:
+        with open(_manifest_path(), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'version': 0, 'sources': {}, 'pages': []}
+
+@_phase('serialize')
+def _save_manifest(manifest):
+    """ページリストを保存する（参照されなくなったソースの情報は取り除く）"""
+    used = {entry['source'] for entry in manifest['pages']}
+    manifest['sources'] = {source_id: info for source_id, info in manifest['sources'].items() if source_id in used}
+    manifest['version'] = manifest.get('version', 0) + 1
+    _write_json(_manifest_path(), manifest)
+
+@_phase('parse')
+def _add_source(manifest, pdf_path, name):
+    """PDFをソースとして登録し、そのページのリストを返す（pdf_pathのファイルは移動される）"""
+    digest = hashlib.sha1()
+    with open(pdf_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    # 同じ内容のファイルは同じソースとして共有する
+    source_id = digest.hexdigest()[:20]
+    source_path = _source_path(source_id)
+    os.makedirs(os.path.dirname(source_path), exist_ok=True)
+    if os.path.exists(source_path):
+        os.remove(pdf_path)
+    else:
+        os.replace(pdf_path, source_path)
+        _count_written(source_path)
+
+    if source_id not in manifest['sources']:
+        # ここで開いた文書はそのままキャッシュに残り、続く編集やプレビューで使われる
+        with _open_document(source_path) as doc:
+            if not doc.is_pdf:
+                raise ValueError('PDFファイルではありません')
+            manifest['sources'][source_id] = {
+                'name': name,
+                'page_fingerprints': _page_fingerprints(doc)
+            }
+            if not os.path.exists(_metadata_path(source_id)):
+                _write_json(_metadata_path(source_id), _page_metadata(doc))
+
+    page_count = len(manifest['sources'][source_id]['page_fingerprints'])
+    return [{'source': source_id, 'index': i, 'rotation': 0} for i in range(page_count)]
+
+@_phase('serialize')
+def _add_source_from_document(manifest, doc, name):
+    """fitzで生成した文書をソースとして保存・登録し、そのページのリストを返す"""
+    temp_path = os.path.join(_workspace().upload_folder, f'source_{os.getpid()}.tmp')
+    doc.save(temp_path, garbage=4, deflate=True, clean=True)
+    return _add_source(manifest, temp_path, name)
+
+def _remove_unused_sources():
+    """現在のページリストと履歴のどれからも参照されていないソースを削除する"""
+    source_folder = os.path.dirname(_source_path('x'))
+    if not os.path.isdir(source_folder):
+        return
+    # 履歴で辿れる状態のページは、現在のページリストかいずれかの差分に必ず含まれる
+    used = {entry['source'] for entry in _load_manifest()['pages']}
+    for history_filename in _workspace().state['history_stack']:
+        step = _load_history_step(history_filename)
+        for _, _, entries in step['forward'] + step['backward']:
+            used.update(entry['source'] for entry in entries)
+        if step['checkpoint']:
+            used.update(step['checkpoint']['sources'])
+    for filename in os.listdir(source_folder):
+        source_id, extension = os.path.splitext(filename)
+        if extension in ('.pdf', '.json') and source_id not in used:
+            _documents.invalidate(os.path.join(source_folder, filename))
+            os.remove(os.path.join(source_folder, filename))
+
+def _entry_fingerprint(manifest, entry):
+    """ページリストの1項目の指紋（元ページの内容・追加の回転・サムネイル解像度から決まる）"""
+    base = manifest['sources'][entry['source']]['page_fingerprints'][entry['index']]
+    return hashlib.sha1(f'{base}|{entry["rotation"]}|{app.config["THUMBNAIL_DPI"]}'.encode('utf-8')).hexdigest()
+
+def _render_tasks(pages):
+    """ページリストからラスタライズ用のタスクを作る"""
+    return [(_source_path(entry['source']), entry['index'], entry['rotation']) for entry in pages]
+
+@_phase('parse')
+def _build_pdf_writer(pages):
+    """ページリストからpypdfのPdfWriterを組み立てる"""
+    readers = {}
+    writer = pypdf.PdfWriter()
+    # add_page はページを書き出し側に複製するので、読み込み側の文書を使うのはこの中だけでよい
+    with contextlib.ExitStack() as stack:
+        for source_id in sorted({entry['source'] for entry in pages}):
+            readers[source_id] = stack.enter_context(_open_document(_source_path(source_id), 'pypdf'))
+        for entry in pages:
+            page = writer.add_page(readers[entry['source']].pages[entry['index']])
+            if entry['rotation']:
+                page.rotate(entry['rotation'])
+    return writer
+
+def _optimize_output(pdf_bytes, options, report):
+    """書き出すPDFを最適化する（options が None なら何もしない）。report に最適化の結果を足し込む"""
+    if options is None:
+        return pdf_bytes
+    with _phase('optimize'):
+        pdf_bytes, result = pdf_engine.optimize_pdf(pdf_bytes, options)
+    for key, value in result.items():
+        report[key] = report.get(key, 0) + value
+    return pdf_bytes
+
+def _write_pdf(writer, output_path, options, report):
+    """PdfWriter の内容をファイルに書き出す（options が指定されていれば最適化してから書き出す）"""
+    with _phase('serialize'):
+        if options is None:
+            with open(output_path, 'wb') as f:
+                writer.write(f)
+        else:
+            buffer = io.BytesIO()
+            writer.write(buffer)
+    if options is not None:
+        pdf_bytes = _optimize_output(buffer.getvalue(), options, report)
+        with open(output_path, 'wb') as f:
+            f.write(pdf_bytes)
+    _count_written(output_path)
+
+def _optimization_summary(report):
+    """最適化の結果をレスポンス用にまとめる（最適化していなければ None）"""
+    if not report:
+        return None
+    return {
+        'bytes_before': report['bytes_before'],
+        'bytes_after': report['bytes_after'],
+        'saved_ratio': round(1 - report['bytes_after'] / report['bytes_before'], 4) if report['bytes_before'] else 0,
+        'images_downsampled': report['images_downsampled'],
+        'seconds': round(report['seconds'], 3)
+    }
+
+# PDFの間接参照（例: "12 0 R"）
+_PDF_REF_PATTERN = re.compile(r'(\d+) (\d+) R')
+# ページオブジェクト中の親ノードへの参照
+_PDF_PARENT_PATTERN = re.compile(r'/Parent\s+\d+\s+\d+\s+R')
+
+def _resolve_pdf_refs(doc, text, memo):
+    """オブジェクト定義中の間接参照を参照先のハッシュ値に置き換える"""
+    return _PDF_REF_PATTERN.sub(lambda m: '<' + _pdf_object_digest(doc, int(m.group(1)), memo) + '>', text)
+
+def _pdf_object_digest(doc, xref, memo):
+    """xrefのオブジェクトを参照先まで含めてハッシュ化する（xref番号に依存しない）"""
+    if xref in memo:
+        return memo[xref]
+    # 循環参照対策として計算中の印を付けておく
+    memo[xref] = 'cycle'
+    digest = hashlib.sha1()
+    digest.update(_resolve_pdf_refs(doc, doc.xref_object(xref, compressed=True), memo).encode('utf-8'))
+    if doc.xref_is_stream(xref):
+        digest.update(doc.xref_stream_raw(xref) or b'')
+    memo[xref] = digest.hexdigest()
+    return memo[xref]
+
+def _page_fingerprints(doc):
+    """各ページのコンテンツストリーム・リソース・回転からページ内容の指紋を計算する"""
+    # 他ページへの参照（リンク注釈など）を辿ってページツリー全体をハッシュしないよう、ページ自体は固定値にする
+    memo = {doc[i].xref: 'page' for i in range(len(doc))}
+    fingerprints = []
+    for i in range(len(doc)):
+        page = doc.load_page(i)
+        page_object = _PDF_PARENT_PATTERN.sub('', doc.xref_object(page.xref, compressed=True))
+        digest = hashlib.sha1()
+        digest.update(_resolve_pdf_refs(doc, page_object, memo).encode('utf-8'))
+        # 親から継承されるリソースも含める
+        parent = doc.xref_get_key(page.xref, 'Parent')
+        while doc.xref_get_key(page.xref, 'Resources')[0] == 'null' and parent[0] == 'xref':
+            parent_xref = int(parent[1].split()[0])
+            resources = doc.xref_get_key(parent_xref, 'Resources')
+            if resources[0] != 'null':
+                digest.update(_resolve_pdf_refs(doc, resources[1], memo).encode('utf-8'))
+                break
+            parent = doc.xref_get_key(parent_xref, 'Parent')
+        # 継承される回転・用紙サイズも指紋に含める
+        digest.update(f'{page.rotation}|{tuple(page.mediabox)}|{tuple(page.cropbox)}'.encode('utf-8'))
+        fingerprints.append(digest.hexdigest())
+    return fingerprints
+
+def _page_metadata(doc):
+    """各ページの大きさ・回転・文字の有無・画像の数・コンテンツストリームの大きさを調べる
+
+    ページを描画したり文字を抽出したりせず、ページの辞書とリソースだけを見る。
+    文字の有無はフォントを使っているかどうかで判定する。
+    """
+    pages = []
+    for page in doc:
+        content_bytes = 0
+        for xref in page.get_contents():
+            content_bytes += _stream_length(doc, xref)
+        pages.append({
+            'width': round(page.rect.width, 1),
+            'height': round(page.rect.height, 1),
+            'rotation': page.rotation,
+            'text': bool(page.get_fonts()),
+            'images': len(page.get_images()),
+            'content_bytes': content_bytes
+        })
+    return {'pages': pages}
+
+def _stream_length(doc, xref):
+    """ストリームの大きさ（圧縮後のバイト数）を /Length から求める
+
+    /Length がない、または整数でない（壊れたPDFなど）場合は、ストリームを読み込んで大きさを数える。
+    """
+    length_type, length = doc.xref_get_key(xref, 'Length')
+    if length_type == 'xref':
+        length_type, length = 'int', doc.xref_object(int(length.split()[0])).strip()
+    if length_type == 'int' and length.isdigit():
+        return int(length)
+    return len(doc.xref_stream_raw(xref) or b'')
+
+def _source_metadata(source_id):
+    """ソースのページのメタデータを読み込む（以前に登録されたソースで保存されていなければ作る）"""
+    try:
+        with open(_metadata_path(source_id), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    with _open_document(_source_path(source_id)) as doc:
+        metadata = _page_metadata(doc)
+    _write_json(_metadata_path(source_id), metadata)
+    return metadata
+
+def _page_info(manifest, pages):
+    """ページリストの各項目の大きさ・回転・向きなどを、ソースのメタデータと追加の回転から求める"""
+    metadata = {}
+    infos = []
+    for entry in pages:
+        if entry['source'] not in metadata:
+            metadata[entry['source']] = _source_metadata(entry['source'])['pages']
+        page = metadata[entry['source']][entry['index']]
+        width, height = page['width'], page['height']
+        if entry['rotation'] % 180:
+            width, height = height, width
+        infos.append({
+            'width': width,
+            'height': height,
+            'rotation': (page['rotation'] + entry['rotation']) % 360,
+            'orientation': 'landscape' if width > height else 'portrait',
+            'text': page['text'],
+            'images': page['images'],
+            'content_bytes': page['content_bytes']
+        })
+    return infos
+
+def _render_pages(tasks, dpi, fmt='png', quality=rasterizer.DEFAULT_QUALITY, cell_height=None):
+    """設定されたワーカー数・チャンクサイズでページを並列にレンダリングする"""
+    return _timed_iter(rasterizer.render_pages(
+        tasks, dpi,
+        workers=app.config['RASTER_WORKERS'],
+        chunk_size=app.config['RASTER_CHUNK_SIZE'],
+        fmt=fmt,
+        quality=quality,
+        cell_height=cell_height
+    ), 'rasterize')
+
+def _evict_thumbnail_cache(keep):
+    """サムネイルキャッシュが上限を超えた場合、最後に使われた時刻が古いものから削除する（LRU）"""
+    _evict_cache(app.config['THUMBNAIL_FOLDER'], app.config['THUMBNAIL_CACHE_BYTES'], keep)
+
+def _evict_cache(folder, limit, keep=()):
+    """フォルダの合計サイズが上限を超えた場合、最後に使われた時刻が古いファイルから削除する（LRU）"""
+    entries = []
+    total_size = 0
+    for entry in os.scandir(folder):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.name))
+        total_size += stat.st_size
+
+    if total_size <= limit:
+        return
+
+    entries.sort()
+    for _, size, name in entries:
+        if total_size <= limit:
+            break
+        # 現在表示中のページのサムネイル（圧縮版を含む）は削除しない
+        if name.removesuffix('.gz') in keep:
+            continue
+        try:
+            os.remove(os.path.join(folder, name))
+            total_size -= size
+        except OSError:
+            pass
+
+def _precompress_thumbnail(thumb_path):
+    """サムネイルのgzip圧縮版を保存する（小さくならない場合は保存しない）"""
+    with open(thumb_path, 'rb') as f:
+        data = f.read()
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(compressed) >= len(data):
+        return
+    temp_path = f'{thumb_path}.gz.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(compressed)
+    os.replace(temp_path, thumb_path + '.gz')
+    _count_written(thumb_path + '.gz')
+
+@_phase('rasterize')
+def _render_thumbnails(manifest, pages):
+    """ページのサムネイルを用意し、ファイル名のリストを返す
+
+    サムネイルはページ内容の指紋をファイル名としてキャッシュし、
+    指紋が変わったページ（新規・変更されたページ）だけをレンダリングする。
+    """
+    thumb_filenames = []
+    render_tasks = []
+    pending_paths = set()
+    for entry in pages:
+        thumb_filename = f'{_entry_fingerprint(manifest, entry)}.png'
+        thumb_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumb_filename)
+        if os.path.exists(thumb_path):
+            # キャッシュヒット：最終利用時刻を更新する
+            os.utime(thumb_path)
+        elif thumb_path not in pending_paths:
+            # 同じ内容のページが複数ある場合は1回だけレンダリングする
+            pending_paths.add(thumb_path)
+            render_tasks.append(_render_tasks([entry])[0] + (thumb_path,))
+        thumb_filenames.append(thumb_filename)
+    # 新しい指紋のページだけを並列にレンダリングする（アトラスを使う場合は、アトラス用の縮小画像も一緒に作る）
+    cell_height = app.config['THUMBNAIL_ATLAS_HEIGHT'] if app.config['THUMBNAIL_ATLAS_PAGES'] > 0 else None
+    for _ in _render_pages(render_tasks, app.config['THUMBNAIL_DPI'], cell_height=cell_height):
+        pass
+    for thumb_path in pending_paths:
+        _count_written(thumb_path)
+        if app.config['THUMBNAIL_PRECOMPRESS']:
+            _precompress_thumbnail(thumb_path)
+    return thumb_filenames
+
+def _atlas_groups(fingerprints, per_atlas):
+    """ページの指紋の並びを、1枚のアトラスにまとめる範囲 (開始, 終了) のリストに区切る
+
+    区切る位置はページの番号ではなく指紋から決める（指紋から求めた値が割り切れるページの後ろで区切る）。
+    ページを削除・追加・変更しても、その前後以外のアトラスは同じページのまとまりのまま残り、作り直さずに済む。
+    1枚のページ数は per_atlas の半分から2倍までで、平均がおよそ per_atlas になる。
+    """
+    min_pages = max(1, per_atlas // 2)
+    max_pages = per_atlas * 2
+    divisor = per_atlas - min_pages + 1
+    groups = []
+    start = 0
+    for i, fingerprint in enumerate(fingerprints):
+        length = i + 1 - start
+        if length >= max_pages or (length >= min_pages and int(fingerprint[:8], 16) % divisor == 0):
+            groups.append((start, i + 1))
+            start = i + 1
+    if start < len(fingerprints):
+        groups.append((start, len(fingerprints)))
+    return groups
+
+@_phase('rasterize')
+def _thumbnail_atlases(groups):
+    """ページのまとまりごとにアトラスを用意し、画像の一覧と各ページの位置を返す
+
+    groups はアトラスごとのページの指紋のリスト（_atlas_groups で区切ったもの）。アトラスはキャッシュ済みの
+    サムネイル（指紋.png、先に _render_thumbnails で用意する）を縮小して並べるだけで、ページをレンダリングしない。
+    縮小した画像もキャッシュするので、並べ替えなどでまとまりが変わったアトラスもすぐに作り直せる。
+    ファイル名はまとめたサムネイルから決まるため、同じまとまりのアトラスは位置が変わっても作り直さない。
+    """
+    folder = app.config['THUMBNAIL_FOLDER']
+    columns = app.config['THUMBNAIL_ATLAS_COLUMNS']
+    height = app.config['THUMBNAIL_ATLAS_HEIGHT']
+    quality = app.config['THUMBNAIL_ATLAS_QUALITY']
+    names = []
+    jobs = {}
+    for group in groups:
+        # 同じ内容のページは1回だけ並べる
+        thumb_filenames = [f'{fingerprint}.png' for fingerprint in dict.fromkeys(group)]
+        key = '|'.join(thumb_filenames + [str(columns), str(height), str(quality)])
+        name = f'atlas_{hashlib.sha1(key.encode("utf-8")).hexdigest()}'
+        image_path = os.path.join(folder, f'{name}.jpg')
+        index_path = os.path.join(folder, f'{name}.json')
+        if os.path.exists(image_path) and os.path.exists(index_path):
+            os.utime(image_path)
+            os.utime(index_path)
+        elif name not in jobs:
+            jobs[name] = (thumb_filenames, image_path)
+        names.append(name)
+
+    results = rasterizer.compose_atlases(
+        [([os.path.join(folder, filename) for filename in thumb_filenames], columns, height, image_path)
+         for thumb_filenames, image_path in jobs.values()],
+        workers=app.config['RASTER_WORKERS'], quality=quality
+    )
+    for (name, (thumb_filenames, image_path)), (width, atlas_height, placements) in zip(jobs.items(), results):
+        _count_written(image_path)
+        _write_json(os.path.join(folder, f'{name}.json'), {
+            'width': width,
+            'height': atlas_height,
+            'fingerprints': [filename[:-len('.png')] for filename in thumb_filenames],
+            'placements': placements
+        })
+
+    images = []
+    atlas_numbers = {}
+    placements = []
+    for name, group in zip(names, groups):
+        if name not in atlas_numbers:
+            with open(os.path.join(folder, f'{name}.json'), encoding='utf-8') as f:
+                index = json.load(f)
+            atlas_numbers[name] = (len(images), dict(zip(index['fingerprints'], index['placements'])))
+            images.append({'url': f'/thumbnails/{name}.jpg', 'width': index['width'], 'height': index['height']})
+        atlas_number, positions = atlas_numbers[name]
+        placements.extend([atlas_number] + positions[fingerprint] for fingerprint in group)
+    return {'images': images, 'pages': placements}
+
+def _page_window(manifest, start, end):
+    """ページリストの start から end までのサムネイルを用意し、URL・大きさ・アトラス上の位置を返す"""
+    pages = manifest['pages']
+    per_atlas = app.config['THUMBNAIL_ATLAS_PAGES']
+    groups = []
+    if per_atlas > 0 and start < end:
+        # 範囲にかかるアトラスのページはすべて、サムネイルを用意してからアトラスにまとめる
+        fingerprints = [_entry_fingerprint(manifest, entry) for entry in pages]
+        groups = [(first, last) for first, last in _atlas_groups(fingerprints, per_atlas) if first < end and last > start]
+    render_start, render_end = (groups[0][0], groups[-1][1]) if groups else (start, end)
+    thumb_filenames = _render_thumbnails(manifest, pages[render_start:render_end])
+    keep = set(thumb_filenames)
+    window = {
+        'start': start,
+        'thumbnails': [f'/thumbnails/{filename}' for filename in thumb_filenames[start - render_start:end - render_start]],
+        'sizes': [[info['width'], info['height']] for info in _page_info(manifest, pages[start:end])]
+    }
+    if groups:
+        atlas = _thumbnail_atlases([fingerprints[first:last] for first, last in groups])
+        atlas['pages'] = atlas['pages'][start - render_start:end - render_start]
+        window['atlas'] = atlas
+        for image in atlas['images']:
+            name = image['url'].rsplit('/', 1)[1]
+            keep.update({name, name[:-len('.jpg')] + '.json'})
+        keep.update(rasterizer.atlas_cell_path(filename, app.config['THUMBNAIL_ATLAS_HEIGHT']) for filename in thumb_filenames)
+    _evict_thumbnail_cache(keep)
+    return window
+
+@_phase('response')
+def _generate_thumbnails_and_response(message, download_url=None):
+    """現在のページリストのサムネイルを用意し、JSONレスポンスを返す
+
+    ページ数が THUMBNAIL_INLINE_PAGES を超える場合はサムネイルを含めず、
+    クライアントが表示する範囲だけを /pages で取得する。
+    """
+    try:
+        os.makedirs(app.config['THUMBNAIL_FOLDER'], exist_ok=True)
+        manifest = _load_manifest()
+        page_count = len(manifest['pages'])
         response = {
             'message': message,
-            'page_count': page_count,
-            'thumbnails': thumbnail_urls
+            'page_count': page_count
         }
+        if page_count <= app.config['THUMBNAIL_INLINE_PAGES']:
+            window = _page_window(manifest, 0, page_count)
+            del window['start']
+            response.update(window)
         if download_url:
             response['download_url'] = download_url
         return jsonify(response)
     except Exception as e:
         return jsonify({'error': f'サムネイル生成中にエラーが発生しました: {str(e)}'}), 500
 
+_last_tile_eviction = 0.0
+
+def _evict_tile_cache():
+    """タイルキャッシュが上限を超えていれば古いものから削除する（フォルダの走査は10秒に1回まで）"""
+    global _last_tile_eviction
+    now = time.time()
+    if now - _last_tile_eviction < 10:
+        return
+    _last_tile_eviction = now
+    _evict_cache(app.config['TILE_FOLDER'], app.config['TILE_CACHE_BYTES'])
+
+def _find_page_by_fingerprint(manifest, fingerprint):
+    """指紋が一致するページリストの項目を返す（なければ None）"""
+    for entry in manifest['pages']:
+        if _entry_fingerprint(manifest, entry) == fingerprint:
+            return entry
+    return None
+
+# --- 文字の検索 ---
+# 検索用の索引はページリストの内容（各ページの指紋の並び）ごとに作り、最近使ったものだけをメモリに残す
+_TEXT_INDEX_LIMIT = 8
+_text_indexes = collections.OrderedDict()
+_text_indexes_lock = threading.Lock()
+
+@_phase('parse')
+def _page_texts(manifest):
+    """ページリストの各ページの文字を返す
+
+    文字はページ内容の指紋ごとにキャッシュし、まだ抽出していないページだけを並列に抽出する。
+    """
+    folder = app.config['TEXT_FOLDER']
+    filenames = []
+    texts = []
+    tasks = []
+    missing = []
+    for page_index, entry in enumerate(manifest['pages']):
+        filename = manifest['sources'][entry['source']]['page_fingerprints'][entry['index']] + '.txt'
+        filenames.append(filename)
+        try:
+            with open(os.path.join(folder, filename), encoding='utf-8') as f:
+                texts.append(f.read())
+            # キャッシュヒット：最終利用時刻を更新する
+            os.utime(os.path.join(folder, filename))
+        except FileNotFoundError:
+            texts.append(None)
+            tasks.append((_source_path(entry['source']), entry['index']))
+            missing.append(page_index)
+
+    if tasks:
+        os.makedirs(folder, exist_ok=True)
+        extracted = rasterizer.extract_text(tasks, workers=app.config['RASTER_WORKERS'],
+                                            chunk_size=app.config['RASTER_CHUNK_SIZE'])
+        for page_index, text in zip(missing, extracted):
+            texts[page_index] = text
+            text_path = os.path.join(folder, filenames[page_index])
+            temp_path = f'{text_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(temp_path, text_path)
+            _count_written(text_path)
+        _evict_cache(folder, app.config['TEXT_CACHE_BYTES'], set(filenames))
+    return texts
+
+def _text_index(manifest):
+    """検索用の索引（各ページの小文字にした文字と、連続する2文字からページ番号への転置索引）"""
+    # パイプラインの途中ではページリストの版が変わらないため、版ではなく内容で見分ける
+    key = hashlib.sha1('|'.join(
+        manifest['sources'][entry['source']]['page_fingerprints'][entry['index']] for entry in manifest['pages']
+    ).encode('utf-8')).hexdigest()
+    with _text_indexes_lock:
+        if key in _text_indexes:
+            _text_indexes.move_to_end(key)
+            return _text_indexes[key]
+
+    texts = [text.casefold() for text in _page_texts(manifest)]
+    postings = {}
+    for page_index, text in enumerate(texts):
+        for bigram in {text[i:i + 2] for i in range(len(text) - 1)}:
+            postings.setdefault(bigram, []).append(page_index)
+    index = {'texts': texts, 'postings': postings}
+
+    with _text_indexes_lock:
+        _text_indexes[key] = index
+        while len(_text_indexes) > _TEXT_INDEX_LIMIT:
+            _text_indexes.popitem(last=False)
+    return index
+
+def _search_pages(manifest, query):
+    """語句を含むページの番号のリストを返す（大文字・小文字は区別しない）"""
+    index = _text_index(manifest)
+    needle = query.casefold()
+    candidates = range(len(index['texts']))
+    if len(needle) >= 2:
+        # 語句のすべての2文字の組を含むページに絞り込んでから確かめる
+        postings = [index['postings'].get(needle[i:i + 2], ()) for i in range(len(needle) - 1)]
+        candidates = sorted(set(min(postings, key=len)).intersection(*postings))
+    return [page_index for page_index in candidates if needle in index['texts'][page_index]]
+
+def _rotate_normalized_rect(rect, rotation):
+    """0〜1に正規化した矩形 (x0, y0, x1, y1) を、ページを時計回りに rotation 度回したときの位置にする"""
+    x0, y0, x1, y1 = rect
+    for _ in range(rotation // 90 % 4):
+        x0, y0, x1, y1 = 1 - y1, x0, 1 - y0, x1
+    return x0, y0, x1, y1
+
+def _search_hits(manifest, page_indices, query):
+    """各ページで語句が現れる位置を、表示されるページに対して0〜1に正規化した矩形のリストで返す"""
+    hits = {}
+    for page_index in page_indices:
+        entry = manifest['pages'][page_index]
+        with _open_document(_source_path(entry['source'])) as doc:
+            page = doc.load_page(entry['index'])
+            # 検索結果は回転前の座標なので、ページ本来の回転を反映してから正規化する
+            width, height = page.rect.width, page.rect.height
+            rects = [rect * page.rotation_matrix for rect in page.search_for(query)]
+        hits[page_index] = []
+        for rect in rects:
+            x0, y0, x1, y1 = _rotate_normalized_rect(
+                (rect.x0 / width, rect.y0 / height, rect.x1 / width, rect.y1 / height), entry['rotation'])
+            x0, y0, x1, y1 = max(0, x0), max(0, y0), min(1, x1), min(1, y1)
+            hits[page_index].append({'x': x0, 'y': y0, 'width': x1 - x0, 'height': y1 - y0})
+    return hits
+
+# --- 白紙・重複ページの検出 ---
+@_phase('rasterize')
+def _page_analysis(manifest):
+    """ページリストの各ページのインクの割合と知覚ハッシュを返す
+
+    解析結果はページ内容の指紋ごとにキャッシュし、まだ解析していないページだけを並列に解析する。
+    ページ本来の向きで解析するので、回転だけが違うページも同じ結果になる。
+    """
+    folder = app.config['ANALYSIS_FOLDER']
+    filenames = []
+    results = []
+    tasks = []
+    missing = []
+    for page_index, entry in enumerate(manifest['pages']):
+        filename = manifest['sources'][entry['source']]['page_fingerprints'][entry['index']] + '.json'
+        filenames.append(filename)
+        try:
+            with open(os.path.join(folder, filename), encoding='utf-8') as f:
+                results.append(json.load(f))
+            # キャッシュヒット：最終利用時刻を更新する
+            os.utime(os.path.join(folder, filename))
+        except (FileNotFoundError, ValueError):
+            results.append(None)
+            tasks.append((_source_path(entry['source']), entry['index']))
+            missing.append(page_index)
+
+    if tasks:
+        os.makedirs(folder, exist_ok=True)
+        analyzed = rasterizer.analyze_pages(tasks, app.config['ANALYSIS_DPI'], workers=app.config['RASTER_WORKERS'],
+                                            chunk_size=app.config['RASTER_CHUNK_SIZE'])
+        for page_index, result in zip(missing, analyzed):
+            results[page_index] = result
+            result_path = os.path.join(folder, filenames[page_index])
+            temp_path = f'{result_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(result, f)
+            os.replace(temp_path, result_path)
+            _count_written(result_path)
+        _evict_cache(folder, app.config['ANALYSIS_CACHE_BYTES'], set(filenames))
+    return results
+
+def _detect_pages(manifest, blank_coverage, max_distance):
+    """白紙ページの番号のリストと、重複ページのまとまり（ページ番号のリストのリスト）を返す
+
+    白紙ページどうしは重複として扱わない。
+    """
+    results = _page_analysis(manifest)
+    blank = [page_index for page_index, result in enumerate(results) if result['coverage'] < blank_coverage]
+    blank_set = set(blank)
+    hashes = {page_index: result['hash'] for page_index, result in enumerate(results) if page_index not in blank_set}
+    return results, blank, page_analysis.find_duplicates(hashes, max_distance)
+
 # --- ルート ---
 
 @app.route('/')
@@ -145,132 +1391,340 @@ def index():
 
 @app.route('/clear_all', methods=['POST'])
 def clear_all():
-    """アップロードされたPDFとサムネイルをすべて削除する"""
-    global original_filename, history_stack, history_index
-
-    original_filename = None
-    history_stack = []
-    history_index = -1
+    """アップロードされたPDFと履歴をすべて削除する（サムネイルキャッシュは容量上限で管理する）
 
-    for folder in [app.config['UPLOAD_FOLDER'], app.config['THUMBNAIL_FOLDER'], HISTORY_FOLDER]:
-        shutil.rmtree(folder, ignore_errors=True)
-        os.makedirs(folder)
+    keep_partial_uploads を指定すると、途中の分割アップロードは残す（ページを読み込み直しても再開できるように。
+    古いものは _remove_stale_uploads で削除される）。
+    """
+    data = request.get_json(silent=True) or {}
+    workspace = _workspace()
+    workspace.state.update({'original_filename': None, 'history_stack': [], 'history_index': -1})
+    workspace.save_state()
+
+    _documents.invalidate_folder(workspace.upload_folder)
+    shutil.rmtree(workspace.history_folder, ignore_errors=True)
+    os.makedirs(workspace.history_folder)
+    if data.get('keep_partial_uploads'):
+        _remove_stale_uploads()
+        for entry in os.scandir(workspace.upload_folder):
+            if entry.name == 'partial':
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+    else:
+        shutil.rmtree(workspace.upload_folder, ignore_errors=True)
+        os.makedirs(workspace.upload_folder)
     return jsonify({'message': 'すべてのページがクリアされました。'})
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    global original_filename
+    """PDFを受け取り、ページリストの末尾に追加する（複数ファイルを1回でまとめて受け付ける）
+
+    画面からは、どのファイルも分割アップロードの1チャンク以下の小さなファイルだけをこちらで送る。
+    """
+    workspace = _workspace()
 
     if 'pdfFile' not in request.files:
         return jsonify({'error': 'ファイルがありません'}), 400
-    file = request.files['pdfFile']
-    if file.filename == '':
+    files = request.files.getlist('pdfFile')
+    if any(file.filename == '' for file in files):
         return jsonify({'error': 'ファイルが選択されていません'}), 400
 
-    if not file.filename.lower().endswith('.pdf'):
+    if not all(file.filename.lower().endswith('.pdf') for file in files):
         return jsonify({'error': '無効なファイル形式です'}), 400
+    if len(files) > app.config['UPLOAD_BATCH_FILES']:
+        return jsonify({'error': f'一度にアップロードできるファイルは{app.config["UPLOAD_BATCH_FILES"]}個までです'}), 400
+    # 大きさの上限はファイルごとに確かめる（受け取ったファイルは一時ファイルにあるので、末尾の位置が大きさになる）
+    limit = app.config['UPLOAD_FILE_MAX_BYTES']
+    for file in files:
+        size = file.stream.seek(0, os.SEEK_END)
+        file.stream.seek(0)
+        if size > limit:
+            return jsonify({'error': f'{file.filename} が大きすぎます（1ファイル {limit // (1024 * 1024)}MB まで、'
+                                     'それより大きいPDFは /uploads で分割してアップロードしてください）'}), 413
+
+    new_files = []
+    try:
+        for i, file in enumerate(files):
+            new_file_path = os.path.join(workspace.upload_folder, f'temp_upload_{i}.pdf')
+            new_files.append((new_file_path, file.filename))
+            file.save(new_file_path)
+    except Exception as e:
+        for new_file_path, _ in new_files:
+            if os.path.exists(new_file_path):
+                os.remove(new_file_path)
+        return jsonify({'error': f'PDFのアップロード処理中にエラーが発生しました: {str(e)}'}), 500
+    return _add_uploaded_files(new_files)
 
-    existing_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
-    new_file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'temp_upload.pdf')
-    file.save(new_file_path)
-
+def _add_uploaded_files(new_files):
+    """受け取ったPDF（(一時ファイルのパス, 元のファイル名) のリスト）をページリストの末尾に追加し、サムネイルを返す"""
+    workspace = _workspace()
     try:
-        writer = pypdf.PdfWriter()
+        manifest = _load_manifest()
         message = ""
 
-        if os.path.exists(existing_pdf_path) and os.path.getsize(existing_pdf_path) > 0:
-            reader_existing = pypdf.PdfReader(existing_pdf_path)
-            for page in reader_existing.pages:
-                writer.add_page(page)
+        if manifest['pages']:
             message = "PDFが追加されました。"
         else:
             # 最初のアップロードの場合、ファイル名を記録
-            if original_filename is None:
+            if workspace.state['original_filename'] is None:
                 # .pdfを除去したベース名を保存
-                original_filename = file.filename.rsplit('.pdf', 1)[0] if file.filename.lower().endswith('.pdf') else file.filename
+                first_filename = new_files[0][1]
+                workspace.state['original_filename'] = first_filename.rsplit('.pdf', 1)[0] if first_filename.lower().endswith('.pdf') else first_filename
+                workspace.save_state()
             message = "PDFがアップロードされました。"
+        if len(new_files) > 1:
+            message = f"{len(new_files)}個のPDFファイルを追加しました。"
 
-        reader_new = pypdf.PdfReader(new_file_path)
-        for page in reader_new.pages:
-            writer.add_page(page)
-
-        # 一時ファイルに書き出し
-        temp_write_path = os.path.join(app.config['UPLOAD_FOLDER'], 'temp_write.pdf')
-        with open(temp_write_path, "wb") as f:
-            writer.write(f)
+        # 既存のPDFは書き換えず、新しいファイルのページをリストの末尾に追加する
+        for new_file_path, filename in new_files:
+            manifest['pages'].extend(_add_source(manifest, new_file_path, filename))
+        _save_manifest(manifest)
 
-        # アップロードされた一時ファイルを削除
-        os.remove(new_file_path)
-
-        # 元のファイルを置き換え
-        if os.path.exists(existing_pdf_path):
-            os.remove(existing_pdf_path)
-        os.rename(temp_write_path, existing_pdf_path)
-
-        # 履歴に保存
+        # 履歴に保存（まとめて1回の操作として扱う）
         _save_history()
 
-        # サムネイル生成とレスポンス
+        # サムネイル生成とレスポンス（新しいページの分だけ描画される）
         return _generate_thumbnails_and_response(message)
 
     except Exception as e:
         # エラー時は一時ファイルをクリーンアップ
-        if os.path.exists(new_file_path):
-            os.remove(new_file_path)
+        for new_file_path, _ in new_files:
+            if os.path.exists(new_file_path):
+                os.remove(new_file_path)
         return jsonify({'error': f'PDFのアップロード処理中にエラーが発生しました: {str(e)}'}), 500
 
+# --- 分割アップロード ---
+# 大きなPDFはチャンクに分けて送る。POST /uploads で始め、PUT /uploads/<id>/chunks/<番号> で各チャンクを
+# （並行して・順不同で）送り、POST /uploads/finalize でページリストに追加する。チャンクは受け取った時点で
+# 最終的なファイルの該当位置に書き込むので、すべて揃えばそのまま解析を始められる。
+# 受け取ったチャンクは received/<番号> の印で記録し、接続が切れても残りのチャンクだけを送り直せる。
+
+def _partial_upload_folder(upload_id):
+    return os.path.join(_workspace().upload_folder, 'partial', upload_id)
+
+def _load_partial_upload(upload_id):
+    """分割アップロードの情報を読み込む（見つからなければ None）"""
+    if not re.fullmatch(r'[0-9a-f]{16}', upload_id):
+        return None
+    try:
+        with open(os.path.join(_partial_upload_folder(upload_id), 'upload.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _received_chunks(upload):
+    """受け取り済みのチャンク番号のリスト"""
+    try:
+        names = os.listdir(os.path.join(_partial_upload_folder(upload['id']), 'received'))
+    except FileNotFoundError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+def _upload_status(upload):
+    received = _received_chunks(upload)
+    return {
+        'upload_id': upload['id'],
+        'filename': upload['filename'],
+        'size': upload['size'],
+        'chunk_size': upload['chunk_size'],
+        'chunk_count': upload['chunk_count'],
+        'received': received,
+        'complete': len(received) == upload['chunk_count']
+    }
+
+def _remove_stale_uploads():
+    """作業領域の中で、一定時間チャンクが届いていない分割アップロードを削除する"""
+    folder = os.path.join(_workspace().upload_folder, 'partial')
+    if not os.path.isdir(folder):
+        return
+    now = time.time()
+    for entry in os.scandir(folder):
+        if entry.is_dir() and now - entry.stat().st_mtime > app.config['WORKSPACE_TTL']:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+@app.route('/uploads', methods=['POST'])
+def start_upload():
+    """分割アップロードを始める
+
+    filename と size（バイト数）を受け取り、チャンクの大きさと数を返す。key（ファイル名・大きさ・更新日時など
+    クライアントがファイルを見分ける文字列）が同じで完了していないアップロードがあれば、それを受け取り済みの
+    チャンクとともに返すので、クライアントは残りのチャンクだけを送ればよい。
+    """
+    data = request.get_json(silent=True) or {}
+    filename = str(data.get('filename', ''))
+    key = str(data.get('key', ''))
+    try:
+        size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        size = 0
+    if not filename.lower().endswith('.pdf'):
+        return jsonify({'error': '無効なファイル形式です'}), 400
+    if size <= 0:
+        return jsonify({'error': 'ファイルの大きさが指定されていません'}), 400
+    if size > app.config['UPLOAD_MAX_BYTES']:
+        return jsonify({'error': f'ファイルが大きすぎます（上限 {app.config["UPLOAD_MAX_BYTES"] // (1024 * 1024)}MB）'}), 413
+
+    _remove_stale_uploads()
+    folder = os.path.join(_workspace().upload_folder, 'partial')
+    if key and os.path.isdir(folder):
+        for entry in os.scandir(folder):
+            upload = _load_partial_upload(entry.name)
+            if upload and upload['key'] == key and upload['filename'] == filename and upload['size'] == size:
+                return jsonify(_upload_status(upload))
+
+    chunk_size = app.config['UPLOAD_CHUNK_BYTES']
+    upload = {
+        'id': secrets.token_hex(8),
+        'filename': filename,
+        'key': key,
+        'size': size,
+        'chunk_size': chunk_size,
+        'chunk_count': (size + chunk_size - 1) // chunk_size,
+        'created_at': time.time()
+    }
+    upload_folder = _partial_upload_folder(upload['id'])
+    os.makedirs(os.path.join(upload_folder, 'received'))
+    # 最終的な大きさのファイルを先に作っておき、各チャンクをその位置に直接書き込む
+    with open(os.path.join(upload_folder, 'data.pdf'), 'wb') as f:
+        f.truncate(size)
+    _write_json(os.path.join(upload_folder, 'upload.json'), upload)
+    return jsonify(_upload_status(upload)), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """分割アップロードの受け取り済みのチャンクを返す"""
+    upload = _load_partial_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'アップロードが見つかりません'}), 404
+    return jsonify(_upload_status(upload))
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    """分割アップロードを取り消し、受け取ったチャンクを削除する"""
+    if _load_partial_upload(upload_id) is None:
+        return jsonify({'error': 'アップロードが見つかりません'}), 404
+    shutil.rmtree(_partial_upload_folder(upload_id), ignore_errors=True)
+    return jsonify({'message': 'アップロードを取り消しました'})
+
+@app.route('/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    """チャンクを1つ受け取り、ファイルの該当位置に書き込む
+
+    本文はチャンクのバイト列そのもので、X-Chunk-CRC32 ヘッダーにそのCRC-32（16進数8桁）を付ける。
+    一致しなければ 400 を返し、ファイルには書き込まず、受け取り済みとして記録しない（同じチャンクを送り直せばよい）。
+    """
+    upload = _load_partial_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'アップロードが見つかりません'}), 404
+    if not 0 <= index < upload['chunk_count']:
+        return jsonify({'error': f'無効なチャンク番号です: {index}'}), 400
+    checksum = request.headers.get('X-Chunk-CRC32', '').lower()
+    if not re.fullmatch(r'[0-9a-f]{8}', checksum):
+        return jsonify({'error': 'チャンクのチェックサム（X-Chunk-CRC32）が指定されていません'}), 400
+    offset = index * upload['chunk_size']
+    expected = min(upload['chunk_size'], upload['size'] - offset)
+
+    # メモリに溜めずに一時ファイルへ書き出し、大きさとチェックサムが一致してからファイルの該当位置に写す
+    # （送り直されたチャンクが壊れていても、受け取り済みの正しいバイト列を上書きしない）
+    upload_folder = _partial_upload_folder(upload_id)
+    temp_path = os.path.join(upload_folder, f'chunk_{index}.{os.getpid()}.{threading.get_ident()}.tmp')
+    crc = 0
+    length = 0
+    try:
+        with open(temp_path, 'wb') as f:
+            for block in iter(lambda: request.stream.read(1024 * 1024), b''):
+                length += len(block)
+                if length > expected:
+                    break
+                crc = zlib.crc32(block, crc)
+                f.write(block)
+        if length != expected:
+            return jsonify({'error': f'チャンクの大きさが一致しません（{expected}バイトのはずが{length}バイト）'}), 400
+        if f'{crc:08x}' != checksum:
+            return jsonify({'error': 'チャンクのチェックサムが一致しません'}), 400
+
+        # 書き込み中に中断されても組み立てに使われないよう、受け取り済みの印を外してから写す
+        marker_path = os.path.join(upload_folder, 'received', str(index))
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+        with open(temp_path, 'rb') as source, open(os.path.join(upload_folder, 'data.pdf'), 'r+b') as f:
+            f.seek(offset)
+            shutil.copyfileobj(source, f, 1024 * 1024)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    with open(marker_path, 'w') as f:
+        f.write(checksum)
+    _count_written(marker_path)
+    # チャンクが届いている間は、古いアップロードとして削除されないようにする
+    os.utime(upload_folder)
+    received_count = len(_received_chunks(upload))
+    return jsonify({'index': index, 'received_count': received_count, 'complete': received_count == upload['chunk_count']})
+
+@app.route('/uploads/finalize', methods=['POST'])
+def finalize_uploads():
+    """すべてのチャンクが揃った分割アップロード（upload_ids の順）をページリストの末尾に追加する
+
+    複数のファイルは /upload と同じく1回の操作として履歴に保存する。
+    """
+    data = request.get_json(silent=True) or {}
+    upload_ids = data.get('upload_ids') or []
+    if not upload_ids:
+        return jsonify({'error': 'アップロードが指定されていません'}), 400
+    uploads = []
+    for upload_id in upload_ids:
+        upload = _load_partial_upload(str(upload_id))
+        if upload is None:
+            return jsonify({'error': f'アップロードが見つかりません: {upload_id}'}), 404
+        missing = sorted(set(range(upload['chunk_count'])) - set(_received_chunks(upload)))
+        if missing:
+            return jsonify({'error': f'{upload["filename"]} のチャンクが揃っていません', 'upload_id': upload['id'], 'missing': missing}), 409
+        uploads.append(upload)
+
+    # 組み立て済みのファイルを取り出し、アップロードの記録は削除する
+    new_files = []
+    for upload in uploads:
+        new_file_path = os.path.join(_workspace().upload_folder, f'temp_upload_{upload["id"]}.pdf')
+        os.replace(os.path.join(_partial_upload_folder(upload['id']), 'data.pdf'), new_file_path)
+        shutil.rmtree(_partial_upload_folder(upload['id']), ignore_errors=True)
+        new_files.append((new_file_path, upload['filename']))
+    return _add_uploaded_files(new_files)
+
 @app.route('/split', methods=['POST'])
 def split_pdf():
-    original_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
-    if not os.path.exists(original_pdf_path):
+    return _run_operation(_split_pdf, request.get_json(silent=True) or {})
+
+def _split_pdf(data, progress):
+    manifest = _load_manifest()
+    if not manifest['pages']:
         return jsonify({'error': 'PDFファイルがアップロードされていません'}), 400
 
-    data = request.get_json(silent=True) or {}
     pages_to_split = data.get('pages_to_split')
 
     try:
-        doc = fitz.open(original_pdf_path)
-        new_doc = fitz.open()
-
         if pages_to_split is None:
-            target_pages = range(len(doc))
+            target_pages = range(len(manifest['pages']))
             message = "全ての横長ページを分割しました。"
         elif not pages_to_split:
             return jsonify({'message': '分割するページが選択されていません。'})
         else:
-            target_pages = set(pages_to_split)
-            message = f'{len(target_pages)}ページを選択して分割処理をしました。'
-
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            rect = page.rect
-            width, height = rect.width, rect.height
-            if page_num in target_pages and width > height:
-                left_half_rect = fitz.Rect(0, 0, width / 2, height)
-                right_half_rect = fitz.Rect(width / 2, 0, width, height)
-                new_page_left = new_doc.new_page(width=width / 2, height=height)
-                new_page_left.show_pdf_page(new_page_left.rect, doc, page_num, clip=left_half_rect)
-                new_page_right = new_doc.new_page(width=width / 2, height=height)
-                new_page_right.show_pdf_page(new_page_right.rect, doc, page_num, clip=right_half_rect)
-            else:
-                new_page = new_doc.new_page(width=width, height=height)
-                new_page.show_pdf_page(new_page.rect, doc, page_num)
+            target_pages = [i for i in set(pages_to_split) if 0 <= i < len(manifest['pages'])]
+            message = f'{len(set(pages_to_split))}ページを選択して分割処理をしました。'
 
-        temp_filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded_temp.pdf')
-        new_doc.save(temp_filepath, garbage=4, deflate=True, clean=True)
-        doc.close()
-        new_doc.close()
-        os.remove(original_pdf_path)
-        os.rename(temp_filepath, original_pdf_path)
+        # 対象の横長ページだけを複製・切り抜きし、他のページはそのまま残す（縦長のページは読み込まない）
+        infos = _page_info(manifest, [manifest['pages'][i] for i in target_pages])
+        target_pages = [i for i, info in zip(target_pages, infos) if info['orientation'] == 'landscape']
+        _derive_pages(manifest, dict.fromkeys(target_pages, pdf_engine.split_page), 'split.pdf', progress)
+        _save_manifest(manifest)
 
         # 操作後に履歴を保存
         _save_history()
 
-        output_filename = 'split.pdf'
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        shutil.copy(original_pdf_path, output_path)
-
-        return _generate_thumbnails_and_response(message, f'/download/{output_filename}')
+        return _generate_thumbnails_and_response(message)
 
     except Exception as e:
         return jsonify({'error': f'PDFの分割中にエラーが発生しました: {str(e)}'}), 500
@@ -281,8 +1735,7 @@ def delete_pages():
     if not data or 'pages_to_delete' not in data:
         return jsonify({'error': '削除するページが指定されていません'}), 400
     pages_to_delete = set([int(i) for i in data['pages_to_delete']])
-    reader = pypdf.PdfReader(os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf'))
-    new_order = [i for i in range(len(reader.pages)) if i not in pages_to_delete]
+    new_order = _page_order('delete', data, len(_load_manifest()['pages']))
     return _regenerate_pdf_and_thumbnails(new_order, f'{len(pages_to_delete)}ページを削除しました')
 
 @app.route('/rotate', methods=['POST'])
@@ -293,25 +1746,19 @@ def rotate_pages():
 
     pages_to_rotate = [int(i) for i in data['pages']]
     rotation = int(data['rotation'])
-    original_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
-    if not os.path.exists(original_pdf_path):
+    if rotation % 90 != 0:
+        return jsonify({'error': '回転角度は90度単位で指定してください'}), 400
+    manifest = _load_manifest()
+    if not manifest['pages']:
         return jsonify({'error': 'PDFファイルがアップロードされていません'}), 400
 
     try:
-        reader = pypdf.PdfReader(original_pdf_path)
-        writer = pypdf.PdfWriter()
-        for page_index in range(len(reader.pages)):
-            page = reader.pages[page_index]
-            if page_index in pages_to_rotate:
-                page.rotate(rotation)
-            writer.add_page(page)
-
-        temp_filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded_temp.pdf')
-        with open(temp_filepath, 'wb') as f:
-            writer.write(f)
-
-        os.remove(original_pdf_path)
-        os.rename(temp_filepath, original_pdf_path)
+        # PDFは書き換えず、ページリストの回転角度だけを更新する
+        for page_index in set(pages_to_rotate):
+            if 0 <= page_index < len(manifest['pages']):
+                entry = manifest['pages'][page_index]
+                entry['rotation'] = (entry['rotation'] + rotation) % 360
+        _save_manifest(manifest)
 
         # 操作後に履歴を保存
         _save_history()
@@ -323,339 +1770,429 @@ def rotate_pages():
 
 @app.route('/reorder', methods=['POST'])
 def reorder_pdf():
+    """指定した順序でPDFを書き出す
+
+    optimize（true または pdf_engine.OPTIMIZE_DEFAULTS の一部を上書きする辞書）を指定すると、書き出したPDFを
+    最適化し、最適化前後のバイト数と処理秒数を optimization として返す（/split_and_save・/split_to_files・
+    /convert_to_image_pdf も同じ）。
+    """
     data = request.get_json()
     if not data or 'order' not in data:
         return jsonify({'error': '順序データがありません'}), 400
     new_order = [int(i) for i in data['order']]
     custom_filename = data.get('filename', 'reordered')  # カスタムファイル名を取得（デフォルトは'reordered'）
-    original_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
     try:
-        reader = pypdf.PdfReader(original_pdf_path)
-        writer = pypdf.PdfWriter()
-        if len(new_order) != len(reader.pages):
+        options = pdf_engine.optimize_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        pages = _load_manifest()['pages']
+        if not pages:
+            return jsonify({'error': 'PDFファイルがアップロードされていません'}), 400
+        if len(new_order) != len(pages):
             return jsonify({'error': 'ページ数が一致しません'}), 400
-        for page_index in new_order:
-            writer.add_page(reader.pages[page_index])
+        # ここで初めてページリストからPDFを書き出す
+        writer = _build_pdf_writer([pages[page_index] for page_index in new_order])
         # .pdfがすでに含まれている場合は除去してから追加
         if custom_filename.lower().endswith('.pdf'):
             custom_filename = custom_filename[:-4]
         output_filename = f'{custom_filename}.pdf'
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        with open(output_path, 'wb') as f:
-            writer.write(f)
-        return jsonify({'download_url': f'/download/{output_filename}', 'filename': output_filename})
+        output_path = os.path.join(_workspace().output_folder, output_filename)
+        report = {}
+        _write_pdf(writer, output_path, options, report)
+        return jsonify({
+            'download_url': f'/download/{output_filename}',
+            'filename': output_filename,
+            'optimization': _optimization_summary(report)
+        })
     except Exception as e:
         return jsonify({'error': f'PDFの並べ替え中にエラーが発生しました: {str(e)}'}), 500
 
 @app.route('/swap_odd_even', methods=['POST'])
 def swap_odd_even():
-    reader = pypdf.PdfReader(os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf'))
-    page_count = len(reader.pages)
-    new_order = []
-    for i in range(0, page_count - 1, 2):
-        new_order.extend([i + 1, i])
-    if page_count % 2 != 0:
-        new_order.append(page_count - 1)
+    new_order = _page_order('swap_odd_even', {}, len(_load_manifest()['pages']))
     return _regenerate_pdf_and_thumbnails(new_order, "偶数・奇数ページを入れ替えました。")
 
 @app.route('/reverse_all', methods=['POST'])
 def reverse_all():
-    reader = pypdf.PdfReader(os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf'))
-    page_count = len(reader.pages)
-    new_order = list(range(page_count - 1, -1, -1))
+    new_order = _page_order('reverse_all', {}, len(_load_manifest()['pages']))
     return _regenerate_pdf_and_thumbnails(new_order, "全ページを逆順にしました。")
 
 @app.route('/apply_mask', methods=['POST'])
 def apply_mask():
-    """指定された領域を指定されたページ間隔とオフセットで黒塗りする"""
-    data = request.get_json()
-    if not data or 'mask' not in data:
+    """指定された領域を黒塗りする
+
+    masks に領域とページの選び方（'odd'・'even'・'1-3,5' のような範囲・ページ番号のリスト・interval と offset）の組を
+    複数指定でき、すべての領域を1回の処理で適用する。従来の mask・interval・offset と search も使える。
+    """
+    return _run_operation(_apply_mask, request.get_json(silent=True) or {})
+
+def _apply_mask(data, progress):
+    search = (data.get('search') or '').strip()
+    masks = data.get('masks') or []
+    if 'mask' not in data and not masks and not search:
         return jsonify({'error': 'マスク領域が指定されていません'}), 400
 
-    mask = data['mask']  # {x, y, width, height} - 正規化された座標 (0-1)
     interval = data.get('interval', 1)  # ページ間隔（デフォルト: 1）
     offset = data.get('offset', 1)  # オフセット（デフォルト: 1 = 1ページ目）
-    original_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
+    manifest = _load_manifest()
 
-    if not os.path.exists(original_pdf_path):
+    if not manifest['pages']:
         return jsonify({'error': 'PDFファイルがアップロードされていません'}), 400
 
     try:
-        doc = fitz.open(original_pdf_path)
-        new_doc = fitz.open()
-
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            rect = page.rect
-
-            # 新しいドキュメントにページをコピー
-            new_page = new_doc.new_page(width=rect.width, height=rect.height)
-            new_page.show_pdf_page(new_page.rect, doc, page_num)
-
-            # ページ間隔とオフセットに基づいてマスキングを適用するかチェック
-            # offset=1, interval=2: 1ページ目から2ページおき (0,2,4,6,...) → page_num % interval == 0
-            # offset=2, interval=2: 2ページ目から2ページおき (1,3,5,7,...) → page_num % interval == 1
-            # offset=3, interval=3: 3ページ目から3ページおき (2,5,8,11,...) → page_num % interval == 2
-            # つまり: (page_num + 1) が offset と同じ余りを interval で割ったとき一致
-            if (page_num + 1 - offset) % interval == 0 and page_num >= offset - 1:
-                # 正規化された座標を実際のページ座標に変換
-                mask_rect = fitz.Rect(
-                    rect.width * mask['x'],
-                    rect.height * mask['y'],
-                    rect.width * (mask['x'] + mask['width']),
-                    rect.height * (mask['y'] + mask['height'])
-                )
-
-                # 新しいページに黒い矩形を描画
-                shape = new_page.new_shape()
-                shape.draw_rect(mask_rect)
-                shape.finish(color=(0, 0, 0), fill=(0, 0, 0))  # 黒塗り
-                shape.commit()
-
-        temp_filepath = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded_temp.pdf')
-        new_doc.save(temp_filepath, garbage=4, deflate=True, clean=True)
-        doc.close()
-        new_doc.close()
+        edits = _mask_edits(manifest, data)
+        if search and not edits:
+            return jsonify({'error': f'「{search}」は見つかりませんでした'}), 404
+        if not edits:
+            return jsonify({'error': 'マスキングの対象になるページがありません'}), 400
 
-        os.remove(original_pdf_path)
-        os.rename(temp_filepath, original_pdf_path)
+        # 対象のページだけに黒塗りを描き足し、他のページはそのまま残す
+        _derive_pages(manifest, edits, 'masked.pdf', progress)
+        _save_manifest(manifest)
 
         # 操作後に履歴を保存
         _save_history()
 
         # メッセージを生成
-        if interval == 1 and offset == 1:
+        if search:
+            message = f'「{search}」が見つかった{len(edits)}ページにマスキングを適用しました。'
+        elif masks:
+            region_count = len(masks) + ('mask' in data)
+            message = f'{region_count}個の領域を{len(edits)}ページにマスキングしました。'
+        elif interval == 1 and offset == 1:
             message = '全ページにマスキングを適用しました。'
         else:
             message = f'{interval}ページ毎に{offset}ページ目にマスキングを適用しました。'
 
         return _generate_thumbnails_and_response(message)
 
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': f'マスキング処理中にエラーが発生しました: {str(e)}'}), 500
 
+class _ManifestPages:
+    """pdf_engine.apply_operation の対象にするページリスト（引数の解釈はバッチ処理のレシピと共通）
+
+    回転と並べ替えはページリストの項目だけを変え、分割・マスキングは対象のページだけを新しいソースとして書き出す。
+    """
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+
+    def __len__(self):
+        return len(self.manifest['pages'])
+
+    def rotate(self, page_indices, rotation):
+        for page_index in page_indices:
+            entry = self.manifest['pages'][page_index]
+            entry['rotation'] = (entry['rotation'] + rotation) % 360
+
+    def split(self, page_indices):
+        # 横長のページだけを複製・切り抜きする（縦長のページは読み込まない）
+        infos = _page_info(self.manifest, [self.manifest['pages'][i] for i in page_indices])
+        page_indices = [i for i, info in zip(page_indices, infos) if info['orientation'] == 'landscape']
+        _derive_pages(self.manifest, dict.fromkeys(page_indices, pdf_engine.split_page), 'split.pdf')
+
+    def mask(self, regions, search, redact):
+        _derive_pages(self.manifest, _region_edits(self.manifest, regions, search, redact), 'masked.pdf')
+
+    def select(self, new_order):
+        self.manifest['pages'] = [self.manifest['pages'][page_index] for page_index in new_order]
+
+@app.route('/pipeline', methods=['POST'])
+def pipeline():
+    """複数の操作を順番にまとめて実行し、保存・履歴・サムネイル生成を1回で済ませる
+
+    operations は [{"op": "rotate", "pages": [0], "rotation": 90}, {"op": "delete", "pages_to_delete": [3]}, ...]
+    の形式で、各操作の引数は個別のエンドポイントと同じ。
+    """
+    return _run_operation(_run_pipeline, request.get_json(silent=True) or {})
+
+def _run_pipeline(data, progress):
+    operations = data.get('operations')
+    if not operations:
+        return jsonify({'error': '操作が指定されていません'}), 400
+    for operation in operations:
+        if operation.get('op') not in pdf_engine.EDIT_OPERATIONS:
+            return jsonify({'error': f'不明な操作です: {operation.get("op")}'}), 400
+
+    manifest = _load_manifest()
+    if not manifest['pages']:
+        return jsonify({'error': 'PDFファイルがアップロードされていません'}), 400
+
+    # すべての操作をメモリ上のページリストに対して行い、最後に1回だけ保存する。
+    # 分割・マスキングは対象ページだけを新しいソースとして書き出す
+    try:
+        pages = _ManifestPages(manifest)
+        for step, operation in enumerate(operations):
+            progress(step, len(operations))
+            pdf_engine.apply_operation(pages, operation)
+        progress(len(operations), len(operations))
+
+        _save_manifest(manifest)
+
+        # まとめて1回の操作として履歴に保存
+        _save_history()
+
+        return _generate_thumbnails_and_response(f'{len(operations)}個の操作を実行しました')
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'操作の実行中にエラーが発生しました: {str(e)}'}), 500
+
 @app.route('/undo', methods=['POST'])
 def undo():
     """一つ前の状態に戻す"""
-    global history_index
-
     # history_index は現在の状態を指している
-    # 一つ前に戻すには history_index - 1 の状態を復元する
+    # 一つ前に戻すには現在の操作の逆差分を適用する
+    history_index = _workspace().state['history_index']
     if history_index < 1:
         return jsonify({'error': 'これ以上戻せません'}), 400
 
     try:
-        # 一つ前の履歴を取得
-        history_index -= 1
-        history_filename = history_stack[history_index]
-        history_path = os.path.join(HISTORY_FOLDER, history_filename)
-
-
-        if not os.path.exists(history_path):
-            return jsonify({'error': '履歴ファイルが見つかりません'}), 400
-
-        # PDFを復元
-        original_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
-        shutil.copy(history_path, original_pdf_path)
+        _move_history(history_index - 1)
 
+        # 変化しなかったページはキャッシュ済みのサムネイルがそのまま使われる
         return _generate_thumbnails_and_response('1つ前の状態に戻しました')
 
+    except FileNotFoundError:
+        return jsonify({'error': '履歴ファイルが見つかりません'}), 400
     except Exception as e:
         return jsonify({'error': f'元に戻す処理中にエラーが発生しました: {str(e)}'}), 500
 
 @app.route('/redo', methods=['POST'])
 def redo():
     """一つ先の状態に進む"""
-    global history_index
-
-    if history_index >= len(history_stack) - 1:
+    state = _workspace().state
+    history_index = state['history_index']
+    if history_index >= len(state['history_stack']) - 1:
         return jsonify({'error': 'これ以上進めません'}), 400
 
     try:
-        # 一つ先の履歴を取得
-        history_index += 1
-        history_filename = history_stack[history_index]
-        history_path = os.path.join(HISTORY_FOLDER, history_filename)
-
-        if not os.path.exists(history_path):
-            return jsonify({'error': '履歴ファイルが見つかりません'}), 400
-
-        # PDFを復元
-        original_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
-        shutil.copy(history_path, original_pdf_path)
+        _move_history(history_index + 1)
 
         return _generate_thumbnails_and_response('1つ先の状態に進みました')
 
+    except FileNotFoundError:
+        return jsonify({'error': '履歴ファイルが見つかりません'}), 400
     except Exception as e:
         return jsonify({'error': f'やり直す処理中にエラーが発生しました: {str(e)}'}), 500
 
 @app.route('/history_status', methods=['GET'])
 def history_status():
     """Undo/Redoが可能かどうかを返す"""
-    can_undo = history_index >= 1
-    can_redo = history_index < len(history_stack) - 1
+    state = _workspace().state
+    can_undo = state['history_index'] >= 1
+    can_redo = state['history_index'] < len(state['history_stack']) - 1
     return jsonify({'can_undo': can_undo, 'can_redo': can_redo})
 
 @app.route('/get_original_filename', methods=['GET'])
 def get_original_filename():
     """最初にアップロードされたファイル名を返す"""
-    return jsonify({'filename': original_filename or 'edited'})
+    return jsonify({'filename': _workspace().state['original_filename'] or 'edited'})
 
 @app.route('/split_to_files', methods=['POST'])
 def split_to_files():
-    """各ページを個別のPDFファイルとして保存し、ZIPでダウンロード"""
-    original_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
+    """各ページを個別のPDFファイルとして保存し、ZIPでダウンロード
 
-    if not os.path.exists(original_pdf_path):
+    stream が指定されていればZIPを作りながらそのままレスポンスとして返す。
+    """
+    data = request.get_json(silent=True) or {}
+    if data.get('stream'):
+        return _stream_split_to_files(data)
+    return _run_operation(_split_to_files, data)
+
+class _ZipChunkWriter:
+    """ZIPの出力を受け取り、書き込まれた分だけを取り出せるようにする（シークできない出力先として扱われる）"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def _iter_page_files(pages, convert_to_image, dpi, base_filename, encoding='png', quality=rasterizer.DEFAULT_QUALITY, stats=None,
+                     options=None, report=None):
+    """1ページずつPDFを作り、(ファイル名, PDFのバイト列) を返すジェネレーター
+
+    stats に辞書を渡すと、画像のエンコードにかかった秒数を encode_seconds に足し込む。
+    options（出力の最適化の指定）があれば各ページのPDFを最適化し、その結果を report に足し込む。
+    """
+    report = {} if report is None else report
+    if convert_to_image:
+        # ページを並列に画像としてレンダリングし、ページ順に受け取る
+        rendered = _render_pages(_render_tasks(pages), dpi, encoding, quality)
+        for page_index, (img_bytes, width, height, encode_seconds) in enumerate(rendered):
+            if stats is not None:
+                stats['encode_seconds'] = stats.get('encode_seconds', 0) + encode_seconds
+            with _phase('serialize'):
+                pdf_bytes = pdf_engine.image_page_bytes(img_bytes, width, height)
+            yield f'{base_filename}_{page_index + 1}.pdf', _optimize_output(pdf_bytes, options, report)
+    else:
+        for page_index, page in enumerate(pages):
+            pdf_buffer = io.BytesIO()
+            writer = _build_pdf_writer([page])
+            with _phase('serialize'):
+                writer.write(pdf_buffer)
+            yield f'{base_filename}_{page_index + 1}.pdf', _optimize_output(pdf_buffer.getvalue(), options, report)
+
+def _split_to_files(data, progress):
+    pages = _load_manifest()['pages']
+
+    if not pages:
         return jsonify({'error': 'PDFファイルがアップロードされていません'}), 400
 
-    data = request.get_json(silent=True) or {}
     convert_to_image = data.get('convert_to_image', False)
     dpi = data.get('dpi', 150)
+    try:
+        encoding, quality = pdf_engine.image_options(data)
+        options = pdf_engine.optimize_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     try:
         # ベースファイル名を取得
-        base_filename = original_filename or 'page'
+        base_filename = _workspace().state['original_filename'] or 'page'
+        page_count = len(pages)
 
-        # ZIPファイルをメモリ上に作成
-        zip_buffer = io.BytesIO()
+        # ZIPファイルに1ページずつ直接書き込む（メモリに載るのは常に1ページ分だけ）
+        zip_filename = f'{base_filename}_pages.zip'
+        zip_path = os.path.join(_workspace().output_folder, zip_filename)
+        temp_path = zip_path + '.tmp'
+        stats = {'encode_seconds': 0}
+        report = {}
+        try:
+            with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                page_files = _iter_page_files(pages, convert_to_image, dpi, base_filename, encoding, quality, stats,
+                                              options, report)
+                for page_index, (page_filename, pdf_bytes) in enumerate(page_files):
+                    progress(page_index, page_count)
+                    with _phase('serialize'):
+                        zip_file.writestr(page_filename, pdf_bytes)
+            _count_written(temp_path)
+            os.replace(temp_path, zip_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        progress(page_count, page_count)
 
         if convert_to_image:
-            # 画像PDFとして保存
-            doc = fitz.open(original_pdf_path)
-            page_count = len(doc)
-
-            if page_count == 0:
-                return jsonify({'error': 'PDFにページがありません'}), 400
-
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                for page_index in range(page_count):
-                    page = doc.load_page(page_index)
-
-                    # ページを画像としてレンダリング
-                    pix = page.get_pixmap(dpi=dpi)
-                    img_bytes = pix.tobytes("png")
-
-                    # 新しいPDFドキュメントを作成
-                    new_doc = fitz.open()
-                    rect = page.rect
-                    new_page = new_doc.new_page(width=rect.width, height=rect.height)
-                    img_rect = fitz.Rect(0, 0, rect.width, rect.height)
-                    new_page.insert_image(img_rect, stream=img_bytes)
-
-                    # PDFをメモリに書き込み
-                    pdf_buffer = io.BytesIO()
-                    new_doc.save(pdf_buffer, garbage=4, deflate=True, clean=True)
-                    pdf_buffer.seek(0)
-
-                    # ZIPファイルに追加
-                    page_filename = f'{base_filename}_{page_index + 1}.pdf'
-                    zip_file.writestr(page_filename, pdf_buffer.read())
-
-                    new_doc.close()
-
-            doc.close()
             message = f'{page_count}ページを画像PDFとして個別ファイルに分割しました（{dpi} DPI）'
-
         else:
-            # 通常のPDFとして保存
-            reader = pypdf.PdfReader(original_pdf_path)
-            page_count = len(reader.pages)
-
-            if page_count == 0:
-                return jsonify({'error': 'PDFにページがありません'}), 400
-
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                for page_index in range(page_count):
-                    # 各ページ用の新しいPDFを作成
-                    writer = pypdf.PdfWriter()
-                    writer.add_page(reader.pages[page_index])
-
-                    # PDFをメモリ上に書き込み
-                    pdf_buffer = io.BytesIO()
-                    writer.write(pdf_buffer)
-                    pdf_buffer.seek(0)
-
-                    # ZIPファイルに追加
-                    page_filename = f'{base_filename}_{page_index + 1}.pdf'
-                    zip_file.writestr(page_filename, pdf_buffer.read())
-
             message = f'{page_count}ページを個別のPDFファイルに分割しました'
 
-        # ZIPファイルを保存
-        zip_filename = f'{base_filename}_pages.zip'
-        zip_path = os.path.join(app.config['OUTPUT_FOLDER'], zip_filename)
-
-        with open(zip_path, 'wb') as f:
-            f.write(zip_buffer.getvalue())
-
         return jsonify({
             'message': message,
             'download_url': f'/download/{zip_filename}',
             'filename': zip_filename,
-            'page_count': page_count
+            'page_count': page_count,
+            'encoding': encoding if convert_to_image else None,
+            'encode_seconds': round(stats['encode_seconds'], 3),
+            'output_size': os.path.getsize(zip_path),
+            'optimization': _optimization_summary(report)
         })
 
     except Exception as e:
         return jsonify({'error': f'ページ分割中にエラーが発生しました: {str(e)}'}), 500
 
-@app.route('/convert_to_image_pdf', methods=['POST'])
-def convert_to_image_pdf():
-    """PDFを画像ベースのPDFに変換（フォント問題を回避）"""
-    original_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
+def _stream_split_to_files(data):
+    """ZIPをページごとに作りながらレスポンスとして送る"""
+    pages = _load_manifest()['pages']
 
-    if not os.path.exists(original_pdf_path):
+    if not pages:
         return jsonify({'error': 'PDFファイルがアップロードされていません'}), 400
 
-    data = request.get_json(silent=True) or {}
-    dpi = data.get('dpi', 150)  # デフォルトは150 DPI
-    custom_filename = data.get('filename', original_filename or 'image_pdf')
-
+    convert_to_image = data.get('convert_to_image', False)
+    dpi = data.get('dpi', 150)
     try:
-        # 元のPDFを開く
-        doc = fitz.open(original_pdf_path)
-        page_count = len(doc)
+        encoding, quality = pdf_engine.image_options(data)
+        options = pdf_engine.optimize_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    base_filename = _workspace().state['original_filename'] or 'page'
+    zip_filename = f'{base_filename}_pages.zip'
+
+    def generate():
+        writer = _ZipChunkWriter()
+        with zipfile.ZipFile(writer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            page_files = _iter_page_files(pages, convert_to_image, dpi, base_filename, encoding, quality, options=options)
+            for page_filename, pdf_bytes in page_files:
+                zip_file.writestr(page_filename, pdf_bytes)
+                yield writer.take()
+        # 末尾の目次を送る
+        yield writer.take()
+
+    # 送信が終わるまでリクエストを保持し、作業領域のロックを外さないようにする
+    return Response(stream_with_context(generate()), mimetype='application/zip', headers={
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(zip_filename)}"
+    })
 
-        if page_count == 0:
-            return jsonify({'error': 'PDFにページがありません'}), 400
-
-        # 新しいPDFドキュメントを作成
-        new_doc = fitz.open()
+@app.route('/convert_to_image_pdf', methods=['POST'])
+def convert_to_image_pdf():
+    """PDFを画像ベースのPDFに変換（フォント問題を回避）"""
+    return _run_operation(_convert_to_image_pdf, request.get_json(silent=True) or {})
 
-        for page_num in range(page_count):
-            page = doc.load_page(page_num)
+def _convert_to_image_pdf(data, progress):
+    pages = _load_manifest()['pages']
 
-            # ページを指定されたDPIで画像としてレンダリング
-            pix = page.get_pixmap(dpi=dpi)
+    if not pages:
+        return jsonify({'error': 'PDFファイルがアップロードされていません'}), 400
 
-            # 画像をPNGバイトとして取得
-            img_bytes = pix.tobytes("png")
+    dpi = data.get('dpi', 150)  # デフォルトは150 DPI
+    custom_filename = data.get('filename', _workspace().state['original_filename'] or 'image_pdf')
+    try:
+        encoding, quality = pdf_engine.image_options(data)
+        options = pdf_engine.optimize_options(data)  # 他の書き出しと同じ optimize の指定
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-            # 新しいPDFページを作成（元のページサイズと同じ）
-            rect = page.rect
-            new_page = new_doc.new_page(width=rect.width, height=rect.height)
+    try:
+        page_count = len(pages)
 
-            # 画像を新しいページに挿入
-            img_rect = fitz.Rect(0, 0, rect.width, rect.height)
-            new_page.insert_image(img_rect, stream=img_bytes)
+        # ページを並列に画像としてレンダリングし、ページ順に元のページサイズと同じ新しいページとして追加
+        rendered = _render_pages(_render_tasks(pages), dpi, encoding, quality)
+        new_doc, encode_seconds = pdf_engine.image_document(rendered, page_count, progress)
 
         # 出力ファイル名を準備
         if custom_filename.lower().endswith('.pdf'):
             custom_filename = custom_filename[:-4]
         output_filename = f'{custom_filename}_image.pdf'
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-
-        # 新しいPDFを保存
-        new_doc.save(output_path, garbage=4, deflate=True, clean=True)
+        output_path = os.path.join(_workspace().output_folder, output_filename)
 
-        doc.close()
+        # 新しいPDFを保存（最適化する場合は書き出したバイト列を最適化してから保存）
+        report = {}
+        with _phase('serialize'):
+            if options is None:
+                new_doc.save(output_path, garbage=4, deflate=True, clean=True)
+            else:
+                pdf_bytes = new_doc.tobytes(garbage=4, deflate=True, clean=True)
         new_doc.close()
+        if options is not None:
+            with open(output_path, 'wb') as f:
+                f.write(_optimize_output(pdf_bytes, options, report))
+        _count_written(output_path)
 
         return jsonify({
             'message': f'{page_count}ページを画像PDFに変換しました（{dpi} DPI）',
             'download_url': f'/download/{output_filename}',
             'filename': output_filename,
-            'page_count': page_count
+            'page_count': page_count,
+            'encoding': encoding,
+            'encode_seconds': round(encode_seconds, 3),
+            'output_size': os.path.getsize(output_path),
+            'optimization': _optimization_summary(report)
         })
 
     except Exception as e:
@@ -664,10 +2201,8 @@ def convert_to_image_pdf():
 @app.route('/split_and_save', methods=['POST'])
 def split_and_save():
     """分割線で区切られた各パートに名前を付けて保存"""
-    global original_filename
-
-    original_pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], 'uploaded.pdf')
-    if not os.path.exists(original_pdf_path):
+    pages = _load_manifest()['pages']
+    if not pages:
         return jsonify({'error': 'PDFファイルがアップロードされていません'}), 400
 
     data = request.get_json()
@@ -675,10 +2210,12 @@ def split_and_save():
         return jsonify({'error': 'パート情報が指定されていません'}), 400
 
     parts = data['parts']  # [{'filename': 'xxx', 'save': True, 'start': 0, 'end': 3}, ...]
-
     try:
-        reader = pypdf.PdfReader(original_pdf_path)
+        options = pdf_engine.optimize_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
+    try:
         # 保存するパートをフィルタリング
         parts_to_save = [p for p in parts if p.get('save', True)]
 
@@ -687,6 +2224,7 @@ def split_and_save():
 
         # 各パートのPDFファイルを個別に保存
         download_urls = []
+        report = {}
 
         for part in parts_to_save:
             filename = part.get('filename', '').strip()
@@ -697,19 +2235,15 @@ def split_and_save():
             end_page = int(part['end'])
 
             # パートのPDFを作成
-            writer = pypdf.PdfWriter()
-            for page_index in range(start_page, end_page):
-                if page_index < len(reader.pages):
-                    writer.add_page(reader.pages[page_index])
+            writer = _build_pdf_writer(pages[start_page:end_page])
 
             # .pdfがない場合は追加
             if not filename.lower().endswith('.pdf'):
                 filename += '.pdf'
 
             # PDFファイルを保存
-            output_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-            with open(output_path, 'wb') as f:
-                writer.write(f)
+            output_path = os.path.join(_workspace().output_folder, filename)
+            _write_pdf(writer, output_path, options, report)
 
             download_urls.append({
                 'url': f'/download/{filename}',
@@ -718,19 +2252,229 @@ def split_and_save():
 
         return jsonify({
             'message': f'{len(parts_to_save)}個のファイルに分割しました',
-            'files': download_urls
+            'files': download_urls,
+            'optimization': _optimization_summary(report)
         })
 
     except Exception as e:
         return jsonify({'error': f'ファイル分割中にエラーが発生しました: {str(e)}'}), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """ジョブの状態（処理済みページ数・総ページ数・残り時間の見込み・結果）を返す"""
+    job = _load_job(_workspace(), job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+
+    job['eta_seconds'] = None
+    if job['status'] == 'running' and job.get('pages_done') and job.get('pages_total'):
+        elapsed = time.time() - job['started_at']
+        job['eta_seconds'] = round(elapsed / job['pages_done'] * (job['pages_total'] - job['pages_done']), 1)
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """ジョブのキャンセルを要求する"""
+    workspace = _workspace()
+    job = _load_job(workspace, job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    if job['status'] in ('done', 'failed', 'cancelled'):
+        return jsonify({'error': 'ジョブはすでに終了しています'}), 400
+    # 実行中のジョブは次の進捗報告のときにこの印を見て中断する
+    with open(_job_path(workspace, job_id) + '.cancel', 'w'):
+        pass
+    return jsonify({'message': 'キャンセルを要求しました'})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """処理時間・処理量の集計値をPrometheusのテキスト形式で返す"""
+    return Response(_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/pages', methods=['GET'])
+def page_window():
+    """ページリストの指定範囲のサムネイルのURL・ページの大きさ・アトラス上の位置を返す"""
+    manifest = _load_manifest()
+    page_count = len(manifest['pages'])
+    try:
+        start = int(request.args.get('start', 0))
+        count = int(request.args.get('count', app.config['PAGE_WINDOW_LIMIT']))
+    except ValueError:
+        return jsonify({'error': '範囲の指定が正しくありません'}), 400
+    if start < 0 or count < 1:
+        return jsonify({'error': '範囲の指定が正しくありません'}), 400
+    end = min(page_count, start + min(count, app.config['PAGE_WINDOW_LIMIT']))
+    start = min(start, end)
+    try:
+        os.makedirs(app.config['THUMBNAIL_FOLDER'], exist_ok=True)
+        window = _page_window(manifest, start, end)
+    except Exception as e:
+        return jsonify({'error': f'サムネイル生成中にエラーが発生しました: {str(e)}'}), 500
+    window['page_count'] = page_count
+    return jsonify(window)
+
+@app.route('/pages/metadata', methods=['GET'])
+def page_metadata():
+    """ページリストの指定範囲の各ページの大きさ・回転・向き・文字の有無・画像の数・コンテンツストリームの大きさを返す
+
+    orientation（landscape/portrait）・text・images（0/1）を指定すると、条件に合うページだけを返す。
+    """
+    manifest = _load_manifest()
+    page_count = len(manifest['pages'])
+    try:
+        start = int(request.args.get('start', 0))
+        count = int(request.args.get('count', page_count))
+        filters = {key: int(request.args[key]) for key in ('text', 'images') if key in request.args}
+    except ValueError:
+        return jsonify({'error': '範囲の指定が正しくありません'}), 400
+    if start < 0 or count < 0:
+        return jsonify({'error': '範囲の指定が正しくありません'}), 400
+    orientation = request.args.get('orientation')
+    if orientation not in (None, 'landscape', 'portrait'):
+        return jsonify({'error': f'無効な向きです: {orientation}'}), 400
+    end = min(page_count, start + count)
+    start = min(start, end)
+
+    pages = []
+    for index, info in enumerate(_page_info(manifest, manifest['pages'][start:end]), start):
+        if orientation and info['orientation'] != orientation:
+            continue
+        if 'text' in filters and info['text'] != bool(filters['text']):
+            continue
+        if 'images' in filters and bool(info['images']) != bool(filters['images']):
+            continue
+        pages.append(dict(info, index=index))
+    return jsonify({'start': start, 'pages': pages, 'page_count': page_count})
+
+@app.route('/search', methods=['GET'])
+def search_text():
+    """ページの文字を検索し、一致したページ番号と一致箇所の矩形（表示されるページに対して0〜1に正規化）を返す
+
+    返したページ番号は /delete・/rotate にそのまま渡せる。一致箇所をすべて黒塗りするには /apply_mask に search を渡す。
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '検索する語句が指定されていません'}), 400
+    manifest = _load_manifest()
+    try:
+        page_indices = _search_pages(manifest, query)
+        hits = _search_hits(manifest, page_indices, query)
+    except Exception as e:
+        return jsonify({'error': f'検索中にエラーが発生しました: {str(e)}'}), 500
+    return jsonify({
+        'query': query,
+        'pages': [{'index': page_index, 'rects': hits[page_index]} for page_index in page_indices],
+        'hit_count': sum(len(rects) for rects in hits.values()),
+        'page_count': len(manifest['pages'])
+    })
+
+@app.route('/pages/analysis', methods=['GET'])
+def analyze_pages():
+    """白紙ページと、内容がほぼ同じ重複ページのまとまりを検出する
+
+    blank_coverage（インクの割合がこれ未満なら白紙）と max_distance（知覚ハッシュの違うビット数がこれ以下なら重複、
+    0〜16）で判定基準を変えられる。返したページ番号は /delete にそのまま渡せる。
+    """
+    try:
+        blank_coverage = float(request.args.get('blank_coverage', page_analysis.BLANK_COVERAGE))
+        max_distance = int(request.args.get('max_distance', page_analysis.DUPLICATE_DISTANCE))
+    except ValueError:
+        return jsonify({'error': '判定基準の指定が正しくありません'}), 400
+    if not 0 <= blank_coverage <= 1 or not 0 <= max_distance <= 16:
+        return jsonify({'error': '判定基準の指定が範囲外です'}), 400
+    manifest = _load_manifest()
+    try:
+        results, blank, duplicates = _detect_pages(manifest, blank_coverage, max_distance)
+    except Exception as e:
+        return jsonify({'error': f'ページの解析中にエラーが発生しました: {str(e)}'}), 500
+    return jsonify({
+        'blank': blank,
+        'duplicates': duplicates,
+        'pages': [{'index': page_index, 'coverage': round(result['coverage'], 5), 'hash': result['hash']}
+                  for page_index, result in enumerate(results)],
+        'page_count': len(manifest['pages'])
+    })
+
+@app.route('/pages/<int:index>/tiles', methods=['GET'])
+def page_tiles(index):
+    """ページを拡大表示するためのタイルのURLの形式と、ページの大きさ（ポイント）を返す"""
+    manifest = _load_manifest()
+    if index >= len(manifest['pages']):
+        return jsonify({'error': 'ページが見つかりません'}), 404
+    entry = manifest['pages'][index]
+    info = _page_info(manifest, [entry])[0]
+    fingerprint = _entry_fingerprint(manifest, entry)
+    return jsonify({
+        'fingerprint': fingerprint,
+        'width': info['width'],
+        'height': info['height'],
+        'tile_size': app.config['TILE_SIZE'],
+        'max_zoom': app.config['TILE_MAX_ZOOM'],
+        'url': f'/tiles/{fingerprint}/{{zoom}}/{{x}}/{{y}}.png'
+    })
+
+@app.route('/tiles/<fingerprint>/<int:zoom>/<int:x>/<int:y>.png')
+def serve_tile(fingerprint, zoom, x, y):
+    """ページの一部分を 2**zoom 倍でレンダリングしたタイルを返す
+
+    タイルはページの指紋・ズーム段階・位置ごとにキャッシュし、URLも内容ごとに異なるので無期限にキャッシュさせる。
+    """
+    if not re.fullmatch(r'[0-9a-f]{40}', fingerprint) or zoom > app.config['TILE_MAX_ZOOM']:
+        return jsonify({'error': 'タイルが見つかりません'}), 404
+    tile_filename = f'{fingerprint}_{zoom}_{x}_{y}.png'
+    tile_path = os.path.join(app.config['TILE_FOLDER'], tile_filename)
+    if os.path.exists(tile_path):
+        # キャッシュヒット：最終利用時刻を更新する
+        os.utime(tile_path)
+    else:
+        entry = _find_page_by_fingerprint(_load_manifest(), fingerprint)
+        if entry is None:
+            return jsonify({'error': 'タイルが見つかりません'}), 404
+        scale = 2 ** zoom
+        span = app.config['TILE_SIZE'] / scale
+        clip = (x * span, y * span, (x + 1) * span, (y + 1) * span)
+        os.makedirs(app.config['TILE_FOLDER'], exist_ok=True)
+        with _phase('rasterize'), _open_document(_source_path(entry['source'])) as doc:
+            rendered = rasterizer.render_tile(doc, entry['index'], entry['rotation'], scale, clip, tile_path)
+        if not rendered:
+            return jsonify({'error': 'タイルが見つかりません'}), 404
+        _count_written(tile_path)
+        _evict_tile_cache()
+    response = send_from_directory(os.path.abspath(app.config['TILE_FOLDER']), tile_filename, mimetype='image/png',
+                                   etag=tile_filename[:-len('.png')], max_age=app.config['THUMBNAIL_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/thumbnails/<path:filename>')
 def serve_thumbnail(filename):
-    return send_from_directory(app.config['THUMBNAIL_FOLDER'], filename)
+    """サムネイルとアトラスを返す
+
+    ファイル名は内容の指紋で、内容が変われば別のURLになるため、
+    Cache-Control: immutable で無期限にキャッシュさせ、指紋をETagとして304に対応する。
+    gzip圧縮版が保存されていて、ブラウザが対応していればそちらを返す。
+    """
+    fingerprint = filename.rsplit('.', 1)[0]
+    folder = os.path.abspath(app.config['THUMBNAIL_FOLDER'])
+    variant = filename
+    etag = fingerprint
+    if 'gzip' in request.accept_encodings and os.path.isfile(os.path.join(folder, filename + '.gz')):
+        variant = filename + '.gz'
+        etag = fingerprint + '-gzip'
+    # 圧縮版でも元の画像の形式として返す
+    response = send_from_directory(folder, variant,
+                                   mimetype=mimetypes.guess_type(filename)[0], etag=etag,
+                                   max_age=app.config['THUMBNAIL_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    if variant != filename and response.status_code == 200:
+        response.content_encoding = 'gzip'
+    return response
 
 @app.route('/download/<path:filename>')
 def serve_output(filename):
-    return send_from_directory(app.config['OUTPUT_FOLDER'], filename, as_attachment=True)
+    return send_from_directory(os.path.abspath(_workspace().output_folder), filename, as_attachment=True)
 
 if __name__ == '__main__':
     import os
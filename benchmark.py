@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+PDF編集Webアプリケーションのベンチマーク
+(c) 2025 IshiyamaYoshihiro
+License: MIT License
+
+テキスト・図形・スキャン画像・横長・縦長のページを混ぜた合成PDFを作り、
+Flaskのテストクライアントで各エンドポイントを順に呼び出して
+処理時間・最大メモリ使用量・ディスクへの書き込み量・出力サイズをJSONで記録する。
+
+使い方:
+    python benchmark.py                          # 10, 100, 1000, 5000ページで計測
+    python benchmark.py --sizes 10 100 -o result.json
+    python benchmark.py --compare before.json    # 以前の結果と比較して表示
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import fitz  # PyMuPDF
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_SIZES = [10, 100, 1000, 5000]
+# 画像化するエンドポイントの解像度（大きい文書でも現実的な時間で終わるよう低めにする）
+DEFAULT_DPI = 72
+# スキャン画像ページのピクセルサイズ
+SCAN_SIZE = (420, 595)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# --- 合成PDF ---
+def _scanned_image(page_number):
+    """スキャンしたページを模したグレースケールJPEGを作る（ページごとに内容を変える）"""
+    width, height = SCAN_SIZE
+    pix = fitz.Pixmap(fitz.csGRAY, fitz.IRect(0, 0, width, height), False)
+    pix.clear_with(235)
+    # 文字の行のような濃い帯を、ページ番号によって位置と長さを変えて並べる
+    for line in range(40):
+        y = 30 + line * 13
+        length = 120 + (page_number * 37 + line * 53) % (width - 160)
+        pix.set_rect(fitz.IRect(40, y, 40 + length, y + 6), (40,))
+    return pix.tobytes('jpg', jpg_quality=75)
+
+def make_corpus(path, page_count):
+    """5種類のページ（テキスト・図形・スキャン画像・横長・縦長）を順に繰り返す合成PDFを作る"""
+    doc = fitz.open()
+    for page_number in range(page_count):
+        kind = page_number % 5
+        if kind == 3:
+            page = doc.new_page(width=842, height=595)  # 横長（見開き）
+        else:
+            page = doc.new_page(width=595, height=842)  # 縦長
+
+        if kind in (0, 3, 4):
+            # テキスト
+            text = f'Page {page_number + 1}\n' + 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 20
+            page.insert_textbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50), text, fontsize=11)
+        if kind in (1, 3):
+            # 図形
+            for i in range(30):
+                rect = fitz.Rect(60 + i * 12, 300 + i * 8, 200 + i * 12, 360 + i * 8)
+                page.draw_rect(rect, color=(i / 30, 0, 1 - i / 30), fill=(1, i / 30, 0), width=1)
+                page.draw_line(fitz.Point(50, 700 - i * 10), fitz.Point(545, 720 - i * 5), color=(0, 0, 0))
+        if kind == 2:
+            # スキャン画像
+            page.insert_image(page.rect, stream=_scanned_image(page_number))
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+
+# --- 計測 ---
+def _current_rss():
+    """現在の常駐メモリ量（バイト）。取得できない環境では None"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _bytes_written():
+    """このプロセスがこれまでに書き込んだバイト数。取得できない環境では None"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def _folder_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class _PeakRssSampler:
+    """計測中の常駐メモリ量の最大値を別スレッドで記録する"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = _current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = _current_rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        rss = _current_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+def _measure(client, workdir, method, url, **kwargs):
+    """1回のリクエストを実行し、計測結果とレスポンスのJSONを返す"""
+    written_before = _bytes_written()
+    disk_before = _folder_size(workdir)
+    with _PeakRssSampler() as sampler:
+        started = time.perf_counter()
+        response = getattr(client, method)(url, **kwargs)
+        wall_seconds = time.perf_counter() - started
+    written_after = _bytes_written()
+    data = response.get_json(silent=True) or {}
+
+    # ダウンロードできるファイルがあれば、その合計サイズを出力サイズとする
+    download_urls = [data['download_url']] if data.get('download_url') else []
+    download_urls += [item['url'] for item in data.get('files', [])]
+    output_bytes = None
+    if download_urls:
+        output_bytes = sum(len(client.get(download_url).data) for download_url in download_urls)
+
+    return {
+        'route': url,
+        'status': response.status_code,
+        'wall_seconds': round(wall_seconds, 4),
+        'peak_rss_bytes': sampler.peak,
+        'bytes_written': None if written_before is None else written_after - written_before,
+        'disk_growth_bytes': _folder_size(workdir) - disk_before,
+        'output_bytes': output_bytes,
+        'error': data.get('error')
+    }, data
+
+
+# --- シナリオ ---
+def run_scenario(app_module, workdir, pdf_path, page_count, dpi):
+    """1つの文書サイズについて全エンドポイントを順に呼び出す"""
+    client = app_module.app.test_client()
+    client.get('/')
+    results = []
+
+    def run(method, url, case=None, **kwargs):
+        result, data = _measure(client, workdir, method, url, **kwargs)
+        # 同じエンドポイントを条件を変えて呼ぶ場合は case で区別する
+        result['case'] = case or url
+        result['pages'] = page_count
+        results.append(result)
+        print(f"{page_count:>6}ページ {result['case']:<28} {result['status']} {result['wall_seconds']:>9.3f}秒", flush=True)
+        return data
+
+    with open(pdf_path, 'rb') as f:
+        run('post', '/upload', data={'pdfFile': (f, os.path.basename(pdf_path))})
+    data = run('post', '/split', json={})
+    data = run('post', '/delete', json={'pages_to_delete': list(range(0, data['page_count'], 10))})
+    page_total = data['page_count']
+    run('post', '/rotate', json={'pages': list(range(0, page_total, 2)), 'rotation': 90})
+    run('post', '/reorder', json={'order': list(range(page_total - 1, -1, -1)), 'filename': 'reordered'})
+    run('post', '/apply_mask', json={'mask': {'x': 0.1, 'y': 0.1, 'width': 0.3, 'height': 0.1}, 'interval': 2, 'offset': 1})
+    run('post', '/undo')
+    run('post', '/redo')
+    run('post', '/split_to_files', json={})
+    run('post', '/split_to_files', case='/split_to_files (image)', json={'convert_to_image': True, 'dpi': dpi})
+    run('post', '/convert_to_image_pdf', json={'dpi': dpi})
+    half = page_total // 2
+    run('post', '/split_and_save', json={'parts': [
+        {'filename': 'part1', 'start': 0, 'end': half},
+        {'filename': 'part2', 'start': half, 'end': page_total}
+    ]})
+    run('post', '/clear_all')
+    return results
+
+
+# --- 比較 ---
+def compare(baseline_path, results):
+    """以前の結果と比べ、処理時間と最大メモリ使用量の変化を表示する"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {(r['pages'], r['case']): r for r in json.load(f)['results']}
+    print(f"\n{'ページ数':>8} {'エンドポイント':<28} {'時間':>10} {'変化':>8} {'メモリ変化':>10}")
+    seen = set()
+    for result in results:
+        key = (result['pages'], result['case'])
+        if key in seen or key not in baseline:
+            continue
+        seen.add(key)
+        before = baseline[key]
+        time_ratio = result['wall_seconds'] / before['wall_seconds'] if before['wall_seconds'] else float('nan')
+        rss_ratio = (result['peak_rss_bytes'] / before['peak_rss_bytes']
+                     if result['peak_rss_bytes'] and before['peak_rss_bytes'] else float('nan'))
+        print(f"{result['pages']:>8} {result['case']:<28} {result['wall_seconds']:>9.3f}s {time_ratio:>7.2f}x {rss_ratio:>9.2f}x")
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='PDF編集Webアプリケーションのベンチマーク')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='計測する文書のページ数')
+    parser.add_argument('--dpi', type=int, default=DEFAULT_DPI, help='画像化するエンドポイントの解像度')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='結果を書き出すJSONファイル')
+    parser.add_argument('--compare', help='比較する以前の結果のJSONファイル')
+    parser.add_argument('--keep', action='store_true', help='作業フォルダを削除せずに残す')
+    args = parser.parse_args()
+    output_path = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+
+    # アプリは作業フォルダを相対パスで作るため、一時フォルダに移動してから読み込む
+    workdir = tempfile.mkdtemp(prefix='pdf_benchmark_')
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import app as app_module
+    app_module.app.config['MAX_CONTENT_LENGTH'] = None
+
+    results = []
+    try:
+        for page_count in args.sizes:
+            pdf_path = os.path.join(workdir, f'corpus_{page_count}.pdf')
+            started = time.perf_counter()
+            make_corpus(pdf_path, page_count)
+            print(f'{page_count}ページの合成PDFを作成しました（{time.perf_counter() - started:.1f}秒, {os.path.getsize(pdf_path)}バイト）', flush=True)
+            # サムネイルのキャッシュが効かない状態から計測する
+            shutil.rmtree(app_module.app.config['THUMBNAIL_FOLDER'], ignore_errors=True)
+            results.extend(run_scenario(app_module, workdir, pdf_path, page_count, args.dpi))
+            os.remove(pdf_path)
+    finally:
+        os.chdir(REPO_DIR)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    children_peak = None
+    if resource is not None:
+        # Linuxではキロバイト、macOSではバイト単位
+        scale = 1 if sys.platform == 'darwin' else 1024
+        children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+    report = {
+        'revision': _git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'pymupdf': fitz.VersionBind,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {
+            'sizes': args.sizes,
+            'dpi': args.dpi,
+            'raster_workers': app_module.app.config['RASTER_WORKERS'],
+            'raster_chunk_size': app_module.app.config['RASTER_CHUNK_SIZE']
+        },
+        'children_peak_rss_bytes': children_peak,
+        'results': results
+    }
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'結果を {output_path} に保存しました')
+
+    if baseline_path:
+        compare(baseline_path, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+開いたPDF文書のキャッシュ
+(c) 2025 IshiyamaYoshihiro
+License: MIT License
+
+解析済みの文書（PyMuPDFの Document と pypdfの PdfReader）をリクエストをまたいで開いたままにしておき、
+同じファイルの同じ版を何度も解析し直さないようにする。
+キャッシュはファイルのパス・種類ごとに持ち、更新日時と大きさ（版）が変わっていれば開き直す。
+合計の大きさ（ファイルサイズで見積もる）が上限を超えたら、使われていないものから最近使った順の古い方を閉じる。
+1つの文書を同時に使えるのは1スレッドだけで、使っている間はその文書のロックを保持する。
+"""
+
+import os
+import collections
+import contextlib
+import threading
+import fitz  # PyMuPDF
+import pypdf
+
+# 文書の種類ごとの開き方
+_LOADERS = {
+    'fitz': fitz.open,
+    'pypdf': pypdf.PdfReader
+}
+
+
+class _Entry:
+    """キャッシュした文書1つ"""
+
+    def __init__(self, version, size):
+        self.version = version
+        self.size = size
+        self.document = None
+        self.lock = threading.Lock()
+        self.users = 0
+        # キャッシュから外されたもの（使い終わった時点で閉じる）
+        self.detached = False
+
+    def close(self):
+        if self.document is not None and hasattr(self.document, 'close'):
+            self.document.close()
+        self.document = None
+
+
+class DocumentCache:
+    """開いた文書のキャッシュ（スレッドセーフ）"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # {(絶対パス, 種類): _Entry}（最近使ったものほど後ろ）
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @contextlib.contextmanager
+    def open(self, path, kind='fitz'):
+        """文書を開く（キャッシュにあればそれを使う）
+
+        ブロックを抜けるまでその文書を他のスレッドは使えない。文書は閉じずにキャッシュに残すので、
+        呼び出し側で閉じたり、ページの回転などを変更したまま戻したりしてはいけない。
+        """
+        key = (os.path.abspath(path), kind)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version != version:
+                self._detach(key)
+                entry = None
+            if entry is None:
+                entry = _Entry(version, stat.st_size)
+                self._entries[key] = entry
+                self._bytes += entry.size
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            entry.users += 1
+        try:
+            with entry.lock:
+                if entry.document is None:
+                    # 解析に時間がかかるので、全体のロックの外で開く
+                    entry.document = _LOADERS[kind](path)
+                yield entry.document
+        finally:
+            with self._lock:
+                entry.users -= 1
+                if entry.detached and entry.users == 0:
+                    entry.close()
+                self._evict()
+
+    def invalidate(self, path):
+        """ファイルを書き換える・削除する前に、そのファイルの文書をキャッシュから外す"""
+        path = os.path.abspath(path)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path]:
+                self._detach(key)
+
+    def invalidate_folder(self, folder):
+        """フォルダ以下のファイルの文書をすべてキャッシュから外す"""
+        prefix = os.path.join(os.path.abspath(folder), '')
+        with self._lock:
+            for key in [key for key in self._entries if key[0].startswith(prefix)]:
+                self._detach(key)
+
+    def clear(self):
+        """すべての文書をキャッシュから外す"""
+        with self._lock:
+            for key in list(self._entries):
+                self._detach(key)
+
+    def stats(self):
+        """キャッシュしている文書の数・合計の大きさ・ヒット数・ミス数"""
+        with self._lock:
+            return {'documents': len(self._entries), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
+
+    def _detach(self, key):
+        """文書をキャッシュから外す（使用中なら使い終わった時点で閉じる）。self._lock を保持して呼ぶ"""
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        entry.detached = True
+        if entry.users == 0:
+            entry.close()
+
+    def _evict(self):
+        """上限を超えている間、使われていない文書を古い順に閉じる。self._lock を保持して呼ぶ"""
+        for key in list(self._entries):
+            if self._bytes <= self.max_bytes:
+                break
+            if self._entries[key].users == 0:
+                self._detach(key)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+処理時間・処理量の計測値の集計
+(c) 2025 IshiyamaYoshihiro
+License: MIT License
+
+ヒストグラムとカウンターをプロセス内で集計し、Prometheusのテキスト形式で出力する。
+値はプロセスごとに保持されるため、複数のワーカープロセスで動かす場合は
+それぞれのプロセスから取得した値を合算して使う。
+"""
+
+import math
+import threading
+
+# ヒストグラムの区切り（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+
+class Registry:
+    """ヒストグラムとカウンターの集計（スレッドセーフ）"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._descriptions = {}
+        # {名前: {ラベルの組: [各区切りの件数..., 合計, 件数]}}
+        self._histograms = {}
+        # {名前: {ラベルの組: 値}}
+        self._counters = {}
+
+    def describe(self, name, metric_type, description):
+        """出力時の HELP と TYPE を登録する"""
+        self._descriptions[name] = (metric_type, description)
+
+    def observe(self, name, value, **labels):
+        """ヒストグラムに値を1つ追加する"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = [0] * len(self.buckets) + [0.0, 0]
+            counts = series[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def inc(self, name, amount=1, **labels):
+        """カウンターを増やす"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def render(self):
+        """Prometheusのテキスト形式で出力する"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                self._render_header(lines, name, 'histogram')
+                for key, counts in sorted(series.items()):
+                    for bound, count in zip(self.buckets, counts):
+                        le = '+Inf' if bound == math.inf else repr(float(bound))
+                        lines.append(f'{name}_bucket{_format_labels(key + (("le", le),))} {count}')
+                    lines.append(f'{name}_sum{_format_labels(key)} {counts[-2]}')
+                    lines.append(f'{name}_count{_format_labels(key)} {counts[-1]}')
+            for name, series in sorted(self._counters.items()):
+                self._render_header(lines, name, 'counter')
+                for key, value in sorted(series.items()):
+                    lines.append(f'{name}{_format_labels(key)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def _render_header(self, lines, name, default_type):
+        metric_type, description = self._descriptions.get(name, (default_type, ''))
+        if description:
+            lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metric_type}')
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in key)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + '}'
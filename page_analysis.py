@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+白紙ページ・重複ページの検出
+(c) 2025 IshiyamaYoshihiro
+License: MIT License
+
+低解像度のグレースケール画像から、ページのインクの割合（暗いピクセルの割合）と
+知覚ハッシュ（縮小画像の離散コサイン変換から作る64ビットの値）を計算する。
+インクの割合が小さいページを白紙、ハッシュのハミング距離が小さいページ同士を重複とみなす。
+NumPy があればベクトル演算で計算し、なければ標準ライブラリだけで同じ値を計算する。
+"""
+
+import math
+
+try:
+    import numpy
+except ImportError:  # NumPy がなくても動くが、計算は遅くなる
+    numpy = None
+
+# インクとみなす明るさ（0〜255、これ未満を暗いピクセルとする）
+INK_THRESHOLD = 128
+# インクの割合を数えるときに除く、ページの端の幅（辺の長さに対する割合、スキャナーの影やパンチ穴を無視する）
+MARGIN = 0.05
+# 知覚ハッシュを作る縮小画像の1辺のピクセル数と、ハッシュに使う低周波成分の1辺の数（8×8 = 64ビット）
+HASH_IMAGE_SIZE = 32
+HASH_SIZE = 8
+# 既定の判定基準：インクの割合がこれ未満なら白紙、ハッシュの違うビット数がこれ以下なら重複
+BLANK_COVERAGE = 0.002
+DUPLICATE_DISTANCE = 4
+
+# 離散コサイン変換（DCT-II）の低周波成分の係数 [k][n]
+_DCT = [[math.cos(math.pi * (2 * n + 1) * k / (2 * HASH_IMAGE_SIZE)) for n in range(HASH_IMAGE_SIZE)]
+        for k in range(HASH_SIZE)]
+# 明るさ → 暗いピクセルなら1、それ以外は0 に変換する表
+_INK_TABLE = bytes(1 if i < INK_THRESHOLD else 0 for i in range(256))
+
+
+def _rows(samples, width, height, stride):
+    """グレースケールのピクセル列を行ごとのバイト列のリストにする"""
+    return [samples[y * stride:y * stride + width] for y in range(height)]
+
+def ink_coverage(samples, width, height, stride=None):
+    """グレースケール画像（1ピクセル1バイト）の端を除いた部分に占める、暗いピクセルの割合"""
+    stride = stride or width
+    margin_x, margin_y = int(width * MARGIN), int(height * MARGIN)
+    x0, x1, y0, y1 = margin_x, width - margin_x, margin_y, height - margin_y
+    if x1 <= x0 or y1 <= y0:
+        return 0.0
+    if numpy is not None:
+        pixels = numpy.frombuffer(samples, dtype=numpy.uint8, count=height * stride).reshape(height, stride)
+        return float((pixels[y0:y1, x0:x1] < INK_THRESHOLD).mean())
+    dark = sum(row[x0:x1].translate(_INK_TABLE).count(1) for row in _rows(samples, width, height, stride)[y0:y1])
+    return dark / ((x1 - x0) * (y1 - y0))
+
+def perceptual_hash(samples, stride=None):
+    """HASH_IMAGE_SIZE 四方のグレースケール画像の知覚ハッシュ（16桁の16進数）
+
+    DCTの低周波成分 HASH_SIZE 四方のそれぞれが、直流成分を除いた中央値より大きいかどうかを1ビットにする。
+    """
+    size = HASH_IMAGE_SIZE
+    stride = stride or size
+    if numpy is not None:
+        pixels = numpy.frombuffer(samples, dtype=numpy.uint8, count=size * stride).reshape(size, stride)[:, :size]
+        dct = numpy.array(_DCT)
+        coefficients = (dct @ pixels.astype(numpy.float64) @ dct.T).flatten().tolist()
+    else:
+        rows = _rows(samples, size, size, stride)
+        # 行方向に変換してから列方向に変換する
+        partial = [[sum(c * p for c, p in zip(basis, row)) for basis in _DCT] for row in rows]
+        coefficients = [sum(basis[n] * partial[n][j] for n in range(size)) for basis in _DCT for j in range(HASH_SIZE)]
+    median = sorted(coefficients[1:])[(len(coefficients) - 1) // 2]
+    value = 0
+    for coefficient in coefficients:
+        value = value << 1 | (coefficient > median)
+    return f'{value:0{HASH_SIZE * HASH_SIZE // 4}x}'
+
+def find_duplicates(hashes, max_distance=DUPLICATE_DISTANCE):
+    """ハッシュの距離が max_distance 以下のページをつないだまとまり（2ページ以上）をページ番号のリストで返す
+
+    hashes はページ番号 → ハッシュの辞書。全組み合わせを比べる代わりに、ハッシュを max_distance + 1 個の帯に分け、
+    どれかの帯が一致する組だけを比べる（距離が max_distance 以下なら、鳩の巣原理で必ずどれかの帯が一致する）。
+    """
+    bits = HASH_SIZE * HASH_SIZE
+    bands = min(bits, max_distance + 1)
+    bounds = [bits * i // bands for i in range(bands + 1)]
+    values = {index: int(value, 16) for index, value in hashes.items()}
+    parent = {index: index for index in values}
+
+    def root(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    for band in range(bands):
+        shift, width = bits - bounds[band + 1], bounds[band + 1] - bounds[band]
+        buckets = {}
+        for index, value in values.items():
+            buckets.setdefault(value >> shift & ((1 << width) - 1), []).append(index)
+        for members in buckets.values():
+            for i, a in enumerate(members):
+                for b in members[i + 1:]:
+                    root_a, root_b = root(a), root(b)
+                    if root_a != root_b and bin(values[a] ^ values[b]).count('1') <= max_distance:
+                        parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    clusters = {}
+    for index in sorted(values):
+        clusters.setdefault(root(index), []).append(index)
+    return [members for members in clusters.values() if len(members) > 1]
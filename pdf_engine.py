@@ -0,0 +1,672 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+PDF編集エンジンとバッチ処理
+(c) 2025 IshiyamaYoshihiro
+License: MIT License
+
+Webアプリ（app.py）の編集操作のうち、Flaskや作業領域に依存しない部分をまとめたもの。
+コマンドラインから実行すると、レシピ（操作の並び）をフォルダ以下のすべてのPDFに
+プロセスプールで並列に適用し、ファイルごとの処理時間とサイズを記録する。
+
+使い方:
+    python pdf_engine.py recipe.json input_dir output_dir
+    python pdf_engine.py recipe.json input_dir output_dir --workers 4
+
+レシピの例（各操作の引数は /pipeline や個別のエンドポイントと同じ）:
+    {
+        "steps": [
+            {"op": "split"},
+            {"op": "apply_mask", "mask": {"x": 0.1, "y": 0.1, "width": 0.3, "height": 0.1}, "interval": 2, "offset": 1},
+            {"op": "apply_mask", "masks": [
+                {"rect": {"x": 0, "y": 0, "width": 1, "height": 0.05}, "pages": "all"},
+                {"rect": {"x": 0.6, "y": 0.85, "width": 0.3, "height": 0.1}, "pages": "2-4,7", "redact": true}
+            ]},
+            {"op": "convert_to_image", "dpi": 150, "encoding": "jpeg", "quality": 85}
+        ],
+        "output": "pdf"
+    }
+
+output は pdf（編集後のPDFを入力と同じ相対パスに保存）または split_to_files（ページごとのPDFをまとめたZIP）。
+"optimize": {"image_dpi": 150} のように指定すると、保存時に出力を最適化する（Webアプリの optimize と同じ）。
+出力フォルダの report.jsonl に1ファイルごとの結果を1行ずつ追記する。中断した後に同じコマンドを実行すると、
+同じレシピで処理済みかつ入力が変わっていないファイルは飛ばす。
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import zipfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import fitz  # PyMuPDF
+import rasterizer
+
+# ページリストを編集する操作（/pipeline で使えるもの）
+EDIT_OPERATIONS = ('split', 'rotate', 'apply_mask', 'delete', 'reorder', 'swap_odd_even', 'reverse_all')
+# レシピで使える操作
+RECIPE_OPERATIONS = EDIT_OPERATIONS + ('convert_to_image',)
+# レシピの出力形式
+OUTPUTS = ('pdf', 'split_to_files')
+REPORT_FILENAME = 'report.jsonl'
+DEFAULT_DPI = 150
+# 出力の最適化（optimize: true）の既定値
+# dedup: 同じ内容のオブジェクト・ストリームを1つにまとめる / compress: ストリーム・画像・フォントをdeflateで圧縮する /
+# clean: コンテンツストリームを整理する / image_dpi: 表示上の解像度がこれを超える画像を縮小する（None なら縮小しない） /
+# image_quality: 縮小した画像をJPEGで保存するときの画質
+OPTIMIZE_DEFAULTS = {'dedup': True, 'compress': True, 'clean': True, 'image_dpi': None, 'image_quality': rasterizer.DEFAULT_QUALITY}
+# 縮小する画像の解像度は、目標の解像度をこの割合以上超えているもの（わずかな違いで画質を落とさない）
+DOWNSAMPLE_THRESHOLD = 1.2
+
+
+def no_progress(done, total):
+    pass
+
+
+# --- 編集操作 ---
+def page_order(operation, params, page_count):
+    """並べ替え系の操作（delete, reorder, swap_odd_even, reverse_all）から新しいページ順を求める"""
+    if operation == 'delete':
+        pages_to_delete = set([int(i) for i in params.get('pages_to_delete', [])])
+        return [i for i in range(page_count) if i not in pages_to_delete]
+    if operation == 'reorder':
+        new_order = [int(i) for i in params.get('order', [])]
+        if len(new_order) != page_count:
+            raise ValueError('ページ数が一致しません')
+        for page_index in new_order:
+            if not 0 <= page_index < page_count:
+                raise ValueError(f'無効なページ番号です: {page_index}')
+        return new_order
+    if operation == 'swap_odd_even':
+        new_order = []
+        for i in range(0, page_count - 1, 2):
+            new_order.extend([i + 1, i])
+        if page_count % 2 != 0:
+            new_order.append(page_count - 1)
+        return new_order
+    if operation == 'reverse_all':
+        return list(range(page_count - 1, -1, -1))
+    raise ValueError(f'不明な操作です: {operation}')
+
+def mask_targets(page_count, interval, offset):
+    """ページ間隔とオフセットからマスキング対象のページ番号を求める"""
+    # offset=1, interval=2: 1ページ目から2ページおき (0,2,4,6,...) → page_num % interval == 0
+    # offset=2, interval=2: 2ページ目から2ページおき (1,3,5,7,...) → page_num % interval == 1
+    # offset=3, interval=3: 3ページ目から3ページおき (2,5,8,11,...) → page_num % interval == 2
+    # つまり: (page_num + 1) が offset と同じ余りを interval で割ったとき一致
+    return [page_num for page_num in range(page_count)
+            if (page_num + 1 - offset) % interval == 0 and page_num >= offset - 1]
+
+def split_page(doc, page_number):
+    """横長のページを複製し、左右の半分ずつを表示範囲（CropBox/MediaBox）にする（縦長なら何もしない）"""
+    page = doc[page_number]
+    width, height = page.rect.width, page.rect.height
+    if width <= height:
+        return False
+    # 複製はページの中身を参照し直すだけで、XObjectで包み直さない（複製は元のページの直後に置く）
+    doc.fullcopy_page(page_number, page_number + 1 if page_number + 1 < len(doc) else -1)
+    halves = (fitz.Rect(0, 0, width / 2, height), fitz.Rect(width / 2, 0, width, height))
+    for i, half in enumerate(halves):
+        target = doc[page_number + i]
+        # 表示上の座標を回転前の座標に戻し、用紙の原点からの位置にする
+        box = (half * target.derotation_matrix).normalize()
+        box += (target.cropbox.x0, target.cropbox.y0, target.cropbox.x0, target.cropbox.y0)
+        target.set_cropbox(box)
+        doc.xref_set_key(target.xref, 'MediaBox', doc.xref_get_key(target.xref, 'CropBox')[1])
+    return True
+
+def select_pages(page_count, rule=None):
+    """ページの選び方から対象のページ番号（0始まり）のリストを求める
+
+    rule は次のいずれか（省略すると全ページ）。
+    'all'・'odd'（奇数ページ）・'even'（偶数ページ）、'1-3,5,8-' のようなページ範囲（1始まり）、
+    ページ番号（0始まり）のリスト、{'interval': 間隔, 'offset': 何ページ目から}（mask_targets と同じ）
+    """
+    if rule is None or rule == 'all':
+        return list(range(page_count))
+    if rule == 'odd':
+        return list(range(0, page_count, 2))
+    if rule == 'even':
+        return list(range(1, page_count, 2))
+    if isinstance(rule, dict):
+        try:
+            interval, offset = int(rule.get('interval', 1)), int(rule.get('offset', 1))
+        except (TypeError, ValueError):
+            raise ValueError('ページ間隔とオフセットは整数で指定してください')
+        if interval < 1 or offset < 1:
+            raise ValueError('ページ間隔とオフセットは1以上で指定してください')
+        return mask_targets(page_count, interval, offset)
+    if isinstance(rule, list):
+        return sorted(set(int(i) for i in rule if 0 <= int(i) < page_count))
+    if isinstance(rule, str):
+        pages = set()
+        for part in rule.replace(' ', '').split(','):
+            if not part:
+                continue
+            first, dash, last = part.partition('-')
+            try:
+                start = int(first) if first else 1
+                end = (int(last) if last else page_count) if dash else start
+            except ValueError:
+                raise ValueError(f'無効なページ範囲です: {part}')
+            pages.update(range(max(start, 1) - 1, min(end, page_count)))
+        return sorted(pages)
+    raise ValueError(f'無効なページの指定です: {rule}')
+
+def mask_regions(page_count, params):
+    """マスキングの引数から {ページ番号: [領域, ...]} を作る
+
+    masks は {'rect': 領域, 'pages': ページの選び方（select_pages と同じ）, 'redact': 墨消しするか} のリストで、
+    領域ごとに別のページに黒塗りできる。従来どおり mask と interval・offset で1つの領域も指定できる。
+    領域は {x, y, width, height}（0〜1に正規化された座標）に、その領域を墨消しするか（redact）を加えたもの。
+    """
+    redact = bool(params.get('redact', False))
+    masks = list(params.get('masks') or [])
+    if 'mask' in params:
+        masks.append({'rect': params['mask'], 'pages': {'interval': params.get('interval', 1), 'offset': params.get('offset', 1)}})
+    regions = {}
+    for mask in masks:
+        rect = mask.get('rect')
+        if not isinstance(rect, dict) or not all(key in rect for key in ('x', 'y', 'width', 'height')):
+            raise ValueError('マスク領域の指定が正しくありません')
+        region = dict(rect, redact=bool(mask.get('redact', redact)))
+        for page_index in select_pages(page_count, mask.get('pages')):
+            regions.setdefault(page_index, []).append(region)
+    return regions
+
+def mask_page(page, masks, redact=False):
+    """ページの指定領域（0〜1に正規化された座標、複数可）を黒塗りする
+
+    redact が真なら墨消し（下にある文字や画像も削除する）、偽なら黒い矩形をコンテンツの末尾に描き足す。
+    領域に redact があればその領域だけ切り替える。墨消しはページごとにまとめて1回で適用する。
+    """
+    rect = page.rect
+    # 回転したページに描くと座標がずれることがあるため、回転を外して回転前の座標で描く
+    derotation = page.derotation_matrix
+    rotation = page.rotation
+    areas = [(fitz.Rect(
+        rect.width * mask['x'],
+        rect.height * mask['y'],
+        rect.width * (mask['x'] + mask['width']),
+        rect.height * (mask['y'] + mask['height'])
+    ) * derotation, mask.get('redact', redact)) for mask in masks]
+    page.set_rotation(0)
+    try:
+        if any(redacted for _, redacted in areas):
+            for area, redacted in areas:
+                if redacted:
+                    page.add_redact_annot(area, fill=(0, 0, 0))
+            page.apply_redactions()
+        # 描き足す矩形が墨消しで消されないよう、墨消しの後に描く
+        for area, redacted in areas:
+            if not redacted:
+                page.draw_rect(area, color=(0, 0, 0), fill=(0, 0, 0))
+    finally:
+        page.set_rotation(rotation)
+    return True
+
+class DocumentPages:
+    """apply_operation の対象にする、文書をその場で編集するページリスト
+
+    app.py のページリスト（_ManifestPages）も同じメソッドを持ち、ソースを書き換えずに同じ操作を行う。
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+
+    def __len__(self):
+        return len(self.doc)
+
+    def rotate(self, page_indices, rotation):
+        for page_index in page_indices:
+            page = self.doc[page_index]
+            page.set_rotation((page.rotation + rotation) % 360)
+
+    def split(self, page_indices):
+        # 分割したページは直後に追加されるので、後ろのページから処理して番号をずらさない（縦長のページは何もしない）
+        for page_index in reversed(page_indices):
+            split_page(self.doc, page_index)
+
+    def mask(self, regions, search, redact):
+        if search:
+            regions = {page_index: list(page_regions) for page_index, page_regions in regions.items()}
+            for page_index, page in enumerate(self.doc):
+                # 検索結果は回転前の座標なので、表示されるページの座標にしてから正規化する
+                width, height = page.rect.width, page.rect.height
+                for rect in page.search_for(search):
+                    rect = (rect * page.rotation_matrix) & page.rect
+                    regions.setdefault(page_index, []).append({
+                        'x': rect.x0 / width, 'y': rect.y0 / height,
+                        'width': rect.width / width, 'height': rect.height / height, 'redact': redact
+                    })
+        for page_index, page_regions in regions.items():
+            mask_page(self.doc[page_index], page_regions)
+
+    def select(self, new_order):
+        self.doc.select(new_order)
+
+def apply_operation(pages, operation):
+    """編集操作を1つ行う（引数は /pipeline の各操作と同じ）
+
+    pages は文書（その場で編集する）、または DocumentPages と同じメソッドを持つページリスト。引数の解釈
+    （省略時の対象ページ・範囲外のページの除外など）はここだけで行い、レシピと /pipeline で同じ結果になるようにする。
+    rotate・split の対象ページを省略すると全ページになる。
+    """
+    if isinstance(pages, fitz.Document):
+        pages = DocumentPages(pages)
+    name = operation.get('op')
+    page_count = len(pages)
+    if name == 'rotate':
+        rotation = int(operation.get('rotation', 0))
+        if rotation % 90 != 0:
+            raise ValueError('回転角度は90度単位で指定してください')
+        page_indices = operation.get('pages')
+        if page_indices is None:
+            page_indices = range(page_count)
+        pages.rotate(sorted(set(i for i in map(int, page_indices) if 0 <= i < page_count)), rotation)
+    elif name == 'split':
+        page_indices = operation.get('pages_to_split')
+        if page_indices is None:
+            page_indices = range(page_count)
+        pages.split(sorted(set(i for i in map(int, page_indices) if 0 <= i < page_count)))
+    elif name == 'apply_mask':
+        search = (operation.get('search') or '').strip()
+        if 'mask' not in operation and not operation.get('masks') and not search:
+            raise ValueError('マスク領域が指定されていません')
+        pages.mask(mask_regions(page_count, operation), search, bool(operation.get('redact', False)))
+    else:
+        pages.select(page_order(name, operation, page_count))
+
+
+# --- 画像PDF ---
+def image_options(params):
+    """画像PDFの出力形式と画質を引数から取り出す"""
+    encoding = params.get('encoding', 'png')
+    if encoding not in rasterizer.ENCODINGS:
+        raise ValueError(f'無効な画像形式です: {encoding}')
+    quality = min(100, max(1, int(params.get('quality', rasterizer.DEFAULT_QUALITY))))
+    return encoding, quality
+
+def add_image_page(doc, img_bytes, width, height):
+    """レンダリングした画像を1ページとして追加する"""
+    page = doc.new_page(width=width, height=height)
+    rect = fitz.Rect(0, 0, width, height)
+    if img_bytes.startswith(b'P4\n'):
+        # 2値画像は展開せず1ビットのまま埋め込む（PBMは1が黒なので Decode で反転する）
+        _, size, samples = img_bytes.split(b'\n', 2)
+        image_width, image_height = size.split()
+        xref = doc.get_new_xref()
+        doc.update_object(xref, (
+            f'<< /Type /XObject /Subtype /Image /Width {int(image_width)} /Height {int(image_height)}'
+            ' /ColorSpace /DeviceGray /BitsPerComponent 1 /Decode [1 0] >>'
+        ))
+        doc.update_stream(xref, samples)
+        page.insert_image(rect, xref=xref)
+    else:
+        page.insert_image(rect, stream=img_bytes)
+
+def image_document(rendered, page_count, progress=no_progress):
+    """レンダリング結果 (画像, 幅, 高さ, エンコード秒数) を順にページにした画像PDFを作り、(文書, エンコード秒数) を返す"""
+    doc = fitz.open()
+    encode_seconds = 0
+    try:
+        for page_num, (img_bytes, width, height, page_encode_seconds) in enumerate(rendered):
+            progress(page_num, page_count)
+            encode_seconds += page_encode_seconds
+            add_image_page(doc, img_bytes, width, height)
+    except BaseException:
+        doc.close()
+        raise
+    progress(page_count, page_count)
+    return doc, encode_seconds
+
+def image_page_bytes(img_bytes, width, height):
+    """レンダリングした画像1枚だけの画像PDFのバイト列を作る"""
+    doc = fitz.open()
+    try:
+        add_image_page(doc, img_bytes, width, height)
+        return doc.tobytes(garbage=4, deflate=True, clean=True)
+    finally:
+        doc.close()
+
+
+# --- 出力の最適化 ---
+def optimize_options(params):
+    """出力の最適化の指定を引数の optimize から取り出す（指定がなければ None）
+
+    optimize は true（既定値で最適化する）または OPTIMIZE_DEFAULTS の一部を上書きする辞書。
+    """
+    value = params.get('optimize')
+    if not value:
+        return None
+    if value is True:
+        return dict(OPTIMIZE_DEFAULTS)
+    if not isinstance(value, dict):
+        raise ValueError('最適化の指定が正しくありません')
+    unknown = set(value) - set(OPTIMIZE_DEFAULTS)
+    if unknown:
+        raise ValueError(f'不明な最適化の指定です: {", ".join(sorted(unknown))}')
+    options = dict(OPTIMIZE_DEFAULTS, **value)
+    if options['image_dpi'] is not None:
+        options['image_dpi'] = int(options['image_dpi'])
+        if options['image_dpi'] <= 0:
+            raise ValueError('画像の解像度は1以上で指定してください')
+    options['image_quality'] = min(100, max(1, int(options['image_quality'])))
+    return options
+
+def save_options(options=None):
+    """最適化の指定から fitz の save・tobytes の引数を作る（None なら従来どおり重複をまとめて圧縮する）"""
+    if options is None:
+        return {'garbage': 4, 'deflate': True, 'clean': True}
+    compress = bool(options['compress'])
+    return {
+        # garbage=1 でも使われていないオブジェクトは削除される。4 では同じ内容のストリームもまとめる
+        'garbage': 4 if options['dedup'] else 1,
+        'clean': bool(options['clean']),
+        'deflate': compress,
+        'deflate_images': compress,
+        'deflate_fonts': compress
+    }
+
+def downsample_images(doc, target_dpi, quality=rasterizer.DEFAULT_QUALITY):
+    """表示される大きさに対する解像度が target_dpi を超える画像を縮小して置き換え、置き換えた画像の数を返す
+
+    同じ画像が複数の箇所に表示される場合は、最も大きく表示される箇所に合わせる。
+    透明度を持つ画像と白黒2値の画像は、縮小するとかえって大きくなることが多いので対象にしない。
+    元がJPEGならJPEGで、それ以外は可逆圧縮で保存し、元より小さくならなければ置き換えない。
+    """
+    # {xref: (画像を表示しているページ番号, 表示上の解像度)}
+    images = {}
+    for page in doc:
+        for xref, smask, width, height, bpc in (info[:5] for info in page.get_images(full=True)):
+            if smask or bpc == 1:
+                continue
+            for rect in page.get_image_rects(xref):
+                if rect.is_empty:
+                    continue
+                # 画像が90度回して配置されている場合もあるので、長い辺どうしで比べる
+                dpi = max(width, height) * 72 / max(rect.width, rect.height)
+                if xref not in images or dpi < images[xref][1]:
+                    images[xref] = (page.number, dpi)
+
+    replaced = 0
+    for xref, (page_number, dpi) in images.items():
+        if dpi < target_dpi * DOWNSAMPLE_THRESHOLD:
+            continue
+        pix = fitz.Pixmap(doc, xref)
+        if pix.alpha:
+            continue
+        if pix.colorspace and pix.colorspace.n not in (1, 3):
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+        scale = target_dpi / dpi
+        small = fitz.Pixmap(pix, max(1, round(pix.width * scale)), max(1, round(pix.height * scale)), None)
+        if 'DCTDecode' in doc.xref_get_key(xref, 'Filter')[1]:
+            data = small.tobytes('jpg', jpg_quality=quality)
+        else:
+            data = small.tobytes('png')
+        if len(data) >= len(doc.xref_stream_raw(xref) or b''):
+            continue
+        doc[page_number].replace_image(xref, stream=data)
+        replaced += 1
+    return replaced
+
+def optimize_pdf(pdf_bytes, options):
+    """PDFのバイト列を最適化し、(最適化後のバイト列, 結果) を返す
+
+    結果は最適化前後のバイト数（bytes_before・bytes_after）・縮小した画像の数（images_downsampled）・処理秒数（seconds）。
+    最適化してもかえって大きくなる場合は、元のバイト列をそのまま返す。
+    """
+    started = time.perf_counter()
+    doc = fitz.open('pdf', pdf_bytes)
+    try:
+        images = downsample_images(doc, options['image_dpi'], options['image_quality']) if options['image_dpi'] else 0
+        optimized = doc.tobytes(**save_options(options))
+    finally:
+        doc.close()
+    if len(optimized) >= len(pdf_bytes):
+        optimized = pdf_bytes
+    return optimized, {
+        'bytes_before': len(pdf_bytes),
+        'bytes_after': len(optimized),
+        'images_downsampled': images,
+        'seconds': time.perf_counter() - started
+    }
+
+
+# --- バッチ処理（ワーカープロセス側） ---
+def validate_recipe(recipe):
+    """レシピの形式を確かめる（誤りがあれば ValueError）"""
+    steps = recipe.get('steps')
+    if not isinstance(steps, list):
+        raise ValueError('レシピに steps（操作のリスト）がありません')
+    for operation in steps:
+        if operation.get('op') not in RECIPE_OPERATIONS:
+            raise ValueError(f'不明な操作です: {operation.get("op")}')
+        if operation['op'] == 'convert_to_image':
+            image_options(operation)
+    optimize_options(recipe)
+    if recipe.get('output', 'pdf') not in OUTPUTS:
+        raise ValueError(f'不明な出力形式です: {recipe.get("output")}')
+
+def _replace_atomically(write, path):
+    """書きかけのファイルが残らないよう、一時ファイルに書いてから置き換える"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path
+
+def _write_page_files(doc, zip_path, base_filename, options=None):
+    """ページごとのPDFを1つのZIPにまとめる（ファイル名は /split_to_files と同じ）"""
+    def write(temp_path):
+        with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for page_index in range(len(doc)):
+                single = fitz.open()
+                try:
+                    single.insert_pdf(doc, from_page=page_index, to_page=page_index)
+                    zip_file.writestr(f'{base_filename}_{page_index + 1}.pdf', single.tobytes(**save_options(options)))
+                finally:
+                    single.close()
+    return _replace_atomically(write, zip_path)
+
+def process_file(recipe, input_path, output_base):
+    """1つのPDFにレシピを適用して保存し、処理結果（ページ数・サイズ・段階ごとの処理時間）を返す
+
+    output_base は拡張子を除いた出力先のパス。画像化はこのプロセスの中で行う（バッチのワーカーが並列に動くため）。
+    """
+    started = time.perf_counter()
+    steps = []
+    temp_paths = []
+    doc = fitz.open(input_path)
+    try:
+        if not doc.is_pdf:
+            raise ValueError('PDFファイルではありません')
+        pages_in = len(doc)
+        edited = False
+        for operation in recipe['steps']:
+            step_started = time.perf_counter()
+            if operation['op'] == 'convert_to_image':
+                # レンダリングはファイルから行うため、それまでの編集結果を一時ファイルに書き出す
+                render_path = input_path
+                if edited:
+                    render_path = f'{output_base}.{os.getpid()}.render.tmp'
+                    os.makedirs(os.path.dirname(render_path) or '.', exist_ok=True)
+                    doc.save(render_path, garbage=1)
+                    temp_paths.append(render_path)
+                encoding, quality = image_options(operation)
+                rendered = rasterizer.render_pages([(render_path, i) for i in range(len(doc))],
+                                                   operation.get('dpi', DEFAULT_DPI), workers=1, fmt=encoding, quality=quality)
+                image_doc, _ = image_document(rendered, len(doc))
+                doc.close()
+                doc = image_doc
+            else:
+                apply_operation(doc, operation)
+            edited = True
+            steps.append({'op': operation['op'], 'seconds': round(time.perf_counter() - step_started, 4)})
+
+        options = optimize_options(recipe)
+        if options and options['image_dpi']:
+            step_started = time.perf_counter()
+            images = downsample_images(doc, options['image_dpi'], options['image_quality'])
+            steps.append({'op': 'downsample_images', 'images': images, 'seconds': round(time.perf_counter() - step_started, 4)})
+
+        step_started = time.perf_counter()
+        if recipe.get('output', 'pdf') == 'split_to_files':
+            base_filename = os.path.basename(output_base)
+            outputs = [_write_page_files(doc, f'{output_base}_pages.zip', base_filename, options)]
+        else:
+            outputs = [_replace_atomically(lambda temp_path: doc.save(temp_path, **save_options(options)),
+                                           f'{output_base}.pdf')]
+        steps.append({'op': 'save', 'seconds': round(time.perf_counter() - step_started, 4)})
+        pages_out = len(doc)
+    finally:
+        doc.close()
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    return {
+        'status': 'ok',
+        'pages_in': pages_in,
+        'pages_out': pages_out,
+        'outputs': outputs,
+        'output_bytes': sum(os.path.getsize(path) for path in outputs),
+        'steps': steps,
+        'seconds': round(time.perf_counter() - started, 4)
+    }
+
+def _process_file_safely(recipe, input_path, output_base):
+    """process_file の例外を結果として返す（1ファイルの失敗でバッチ全体を止めない）"""
+    started = time.perf_counter()
+    try:
+        return process_file(recipe, input_path, output_base)
+    except Exception as e:
+        return {'status': 'error', 'error': f'{type(e).__name__}: {e}', 'seconds': round(time.perf_counter() - started, 4)}
+
+
+# --- バッチ処理（呼び出し側） ---
+def find_pdfs(input_dir, exclude=None):
+    """フォルダ以下のPDFを、フォルダからの相対パスの順に返す（exclude 以下は除く）"""
+    exclude = os.path.abspath(exclude) if exclude else None
+    found = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) != exclude)
+        for filename in files:
+            if filename.lower().endswith('.pdf'):
+                found.append(os.path.relpath(os.path.join(root, filename), input_dir))
+    return sorted(found)
+
+def recipe_digest(recipe):
+    """レシピの内容のハッシュ値（レシピを変えたら処理し直すために記録する）"""
+    return hashlib.sha1(json.dumps(recipe, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def load_report(report_path):
+    """これまでの結果を {入力の相対パス: 最後の結果} として読み込む（途中で切れた行は無視する）"""
+    records = {}
+    if not os.path.exists(report_path):
+        return records
+    with open(report_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['input']] = record
+    return records
+
+def _is_done(record, digest, stat):
+    """前回の結果をそのまま使えるか（同じレシピで成功し、入力が変わっておらず、出力が残っている）"""
+    return (record is not None and record['status'] == 'ok' and record['recipe'] == digest
+            and record['input_bytes'] == stat.st_size and record['input_mtime'] == stat.st_mtime_ns
+            and all(os.path.exists(path) for path in record['outputs']))
+
+def run_batch(recipe, input_dir, output_dir, workers=None, report_path=None, log=print):
+    """フォルダ以下のすべてのPDFにレシピを適用し、(処理した数, 飛ばした数, 失敗した数) を返す"""
+    validate_recipe(recipe)
+    workers = max(1, workers or rasterizer.DEFAULT_WORKERS)
+    os.makedirs(output_dir, exist_ok=True)
+    report_path = report_path or os.path.join(output_dir, REPORT_FILENAME)
+    digest = recipe_digest(recipe)
+    previous = load_report(report_path)
+
+    pending_files = []
+    skipped = 0
+    for relative_path in find_pdfs(input_dir, exclude=output_dir):
+        stat = os.stat(os.path.join(input_dir, relative_path))
+        if _is_done(previous.get(relative_path), digest, stat):
+            skipped += 1
+        else:
+            pending_files.append((relative_path, stat))
+    log(f'{len(pending_files)}件を処理します（処理済みの{skipped}件は飛ばします）')
+
+    processed = failed = 0
+    # スレッドを使う呼び出し元からforkするとロックを引き継いでしまうため、spawnで起動する
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    running = {}
+    queue = iter(pending_files)
+    try:
+        with open(report_path, 'a', encoding='utf-8') as report:
+            while True:
+                # 同時に投入するファイル数をワーカー数の2倍までに抑える
+                while len(running) < workers * 2:
+                    item = next(queue, None)
+                    if item is None:
+                        break
+                    relative_path, stat = item
+                    output_base = os.path.join(output_dir, os.path.splitext(relative_path)[0])
+                    future = executor.submit(_process_file_safely, recipe, os.path.join(input_dir, relative_path), output_base)
+                    running[future] = item
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    relative_path, stat = running.pop(future)
+                    record = dict(future.result(), input=relative_path, input_bytes=stat.st_size,
+                                  input_mtime=stat.st_mtime_ns, recipe=digest)
+                    # 1件ごとに書き出し、中断されても処理済みの分は次回飛ばせるようにする
+                    report.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    report.flush()
+                    if record['status'] == 'ok':
+                        processed += 1
+                        log(f"{processed + failed}/{len(pending_files)} {relative_path} "
+                            f"{record['pages_in']}→{record['pages_out']}ページ {record['seconds']:.2f}秒")
+                    else:
+                        failed += 1
+                        log(f"{processed + failed}/{len(pending_files)} {relative_path} エラー: {record['error']}")
+    finally:
+        # 中断された場合は未着手のファイルを取り消す
+        executor.shutdown(wait=True, cancel_futures=True)
+    return processed, skipped, failed
+
+def main():
+    parser = argparse.ArgumentParser(description='フォルダ以下のPDFにレシピ（編集操作の並び）をまとめて適用する')
+    parser.add_argument('recipe', help='レシピのJSONファイル')
+    parser.add_argument('input_dir', help='入力フォルダ（サブフォルダも含めて処理する）')
+    parser.add_argument('output_dir', help='出力フォルダ（入力と同じフォルダ構成で保存する）')
+    parser.add_argument('--workers', type=int, default=None, help='並列に処理するプロセス数（既定はCPU数）')
+    parser.add_argument('--report', help=f'結果を追記するファイル（既定は出力フォルダの {REPORT_FILENAME}）')
+    args = parser.parse_args()
+
+    with open(args.recipe, encoding='utf-8') as f:
+        recipe = json.load(f)
+    try:
+        processed, skipped, failed = run_batch(recipe, args.input_dir, args.output_dir, args.workers, args.report)
+    except ValueError as e:
+        print(f'エラー: {e}', file=sys.stderr)
+        sys.exit(2)
+    except KeyboardInterrupt:
+        print('中断しました。同じコマンドを実行すると続きから処理します。', file=sys.stderr)
+        sys.exit(130)
+    print(f'完了: 処理 {processed}件, スキップ {skipped}件, エラー {failed}件')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ページラスタライズエンジン
+(c) 2025 IshiyamaYoshihiro
+License: MIT License
+
+ページ範囲をチャンクに分割してプロセスプールで並列にレンダリングし、
+結果をページ順に返す。各ワーカーは自分でPDFを開き直す。
+レンダリング済みのサムネイルを1枚にまとめたスプライト画像（アトラス）の作成と、ページの文字の抽出、
+白紙・重複ページの検出に使う低解像度画像の解析も同じプールで行う。
+"""
+
+import os
+import atexit
+import collections
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import fitz  # PyMuPDF
+import page_analysis
+
+# 既定のワーカー数とチャンクサイズ
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_CHUNK_SIZE = 8
+DEFAULT_QUALITY = 85
+
+# 画像の出力形式
+# png: 可逆圧縮 / jpeg: カラーJPEG / gray: グレースケールJPEG /
+# bilevel: 白黒2値（PBM形式） / pixmap: 無圧縮（PAM形式、圧縮はPDF保存時に行う）
+ENCODINGS = ('png', 'jpeg', 'gray', 'bilevel', 'pixmap')
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+# --- ワーカープロセス側 ---
+def _pack_bilevel(pix):
+    """グレースケールのピクセルマップを2値化し、PBM（P4）形式のバイト列にする"""
+    width, height, stride = pix.width, pix.height, pix.stride
+    samples = pix.samples
+    # 明るさ128未満を黒(1)とし、各行を '0'/'1' の文字列に変換してから整数経由で8ピクセルずつ詰める
+    bits = samples.translate(bytes(49 if i < 128 else 48 for i in range(256)))
+    padding = b'0' * (-width % 8)
+    row_bytes = (width + 7) // 8
+    rows = b''.join(
+        int(bits[y * stride:y * stride + width] + padding, 2).to_bytes(row_bytes, 'big')
+        for y in range(height)
+    )
+    return f'P4\n{width} {height}\n'.encode('ascii') + rows
+
+def _encode(pix, fmt, quality):
+    """ピクセルマップを指定された形式のバイト列にする"""
+    if fmt in ('jpeg', 'gray'):
+        return pix.tobytes('jpg', jpg_quality=quality)
+    if fmt == 'bilevel':
+        return _pack_bilevel(pix)
+    if fmt == 'pixmap':
+        return pix.tobytes('pam')
+    return pix.tobytes(fmt)
+
+def _render_chunk(tasks, dpi, fmt, quality=DEFAULT_QUALITY, cell_height=None):
+    """担当するページを1ページずつレンダリングして返すジェネレーター
+
+    tasks は (pdf_path, page_index, rotation, save_path) のリスト。
+    rotation はページ本来の回転に追加する角度（ファイルは変更しない）。
+    save_path が指定されていればファイルに保存して None を、
+    なければ (画像バイト列, ページ幅, ページ高さ, エンコード秒数) を返す。
+    cell_height を指定すると、保存する画像をアトラス用に縮小した画像も保存する（atlas_cell_path）。
+    """
+    colorspace = fitz.csGRAY if fmt in ('gray', 'bilevel') else fitz.csRGB
+    docs = {}
+    try:
+        for pdf_path, page_index, rotation, save_path in tasks:
+            if pdf_path not in docs:
+                docs[pdf_path] = fitz.open(pdf_path)
+            page = docs[pdf_path].load_page(page_index)
+            if rotation:
+                page.set_rotation((page.rotation + rotation) % 360)
+            pix = page.get_pixmap(dpi=dpi, colorspace=colorspace)
+            started = time.perf_counter()
+            data = _encode(pix, fmt, quality)
+            encode_seconds = time.perf_counter() - started
+            if save_path:
+                # 書きかけのファイルが読まれないよう、一時ファイル経由で置き換える
+                temp_path = f'{save_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, save_path)
+                if cell_height:
+                    _save_atlas_cell(pix, save_path, cell_height)
+                yield None
+            else:
+                yield data, page.rect.width, page.rect.height, encode_seconds
+    finally:
+        for doc in docs.values():
+            doc.close()
+
+def _extract_chunk(tasks):
+    """担当するページの文字を1ページずつ抽出して返すジェネレーター
+
+    tasks は (pdf_path, page_index) のリスト。
+    """
+    docs = {}
+    try:
+        for pdf_path, page_index in tasks:
+            if pdf_path not in docs:
+                docs[pdf_path] = fitz.open(pdf_path)
+            yield docs[pdf_path].load_page(page_index).get_text('text')
+    finally:
+        for doc in docs.values():
+            doc.close()
+
+def _analyze_chunk(tasks, dpi):
+    """担当するページを低解像度のグレースケールでレンダリングし、1ページずつ解析して返すジェネレーター
+
+    tasks は (pdf_path, page_index) のリスト。ページごとに {'coverage': インクの割合, 'hash': 知覚ハッシュ} を返す。
+    """
+    size = page_analysis.HASH_IMAGE_SIZE
+    docs = {}
+    try:
+        for pdf_path, page_index in tasks:
+            if pdf_path not in docs:
+                docs[pdf_path] = fitz.open(pdf_path)
+            pix = docs[pdf_path].load_page(page_index).get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+            small = fitz.Pixmap(pix, size, size, None)
+            yield {
+                'coverage': page_analysis.ink_coverage(pix.samples, pix.width, pix.height, pix.stride),
+                'hash': page_analysis.perceptual_hash(small.samples, small.stride)
+            }
+    finally:
+        for doc in docs.values():
+            doc.close()
+
+def atlas_cell_path(path, cell_height):
+    """アトラス用に縮小したサムネイルのキャッシュのパス（サムネイルと同じフォルダに置く）"""
+    return f'{path.removesuffix(".png")}.h{cell_height}.png'
+
+def _save_atlas_cell(pix, path, cell_height):
+    """ピクセルマップを高さ cell_height に縮小し、サムネイル path のアトラス用の画像として保存して返す"""
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.colorspace.n != 3:
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    cell = fitz.Pixmap(pix, max(1, round(pix.width * cell_height / pix.height)), cell_height, None)
+    cell_path = atlas_cell_path(path, cell_height)
+    temp_path = f'{cell_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    cell.save(temp_path, output='png')
+    os.replace(temp_path, cell_path)
+    return cell
+
+def _atlas_cell(path, cell_height):
+    """サムネイル path をアトラス用に縮小した画像を返す（キャッシュがなければサムネイルから作る）"""
+    cell_path = atlas_cell_path(path, cell_height)
+    try:
+        cell = fitz.Pixmap(cell_path)
+        os.utime(cell_path)
+        return cell
+    except (RuntimeError, FileNotFoundError):
+        return _save_atlas_cell(fitz.Pixmap(path), path, cell_height)
+
+def _compose_atlas(paths, columns, cell_height, quality, save_path):
+    """サムネイル画像を同じ高さに縮小して格子状に並べ、1枚のJPEGとして保存する（ワーカープロセスで実行）
+
+    paths はレンダリング済みのサムネイル（PNG）のパスのリスト。ページを改めてレンダリングせず、
+    縮小した画像（atlas_cell_path にキャッシュする）を並べるだけで作る。各行には columns 枚ずつ左から詰めて並べる。
+    (アトラスの幅, 高さ, [(x, y, 幅, 高さ), ...]) を返す。
+    """
+    cells = []
+    placements = []
+    width = 0
+    for i, path in enumerate(paths):
+        pix = _atlas_cell(path, cell_height)
+        if i % columns == 0:
+            x = 0
+        placements.append((x, (i // columns) * cell_height, pix.width, pix.height))
+        cells.append(pix)
+        x += pix.width
+        width = max(width, x)
+    height = ((len(paths) + columns - 1) // columns) * cell_height
+
+    atlas = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, width, height), False)
+    atlas.clear_with(255)
+    for pix, (x, y, cell_w, cell_h) in zip(cells, placements):
+        pix.set_origin(x, y)
+        atlas.copy(pix, fitz.IRect(x, y, x + cell_w, y + cell_h))
+    temp_path = f'{save_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    atlas.save(temp_path, output='jpeg', jpg_quality=quality)
+    os.replace(temp_path, save_path)
+    return width, height, placements
+
+def _collect_chunk(function, tasks, *args):
+    """チャンク関数（ジェネレーター）の結果をリストにまとめて返す（ワーカープロセスで実行）"""
+    return list(function(tasks, *args))
+
+
+# --- 呼び出し側 ---
+def render_tile(doc, page_index, rotation, scale, clip, save_path):
+    """ページの一部分を指定した倍率でレンダリングし、PNGで保存する（呼び出したプロセスで実行）
+
+    doc は呼び出し側で開いた文書で、変更した回転はレンダリング後に元に戻す。
+    clip は回転後のページ座標（ポイント）で、ページからはみ出す部分は切り詰める。
+    描画する部分がなければ保存せずに False を返す。
+    """
+    page = doc.load_page(page_index)
+    original_rotation = page.rotation
+    try:
+        if rotation:
+            page.set_rotation((original_rotation + rotation) % 360)
+        clip = fitz.Rect(clip) & page.rect
+        if clip.is_empty:
+            return False
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), clip=clip)
+    finally:
+        if page.rotation != original_rotation:
+            page.set_rotation(original_rotation)
+    temp_path = f'{save_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    pix.save(temp_path, output='png')
+    os.replace(temp_path, save_path)
+    return True
+
+def _get_executor(workers):
+    """プロセスプールを取得する（初回またはワーカー数変更時に作り直す）"""
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            # スレッドで動くWebサーバーからforkするとロックを引き継いでしまうため、spawnで起動する
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _executor_workers = workers
+        return _executor
+
+def _reset_executor():
+    """壊れたプロセスプールを破棄する"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = None
+
+@atexit.register
+def shutdown():
+    """プロセスプールを終了する"""
+    _reset_executor()
+
+def render_pages(tasks, dpi, workers=None, chunk_size=None, fmt='png', quality=DEFAULT_QUALITY, cell_height=None):
+    """ページをレンダリングし、結果をページ順に返すジェネレーター
+
+    tasks は (pdf_path, page_index[, rotation[, save_path]]) のリスト。
+    fmt は ENCODINGS のいずれか。quality は JPEG の画質（1〜100）。
+    cell_height を指定すると、保存するサムネイルからアトラス用の縮小画像も作る。
+    """
+    tasks = [tuple(task) + (0, None)[len(task) - 2:] for task in tasks]
+    yield from _map_chunks(_render_chunk, tasks, workers, chunk_size, dpi, fmt, quality, cell_height)
+
+def extract_text(tasks, workers=None, chunk_size=None):
+    """ページの文字を抽出し、ページ順に返すジェネレーター
+
+    tasks は (pdf_path, page_index) のリスト。並列化の方法は render_pages と同じ。
+    """
+    yield from _map_chunks(_extract_chunk, [tuple(task) for task in tasks], workers, chunk_size)
+
+def analyze_pages(tasks, dpi, workers=None, chunk_size=None):
+    """ページを解析し（page_analysis を参照）、結果をページ順に返すジェネレーター
+
+    tasks は (pdf_path, page_index) のリスト。並列化の方法は render_pages と同じ。
+    """
+    yield from _map_chunks(_analyze_chunk, [tuple(task) for task in tasks], workers, chunk_size, dpi)
+
+def _map_chunks(function, tasks, workers, chunk_size, *args):
+    """tasks をチャンクに分けて function(chunk, *args) をプロセスプールで実行し、結果をページ順に返す
+
+    function はページごとの結果を順に返すジェネレーター関数。
+    ページ数がチャンク1つ分以下、またはワーカー数が1の場合はプロセスを使わずに処理し、
+    1ページ処理するごとに結果を返す（全ページの結果をメモリに溜めない）。
+    同時に処理中のチャンク数はワーカー数の2倍までに抑え、メモリ使用量を一定に保つ。
+    """
+    workers = max(1, workers or DEFAULT_WORKERS)
+    chunk_size = max(1, chunk_size or DEFAULT_CHUNK_SIZE)
+    if not tasks:
+        return
+
+    if workers == 1 or len(tasks) <= chunk_size:
+        yield from function(tasks, *args)
+        return
+
+    chunks = iter([tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)])
+    executor = _get_executor(workers)
+    pending = collections.deque()
+    try:
+        for chunk in chunks:
+            pending.append(executor.submit(_collect_chunk, function, chunk, *args))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            results = pending.popleft().result()
+            next_chunk = next(chunks, None)
+            if next_chunk is not None:
+                pending.append(executor.submit(_collect_chunk, function, next_chunk, *args))
+            yield from results
+    except BrokenProcessPool:
+        _reset_executor()
+        raise
+    finally:
+        # 途中で中断された場合は未着手のチャンクを取り消す
+        for future in pending:
+            future.cancel()
+
+def compose_atlases(jobs, workers=None, quality=DEFAULT_QUALITY):
+    """スプライト画像をまとめて作成し、各画像の配置を jobs と同じ順に返す
+
+    jobs は (サムネイル画像のパスのリスト, 1行の枚数, 縮小後の高さ, 保存先) のリスト。
+    """
+    workers = max(1, workers or DEFAULT_WORKERS)
+    if workers == 1 or len(jobs) <= 1:
+        return [_compose_atlas(paths, columns, height, quality, save_path)
+                for paths, columns, height, save_path in jobs]
+    executor = _get_executor(workers)
+    futures = [executor.submit(_compose_atlas, paths, columns, height, quality, save_path)
+               for paths, columns, height, save_path in jobs]
+    try:
+        return [future.result() for future in futures]
+    except BrokenProcessPool:
+        _reset_executor()
+        raise
@@ -8,7 +8,11 @@ document.addEventListener('DOMContentLoaded', () => {
     // ========================================
     // グローバル変数・定数
     // ========================================
-    let sharedPdfData = null;
+    let sharedPdfData = null; // { page_count, thumbnails, sizes, atlas } - サムネイルは取得済みのページだけ入る
+    let pageDataGeneration = 0; // 操作のたびに増やし、古い /pages の結果を捨てる
+    const pendingPageWindows = new Map();
+    const GALLERY_BLOCK_SIZE = 50; // 仮想表示でまとめて要素を作るページ数
+    const galleryViews = new Map();
     let galleriesPopulated = {
         upload: false,
         split: false,
@@ -29,6 +33,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const status = document.getElementById('status');
     const undoButton = document.getElementById('undo-button');
     const redoButton = document.getElementById('redo-button');
+    const cancelJobButton = document.getElementById('cancel-job-button');
+    let currentJobId = null; // 実行中のバックグラウンドジョブID
 
     // --- アップロードタブ要素 ---
     const dropZone = document.getElementById('drop-zone');
@@ -55,6 +61,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const splitSelectedButton = document.getElementById('split-selected-button');
     const splitAllButton = document.getElementById('split-all-button');
     const clearSelectionButtonSplit = document.getElementById('clear-selection-button-split');
+    const selectLandscapeButton = document.getElementById('select-landscape-button');
     const sizeSliderSplit = document.getElementById('size-slider-split');
     let selectedPagesToSplit = [];
 
@@ -62,6 +69,10 @@ document.addEventListener('DOMContentLoaded', () => {
     const galleryDelete = document.getElementById('gallery-delete');
     const deleteButton = document.getElementById('delete-button');
     const clearSelectionButtonDelete = document.getElementById('clear-selection-button-delete');
+    const searchInputDelete = document.getElementById('search-input-delete');
+    const searchButtonDelete = document.getElementById('search-button-delete');
+    const selectBlankButton = document.getElementById('select-blank-button');
+    const selectDuplicatesButton = document.getElementById('select-duplicates-button');
     const sizeSliderDelete = document.getElementById('size-slider-delete');
     let selectedPagesToDelete = [];
 
@@ -70,6 +81,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const rotateLeftButton = document.getElementById('rotate-left-button');
     const rotateRightButton = document.getElementById('rotate-right-button');
     const clearSelectionButtonEdit = document.getElementById('clear-selection-button-edit');
+    const searchInputEdit = document.getElementById('search-input-edit');
+    const searchButtonEdit = document.getElementById('search-button-edit');
     const swapOddEvenButton = document.getElementById('swap-odd-even-button');
     const reverseAllButton = document.getElementById('reverse-all-button');
     const sizeSliderEdit = document.getElementById('size-slider-edit');
@@ -84,6 +97,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const sizeSliderReorder = document.getElementById('size-slider-reorder');
     let clickedOrder = [];
     let selectedPagesToMove = [];
+    let reorderOrder = []; // 並べ替えタブでの現在の並び（元のページ番号）
 
     // --- ファイル分割タブ要素 ---
     const galleryFileSplit = document.getElementById('gallery-file-split');
@@ -99,10 +113,29 @@ document.addEventListener('DOMContentLoaded', () => {
     const clearMaskButton = document.getElementById('clear-mask-button');
     const maskIntervalSelect = document.getElementById('mask-interval-select');
     const maskOffsetSelect = document.getElementById('mask-offset-select');
+    const maskRedactCheckbox = document.getElementById('mask-redact-checkbox');
+    const maskPagesMode = document.getElementById('mask-pages-mode');
+    const maskPagesInput = document.getElementById('mask-pages-input');
+    const maskIntervalControls = document.getElementById('mask-interval-controls');
+    const addMaskRegionButton = document.getElementById('add-mask-region-button');
+    const maskRegionList = document.getElementById('mask-region-list');
+    let maskRegions = []; // まとめて黒塗りする領域 [{ rect, pages, label }]
+    const maskSearchInput = document.getElementById('mask-search-input');
+    const maskSearchButton = document.getElementById('mask-search-button');
     const maskInfo = document.getElementById('mask-info');
     let maskSelection = null; // {x, y, width, height} - 正規化された座標 (0-1)
     let maskSelectionBox = null; // DOM要素
     let currentMaskPageIndex = 0; // 現在選択中のページインデックス
+    const maskZoomOutButton = document.getElementById('mask-zoom-out-button');
+    const maskZoomInButton = document.getElementById('mask-zoom-in-button');
+    const maskZoomResetButton = document.getElementById('mask-zoom-reset-button');
+    const maskZoomLabel = document.getElementById('mask-zoom-label');
+    let maskPage = null; // 表示中のページ { width, height, tile_size, max_zoom, url, thumbnail } - 大きさはポイント
+    let maskLoadCount = 0; // ページを切り替えたときに、古い読み込み結果を捨てるための番号
+    let maskZoom = 1; // 表示倍率（1でページ全体）
+    let maskOffsetX = 0, maskOffsetY = 0; // 表示している領域の左上（ポイント）
+    const maskTileImages = new Map(); // タイルのURL → Image（最近使ったものを後ろに置く）
+    const MASK_TILE_CACHE_SIZE = 300;
 
     // --- ページ分割保存タブ要素 ---
     const gallerySplitFiles = document.getElementById('gallery-split-files');
@@ -110,6 +143,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const splitFilesAsImageCheckbox = document.getElementById('split-files-as-image-checkbox');
     const splitFilesDpiContainer = document.getElementById('split-files-dpi-container');
     const splitFilesDpiSelect = document.getElementById('split-files-dpi-select');
+    const splitFilesEncodingSelect = document.getElementById('split-files-encoding-select');
     const sizeSliderSplitFiles = document.getElementById('size-slider-split-files');
 
     // --- 保存タブ要素 ---
@@ -117,6 +151,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const savePdfButton = document.getElementById('save-pdf-button');
     const saveImagePdfButton = document.getElementById('save-image-pdf-button');
     const imagePdfDpiSelect = document.getElementById('image-pdf-dpi-select');
+    const imagePdfEncodingSelect = document.getElementById('image-pdf-encoding-select');
     const sizeSliderSave = document.getElementById('size-slider-save');
 
     // --- モーダル要素 ---
@@ -134,10 +169,14 @@ document.addEventListener('DOMContentLoaded', () => {
     // 初期状態設定
     setEditButtonsState(false);
 
-    // ページ読み込み時にサーバー側のファイルをクリア
+    // ページ読み込み時にサーバー側のファイルをクリア（途中の分割アップロードは再開できるように残す）
     (async () => {
         try {
-            await fetch('/clear_all', { method: 'POST' });
+            await fetch('/clear_all', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ keep_partial_uploads: true })
+            });
         } catch (error) {
             console.error('初期化エラー:', error);
         }
@@ -146,6 +185,86 @@ document.addEventListener('DOMContentLoaded', () => {
     // ========================================
     // ファイル処理関数
     // ========================================
+    // 分割アップロード：同時に送るチャンクの数と、1つのチャンクを送り直す回数
+    const UPLOAD_CONCURRENCY = 4;
+    const UPLOAD_RETRIES = 5;
+    // どのファイルもこの大きさ（サーバーのチャンク1つ分）以下なら、分割せずに /upload へ1回のリクエストでまとめて送る
+    const DIRECT_UPLOAD_MAX_BYTES = 8 * 1024 * 1024;
+    let crc32Table = null;
+
+    // チャンクのCRC-32（サーバーで受け取った内容と照合する）
+    function crc32(bytes) {
+        if (!crc32Table) {
+            crc32Table = new Uint32Array(256);
+            for (let n = 0; n < 256; n++) {
+                let c = n;
+                for (let k = 0; k < 8; k++) c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+                crc32Table[n] = c >>> 0;
+            }
+        }
+        let crc = 0xFFFFFFFF;
+        for (let i = 0; i < bytes.length; i++) crc = crc32Table[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+        return (crc ^ 0xFFFFFFFF) >>> 0;
+    }
+
+    // チャンクを1つ送る（通信エラーやチェックサムの不一致は、間隔を空けて送り直す）
+    async function putChunk(uploadId, index, bytes) {
+        const checksum = crc32(bytes).toString(16).padStart(8, '0');
+        const resumeHint = '（同じファイルをもう一度選択すると、続きからアップロードします）';
+        for (let attempt = 0; ; attempt++) {
+            let response = null;
+            try {
+                response = await fetch(`/uploads/${uploadId}/chunks/${index}`, {
+                    method: 'PUT',
+                    headers: { 'Content-Type': 'application/octet-stream', 'X-Chunk-CRC32': checksum },
+                    body: bytes
+                });
+            } catch (error) {
+                if (attempt >= UPLOAD_RETRIES) throw new Error(`${error.message}${resumeHint}`);
+            }
+            if (response) {
+                if (response.ok) return;
+                const data = await response.json().catch(() => ({}));
+                // アップロード自体がなくなった場合は、送り直しても無駄なので諦める
+                if (response.status === 404) throw new Error(data.error || 'アップロードが見つかりません');
+                if (attempt >= UPLOAD_RETRIES) throw new Error(`${data.error || `サーバーエラー（${response.status}）`}${resumeHint}`);
+            }
+            await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+        }
+    }
+
+    // ファイルをチャンクに分けて並行して送り、アップロードIDを返す（onProgress には送ったバイト数が渡される）
+    // 同じファイルの以前のアップロードが途中で止まっていれば、サーバーが受け取り済みのチャンクは送らない
+    async function uploadInChunks(file, onProgress) {
+        const response = await fetch('/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size, key: `${file.name}:${file.size}:${file.lastModified}` })
+        });
+        const upload = await response.json();
+        if (!response.ok) throw new Error(upload.error || 'サーバーエラー');
+
+        const chunkBytes = index => Math.min(upload.chunk_size, file.size - index * upload.chunk_size);
+        const received = new Set(upload.received);
+        received.forEach(index => onProgress(chunkBytes(index)));
+        const pending = [];
+        for (let i = 0; i < upload.chunk_count; i++) {
+            if (!received.has(i)) pending.push(i);
+        }
+
+        async function sendPending() {
+            while (pending.length > 0) {
+                const index = pending.shift();
+                const start = index * upload.chunk_size;
+                const bytes = new Uint8Array(await file.slice(start, start + chunkBytes(index)).arrayBuffer());
+                await putChunk(upload.upload_id, index, bytes);
+                onProgress(bytes.length);
+            }
+        }
+        await Promise.all(Array.from({ length: Math.min(UPLOAD_CONCURRENCY, pending.length) }, sendPending));
+        return upload.upload_id;
+    }
+
     async function handleFiles(files) {
         if (files.length === 0) {
             status.textContent = 'ファイルが選択されていません。';
@@ -163,23 +282,40 @@ document.addEventListener('DOMContentLoaded', () => {
             return;
         }
 
-        status.textContent = 'アップロード中... サムネイルを生成しています。';
+        status.textContent = 'アップロード中...';
         uploadButton.disabled = true;
         clearAllButton.disabled = true;
 
         try {
-            for (let i = 0; i < pdfFiles.length; i++) {
+            let response;
+            if (pdfFiles.every(file => file.size <= DIRECT_UPLOAD_MAX_BYTES)) {
+                // 小さなファイルだけなら、分割の準備と組み立ての往復を省いて1回で送る
                 const formData = new FormData();
-                formData.append('pdfFile', pdfFiles[i]);
-
-                status.textContent = `アップロード中 (${i + 1}/${pdfFiles.length})... サムネイルを生成しています。`;
-
-                const response = await fetch('/upload', { method: 'POST', body: formData });
-                const data = await response.json();
-                if (!response.ok) { throw new Error(data.error || 'サーバーエラー'); }
+                pdfFiles.forEach(file => formData.append('pdfFile', file));
+                response = await fetch('/upload', { method: 'POST', body: formData });
+            } else {
+                // 各ファイルをチャンクに分けて送り、すべて揃ったらまとめてページリストに追加する
+                const totalBytes = pdfFiles.reduce((sum, file) => sum + file.size, 0);
+                let sentBytes = 0;
+                const uploadIds = [];
+                for (const file of pdfFiles) {
+                    uploadIds.push(await uploadInChunks(file, bytes => {
+                        sentBytes += bytes;
+                        status.textContent = `アップロード中... ${Math.floor(sentBytes / totalBytes * 100)}%`;
+                    }));
+                }
 
-                sharedPdfData = { page_count: data.page_count, thumbnails: data.thumbnails };
+                status.textContent = 'アップロード完了。サムネイルを生成しています...';
+                response = await fetch('/uploads/finalize', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ upload_ids: uploadIds })
+                });
             }
+            const data = await response.json();
+            if (!response.ok) { throw new Error(data.error || 'サーバーエラー'); }
+
+            setSharedPdfData(data);
 
             forceRepopulateAllGalleries();
             status.textContent = `${pdfFiles.length}個のPDFファイルを追加しました。`;
@@ -302,6 +438,7 @@ document.addEventListener('DOMContentLoaded', () => {
     [sizeSliderSplit, sizeSliderDelete, sizeSliderEdit, sizeSliderReorder, sizeSliderFileSplit, sizeSliderSplitFiles, sizeSliderSave].forEach(slider => {
         slider.addEventListener('input', (e) => {
             document.documentElement.style.setProperty('--thumbnail-width', `${e.target.value}px`);
+            refreshGalleryEstimates(true);
         });
     });
 
@@ -332,6 +469,11 @@ document.addEventListener('DOMContentLoaded', () => {
         updateMaskGallerySelection();
     });
 
+    maskPagesMode.addEventListener('change', () => {
+        maskIntervalControls.style.display = maskPagesMode.value === 'interval' ? 'flex' : 'none';
+        maskPagesInput.style.display = maskPagesMode.value === 'range' ? 'inline-block' : 'none';
+    });
+
     undoButton.addEventListener('click', async () => {
         status.textContent = '元に戻しています...';
         undoButton.disabled = true;
@@ -341,7 +483,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const data = await response.json();
             if (!response.ok) { throw new Error(data.error || 'サーバーエラー'); }
 
-            sharedPdfData = { page_count: data.page_count, thumbnails: data.thumbnails };
+            setSharedPdfData(data);
             resetAllSelections();
             forceRepopulateAllGalleries();
             status.textContent = data.message;
@@ -361,7 +503,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const data = await response.json();
             if (!response.ok) { throw new Error(data.error || 'サーバーエラー'); }
 
-            sharedPdfData = { page_count: data.page_count, thumbnails: data.thumbnails };
+            setSharedPdfData(data);
             resetAllSelections();
             forceRepopulateAllGalleries();
             status.textContent = data.message;
@@ -382,6 +524,49 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    // 重い処理はジョブとして実行し、完了するまで進捗を表示する
+    async function fetchWithJob(url, options, statusMessage) {
+        const response = await fetch(url, options);
+        const data = await response.json();
+        if (response.status !== 202) {
+            return { ok: response.ok, data: data };
+        }
+        currentJobId = data.job_id;
+        cancelJobButton.style.display = 'inline-block';
+        cancelJobButton.disabled = false;
+        try {
+            while (true) {
+                await new Promise(resolve => setTimeout(resolve, 500));
+                const jobResponse = await fetch(data.status_url);
+                const job = await jobResponse.json();
+                if (!jobResponse.ok) { throw new Error(job.error || 'サーバーエラー'); }
+                if (job.status === 'done' || job.status === 'failed') {
+                    return { ok: job.status === 'done', data: job.result };
+                }
+                if (job.status === 'cancelled') {
+                    throw new Error('処理をキャンセルしました');
+                }
+                if (job.pages_total) {
+                    const eta = job.eta_seconds !== null ? `（残り約${Math.ceil(job.eta_seconds)}秒）` : '';
+                    status.textContent = `${statusMessage} ${job.pages_done}/${job.pages_total}ページ${eta}`;
+                }
+            }
+        } finally {
+            currentJobId = null;
+            cancelJobButton.style.display = 'none';
+        }
+    }
+
+    cancelJobButton.addEventListener('click', async () => {
+        if (!currentJobId) return;
+        cancelJobButton.disabled = true;
+        try {
+            await fetch(`/jobs/${currentJobId}/cancel`, { method: 'POST' });
+        } catch (error) {
+            console.error('キャンセルエラー:', error);
+        }
+    });
+
     async function updateHistoryButtons() {
         try {
             const response = await fetch('/history_status');
@@ -407,7 +592,66 @@ document.addEventListener('DOMContentLoaded', () => {
             maskSelectionBox = null;
         }
         maskInfo.textContent = '';
-        applyMaskButton.disabled = true;
+        applyMaskButton.disabled = maskRegions.length === 0;
+        addMaskRegionButton.disabled = true;
+    }
+
+    // 選択中の「対象ページ」の指定を、/apply_mask の pages の形式と表示用の説明にする（不正なら null）
+    function currentMaskRule() {
+        switch (maskPagesMode.value) {
+            case 'odd': return { pages: 'odd', label: '奇数ページ' };
+            case 'even': return { pages: 'even', label: '偶数ページ' };
+            case 'range': {
+                const range = maskPagesInput.value.trim();
+                if (!/^[\d\s,-]+$/.test(range) || !/\d/.test(range)) return null;
+                return { pages: range, label: `${range}ページ` };
+            }
+            default: {
+                const interval = parseInt(maskIntervalSelect.value, 10);
+                const offset = parseInt(maskOffsetSelect.value, 10);
+                return {
+                    pages: { interval: interval, offset: offset },
+                    label: interval === 1 && offset === 1 ? '全ページ' : `${interval}ページ毎に${offset}ページ目`
+                };
+            }
+        }
+    }
+
+    // 領域の対象ページに pageIndex（0始まり）が含まれるか（サーバーの select_pages と同じ規則）
+    function maskRuleIncludes(pages, pageIndex, pageCount) {
+        if (pages === 'odd') return pageIndex % 2 === 0;
+        if (pages === 'even') return pageIndex % 2 === 1;
+        if (typeof pages === 'object') {
+            return pageIndex >= pages.offset - 1 && (pageIndex + 1 - pages.offset) % pages.interval === 0;
+        }
+        return pages.split(',').some(part => {
+            part = part.trim();
+            if (!part) return false;
+            const [first, last] = part.split('-').map(v => v.trim());
+            const start = first ? parseInt(first, 10) : 1;
+            const end = part.includes('-') ? (last ? parseInt(last, 10) : pageCount) : start;
+            return pageIndex + 1 >= start && pageIndex + 1 <= end;
+        });
+    }
+
+    function renderMaskRegionList() {
+        maskRegionList.innerHTML = '';
+        maskRegions.forEach((region, i) => {
+            const item = document.createElement('li');
+            const label = document.createElement('span');
+            const r = region.rect;
+            label.textContent = `領域${i + 1}: ${region.label}（左${Math.round(r.x * 100)}% 上${Math.round(r.y * 100)}% 幅${Math.round(r.width * 100)}% 高さ${Math.round(r.height * 100)}%）`;
+            const removeButton = document.createElement('button');
+            removeButton.textContent = '削除';
+            removeButton.addEventListener('click', () => {
+                maskRegions.splice(i, 1);
+                renderMaskRegionList();
+            });
+            item.append(label, removeButton);
+            maskRegionList.appendChild(item);
+        });
+        applyMaskButton.disabled = maskRegions.length === 0 && !maskSelection;
+        drawMaskCanvas();
     }
 
     // ========================================
@@ -461,6 +705,9 @@ document.addEventListener('DOMContentLoaded', () => {
                 const orderToRender = Array.from({ length: sharedPdfData.page_count }, (_, i) => i);
                 populateGalleries(orderToRender);
                 galleriesPopulated[tabName] = true;
+            } else {
+                // 非表示の間に見積もったブロックの高さを、表示した幅で見積もり直す
+                refreshGalleryEstimates(false);
             }
         } else {
             activeTabContent.querySelector('.placeholder').style.display = 'block';
@@ -483,22 +730,25 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // 表示中のギャラリーだけ描き直し、他のタブは表示したときに描き直す
     function forceRepopulateAllGalleries() {
         Object.keys(galleriesPopulated).forEach(key => galleriesPopulated[key] = false);
-        [galleryUpload, gallerySplit, galleryDelete, galleryEdit, galleryReorder, galleryFileSplit, galleryMask, gallerySplitFiles, gallerySave].forEach(g => { g.innerHTML = ''; });
-        if (sharedPdfData) {
-            const orderToRender = Array.from({ length: sharedPdfData.page_count }, (_, i) => i);
-            populateGalleries(orderToRender);
-            const activeTabId = document.querySelector('.tab-content.active').id;
-            const tabName = activeTabId.replace('-tab', '');
-            galleriesPopulated[tabName] = true;
+        if (!sharedPdfData) {
+            [galleryUpload, gallerySplit, galleryDelete, galleryEdit, galleryReorder, galleryFileSplit, galleryMask, gallerySplitFiles, gallerySave].forEach(clearGallery);
+            return;
         }
+        const orderToRender = Array.from({ length: sharedPdfData.page_count }, (_, i) => i);
+        populateGalleries(orderToRender);
+        const activeTabId = document.querySelector('.tab-content.active').id;
+        const tabName = activeTabId.replace('-tab', '');
+        galleriesPopulated[tabName] = true;
     }
 
     function resetAllStates() {
+        sharedPdfData = null;
+        pageDataGeneration++;
         forceRepopulateAllGalleries();
         status.textContent = '';
-        sharedPdfData = null;
         resetAllSelections();
         setEditButtonsState(false);
     }
@@ -519,11 +769,13 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function setEditButtonsState(enabled) {
         const buttons = [
-            splitSelectedButton, splitAllButton, clearSelectionButtonSplit,
+            splitSelectedButton, splitAllButton, clearSelectionButtonSplit, selectLandscapeButton,
             deleteButton, clearSelectionButtonDelete, rotateLeftButton,
             rotateRightButton, clearSelectionButtonEdit, swapOddEvenButton,
             reverseAllButton, applyOrderButton, clearSelectionButton,
-            splitToFilesButton, savePdfButton, saveImagePdfButton
+            splitToFilesButton, savePdfButton, saveImagePdfButton,
+            searchButtonDelete, searchButtonEdit, maskSearchButton,
+            selectBlankButton, selectDuplicatesButton
         ];
         buttons.forEach(btn => btn.disabled = !enabled);
         movePrevButton.disabled = true;
@@ -537,126 +789,125 @@ document.addEventListener('DOMContentLoaded', () => {
     // ========================================
 
     function populateGalleryUpload(order) {
-        galleryUpload.innerHTML = '';
-        order.forEach((originalIndex) => {
-            galleryUpload.appendChild(createPageContainer(originalIndex, sharedPdfData.thumbnails[originalIndex]));
-        });
+        renderGallery(galleryUpload, order, {});
     }
 
     function populateGallerySplit(pageOrder) {
-        gallerySplit.innerHTML = '';
-        pageOrder.forEach((originalIndex) => {
-            const pageContainer = createPageContainer(originalIndex, sharedPdfData.thumbnails[originalIndex]);
-            pageContainer.addEventListener('click', () => {
-                const idx = parseInt(pageContainer.dataset.originalIndex, 10);
-                const foundIndex = selectedPagesToSplit.indexOf(idx);
-                if (foundIndex > -1) {
-                    selectedPagesToSplit.splice(foundIndex, 1);
-                    pageContainer.classList.remove('selected-split');
-                } else {
-                    selectedPagesToSplit.push(idx);
-                    pageContainer.classList.add('selected-split');
-                }
-            });
-            gallerySplit.appendChild(pageContainer);
+        renderGallery(gallerySplit, pageOrder, {
+            setup: (pageContainer) => {
+                pageContainer.addEventListener('click', () => {
+                    const idx = parseInt(pageContainer.dataset.originalIndex, 10);
+                    const foundIndex = selectedPagesToSplit.indexOf(idx);
+                    if (foundIndex > -1) {
+                        selectedPagesToSplit.splice(foundIndex, 1);
+                        pageContainer.classList.remove('selected-split');
+                    } else {
+                        selectedPagesToSplit.push(idx);
+                        pageContainer.classList.add('selected-split');
+                    }
+                });
+            },
+            applyState: (pageContainer, idx) => pageContainer.classList.toggle('selected-split', selectedPagesToSplit.includes(idx))
         });
     }
 
     function populateGalleryDelete(pageOrder) {
-        galleryDelete.innerHTML = '';
-         pageOrder.forEach((originalIndex) => {
-            const pageContainer = createPageContainer(originalIndex, sharedPdfData.thumbnails[originalIndex]);
-            const deleteOverlay = document.createElement('div');
-            deleteOverlay.className = 'delete-overlay';
-            deleteOverlay.textContent = '×';
-            pageContainer.appendChild(deleteOverlay);
-            pageContainer.addEventListener('click', () => {
-                const idx = parseInt(pageContainer.dataset.originalIndex, 10);
-                const foundIndex = selectedPagesToDelete.indexOf(idx);
-                if (foundIndex > -1) {
-                    selectedPagesToDelete.splice(foundIndex, 1);
-                    pageContainer.classList.remove('selected-delete');
-                } else {
-                    selectedPagesToDelete.push(idx);
-                    pageContainer.classList.add('selected-delete');
-                }
-            });
-            galleryDelete.appendChild(pageContainer);
+        renderGallery(galleryDelete, pageOrder, {
+            setup: (pageContainer) => {
+                const deleteOverlay = document.createElement('div');
+                deleteOverlay.className = 'delete-overlay';
+                deleteOverlay.textContent = '×';
+                pageContainer.appendChild(deleteOverlay);
+                pageContainer.addEventListener('click', () => {
+                    const idx = parseInt(pageContainer.dataset.originalIndex, 10);
+                    const foundIndex = selectedPagesToDelete.indexOf(idx);
+                    if (foundIndex > -1) {
+                        selectedPagesToDelete.splice(foundIndex, 1);
+                        pageContainer.classList.remove('selected-delete');
+                    } else {
+                        selectedPagesToDelete.push(idx);
+                        pageContainer.classList.add('selected-delete');
+                    }
+                });
+            },
+            applyState: (pageContainer, idx) => pageContainer.classList.toggle('selected-delete', selectedPagesToDelete.includes(idx))
         });
     }
 
     function populateGalleryEdit(pageOrder) {
-        galleryEdit.innerHTML = '';
-        pageOrder.forEach((originalIndex) => {
-            const pageContainer = createPageContainer(originalIndex, sharedPdfData.thumbnails[originalIndex]);
-            pageContainer.addEventListener('click', () => {
-                const idx = parseInt(pageContainer.dataset.originalIndex, 10);
-                const foundIndex = selectedPagesToEdit.indexOf(idx);
-                if (foundIndex > -1) {
-                    selectedPagesToEdit.splice(foundIndex, 1);
-                    pageContainer.classList.remove('selected-edit');
-                } else {
-                    selectedPagesToEdit.push(idx);
-                    pageContainer.classList.add('selected-edit');
-                }
-            });
-            galleryEdit.appendChild(pageContainer);
+        renderGallery(galleryEdit, pageOrder, {
+            setup: (pageContainer) => {
+                pageContainer.addEventListener('click', () => {
+                    const idx = parseInt(pageContainer.dataset.originalIndex, 10);
+                    const foundIndex = selectedPagesToEdit.indexOf(idx);
+                    if (foundIndex > -1) {
+                        selectedPagesToEdit.splice(foundIndex, 1);
+                        pageContainer.classList.remove('selected-edit');
+                    } else {
+                        selectedPagesToEdit.push(idx);
+                        pageContainer.classList.add('selected-edit');
+                    }
+                });
+            },
+            applyState: (pageContainer, idx) => pageContainer.classList.toggle('selected-edit', selectedPagesToEdit.includes(idx))
         });
     }
 
     function populateGalleryReorder(pageOrder) {
-        galleryReorder.innerHTML = '';
+        reorderOrder = pageOrder;
         selectedPagesToMove = [];
-        pageOrder.forEach((originalIndex) => {
-            const pageContainer = createPageContainer(originalIndex, sharedPdfData.thumbnails[originalIndex]);
-            const orderOverlay = document.createElement('div');
-            orderOverlay.className = 'order-overlay';
-            pageContainer.appendChild(orderOverlay);
-            pageContainer.addEventListener('click', () => {
-                pageContainer.classList.toggle('selected-reorder');
-                const indexInMoveSelection = selectedPagesToMove.indexOf(pageContainer);
-                if (indexInMoveSelection > -1) selectedPagesToMove.splice(indexInMoveSelection, 1); else selectedPagesToMove.push(pageContainer);
-                updateReorderButtonsState();
-                const originalIdx = parseInt(pageContainer.dataset.originalIndex, 10);
-                const indexInClickOrder = clickedOrder.indexOf(originalIdx);
-                if (indexInClickOrder > -1) clickedOrder.splice(indexInClickOrder, 1); else clickedOrder.push(originalIdx);
-                updateGalleryOverlays();
-            });
-            galleryReorder.appendChild(pageContainer);
+        renderReorderGallery();
+    }
+
+    function renderReorderGallery() {
+        renderGallery(galleryReorder, reorderOrder, {
+            setup: (pageContainer) => {
+                const orderOverlay = document.createElement('div');
+                orderOverlay.className = 'order-overlay';
+                pageContainer.appendChild(orderOverlay);
+                pageContainer.addEventListener('click', () => {
+                    const originalIdx = parseInt(pageContainer.dataset.originalIndex, 10);
+                    pageContainer.classList.toggle('selected-reorder');
+                    const indexInMoveSelection = selectedPagesToMove.indexOf(originalIdx);
+                    if (indexInMoveSelection > -1) selectedPagesToMove.splice(indexInMoveSelection, 1); else selectedPagesToMove.push(originalIdx);
+                    updateReorderButtonsState();
+                    const indexInClickOrder = clickedOrder.indexOf(originalIdx);
+                    if (indexInClickOrder > -1) clickedOrder.splice(indexInClickOrder, 1); else clickedOrder.push(originalIdx);
+                    updateGalleryOverlays();
+                });
+            },
+            applyState: (pageContainer, idx) => {
+                pageContainer.classList.toggle('selected-reorder', selectedPagesToMove.includes(idx));
+                updateOrderOverlay(pageContainer);
+            }
         });
-        updateGalleryOverlays();
         updateReorderButtonsState();
     }
 
     function populateGalleryMask(pageOrder) {
-        galleryMask.innerHTML = '';
-        pageOrder.forEach((originalIndex) => {
-            const pageContainer = createPageContainer(originalIndex, sharedPdfData.thumbnails[originalIndex]);
-            pageContainer.addEventListener('click', () => {
-                document.querySelectorAll('#gallery-mask .page-container').forEach(c => c.classList.remove('selected-mask'));
-                pageContainer.classList.add('selected-mask');
-                currentMaskPageIndex = originalIndex;
-                loadMaskCanvas(originalIndex);
-                clearMaskSelection();
-            });
-            if (originalIndex === (parseInt(maskOffsetSelect.value, 10) - 1)) {
-                pageContainer.classList.add('selected-mask');
-            }
-            galleryMask.appendChild(pageContainer);
+        renderGallery(galleryMask, pageOrder, {
+            setup: (pageContainer) => {
+                pageContainer.addEventListener('click', () => {
+                    const idx = parseInt(pageContainer.dataset.originalIndex, 10);
+                    document.querySelectorAll('#gallery-mask .page-container').forEach(c => c.classList.remove('selected-mask'));
+                    pageContainer.classList.add('selected-mask');
+                    currentMaskPageIndex = idx;
+                    loadMaskCanvas(idx);
+                    clearMaskSelection();
+                });
+            },
+            applyState: (pageContainer, idx) => pageContainer.classList.toggle('selected-mask', idx === currentMaskPageIndex)
         });
     }
 
     function populateGalleryFileSplit(pageOrder) {
-        galleryFileSplit.innerHTML = '';
-        pageOrder.forEach((originalIndex, index) => {
-            const pageContainer = createPageContainer(originalIndex, sharedPdfData.thumbnails[originalIndex]);
-            galleryFileSplit.appendChild(pageContainer);
-
-            if (index < pageOrder.length - 1) {
+        renderGallery(galleryFileSplit, pageOrder, {
+            separator: (originalIndex) => {
                 const splitLine = document.createElement('div');
                 splitLine.className = 'split-line';
                 splitLine.dataset.position = originalIndex + 1;
                 splitLine.title = `${originalIndex + 1}ページと${originalIndex + 2}ページの間で分割`;
+                splitLine.classList.toggle('active', fileSplitPositions.includes(originalIndex + 1));
                 splitLine.addEventListener('click', () => {
                     const position = parseInt(splitLine.dataset.position, 10);
                     const posIndex = fileSplitPositions.indexOf(position);
@@ -670,22 +921,156 @@ document.addEventListener('DOMContentLoaded', () => {
                     executeFileSplitButton.disabled = fileSplitPositions.length === 0;
                     clearSplitLinesButton.disabled = fileSplitPositions.length === 0;
                 });
-                galleryFileSplit.appendChild(splitLine);
+                return splitLine;
             }
         });
     }
 
     function populateGallerySplitFiles(pageOrder) {
-        gallerySplitFiles.innerHTML = '';
-        pageOrder.forEach((originalIndex) => {
-            gallerySplitFiles.appendChild(createPageContainer(originalIndex, sharedPdfData.thumbnails[originalIndex]));
-        });
+        renderGallery(gallerySplitFiles, pageOrder, {});
     }
 
     function populateGallerySave(pageOrder) {
-        gallerySave.innerHTML = '';
-        pageOrder.forEach((originalIndex) => {
-            gallerySave.appendChild(createPageContainer(originalIndex, sharedPdfData.thumbnails[originalIndex]));
+        renderGallery(gallerySave, pageOrder, {});
+    }
+
+    // ========================================
+    // ギャラリーの仮想表示
+    // ========================================
+    // ページを GALLERY_BLOCK_SIZE ページずつのブロックに分け、画面の近くにあるブロックだけ要素を作る。
+    // 再描画のときは、サムネイルのURLが同じページの要素を使い回し、変わったページだけ作り直す。
+
+    function renderGallery(gallery, order, options) {
+        let view = galleryViews.get(gallery);
+        if (!view) {
+            view = { gallery: gallery, blocks: [] };
+            view.observer = new IntersectionObserver((entries) => {
+                entries.forEach(entry => {
+                    if (entry.isIntersecting) mountBlock(view, entry.target);
+                    else unmountBlock(view, entry.target);
+                });
+            }, { rootMargin: '600px 0px' });
+            galleryViews.set(gallery, view);
+        }
+        // 表示中の要素を、サムネイルのURLごとに使い回せるよう取っておく
+        view.pool = new Map();
+        gallery.querySelectorAll('.page-container').forEach(container => {
+            const key = container.dataset.thumbnail;
+            if (!view.pool.has(key)) view.pool.set(key, []);
+            view.pool.get(key).push(container);
+        });
+        view.order = order;
+        view.options = options;
+
+        const blockCount = Math.ceil(order.length / GALLERY_BLOCK_SIZE);
+        while (view.blocks.length > blockCount) {
+            const block = view.blocks.pop();
+            view.observer.unobserve(block);
+            block.remove();
+        }
+        while (view.blocks.length < blockCount) {
+            const block = document.createElement('div');
+            block.className = 'gallery-block';
+            block.dataset.blockIndex = view.blocks.length;
+            gallery.appendChild(block);
+            view.blocks.push(block);
+            view.observer.observe(block);
+        }
+        view.blocks.forEach(block => {
+            if (block.mounted) fillBlock(view, block); else estimateBlockHeight(view, block);
+        });
+    }
+
+    function clearGallery(gallery) {
+        const view = galleryViews.get(gallery);
+        if (view) {
+            view.observer.disconnect();
+            galleryViews.delete(gallery);
+        }
+        gallery.innerHTML = '';
+    }
+
+    function mountBlock(view, block) {
+        if (block.mounted) return;
+        block.mounted = true;
+        fillBlock(view, block);
+    }
+
+    function unmountBlock(view, block) {
+        if (!block.mounted) return;
+        // 非表示のタブでは高さが0になるので、表示中に測った高さを残す
+        if (block.offsetHeight > 0) block.measuredHeight = block.offsetHeight;
+        block.mounted = false;
+        block.replaceChildren();
+        estimateBlockHeight(view, block);
+    }
+
+    function fillBlock(view, block) {
+        const start = parseInt(block.dataset.blockIndex, 10) * GALLERY_BLOCK_SIZE;
+        const indices = view.order.slice(start, start + GALLERY_BLOCK_SIZE);
+        if (!hasPages(indices)) {
+            // サムネイルの情報を取得してから表示する（その間は概算の高さを確保しておく）
+            const order = view.order;
+            ensurePages(indices).then(loaded => {
+                if (loaded && block.mounted && view.order === order) fillBlock(view, block);
+            }).catch(error => {
+                status.textContent = `エラー: ${error.message}`;
+            });
+            return;
+        }
+        const nodes = [];
+        indices.forEach((originalIndex, i) => {
+            const thumbUrl = sharedPdfData.thumbnails[originalIndex];
+            const reusable = view.pool.get(thumbUrl);
+            let pageContainer = reusable && reusable.length > 0 ? reusable.pop() : null;
+            if (pageContainer) {
+                updatePageContainer(pageContainer, originalIndex);
+            } else {
+                pageContainer = createPageContainer(originalIndex, thumbUrl);
+                if (view.options.setup) view.options.setup(pageContainer);
+            }
+            if (view.options.applyState) view.options.applyState(pageContainer, originalIndex);
+            nodes.push(pageContainer);
+            if (view.options.separator && start + i < view.order.length - 1) {
+                nodes.push(view.options.separator(originalIndex));
+            }
+        });
+        block.replaceChildren(...nodes);
+        block.style.height = '';
+    }
+
+    function estimateBlockHeight(view, block) {
+        if (block.measuredHeight) {
+            block.style.height = `${block.measuredHeight}px`;
+            return;
+        }
+        const start = parseInt(block.dataset.blockIndex, 10) * GALLERY_BLOCK_SIZE;
+        const indices = view.order.slice(start, start + GALLERY_BLOCK_SIZE);
+        const thumbHeight = parseFloat(getComputedStyle(document.documentElement).getPropertyValue('--thumbnail-width')) || 200;
+        const rowWidth = view.gallery.clientWidth - 20;
+        // ページを左から並べたときの行数を数える（大きさが分からないページはA4縦とする）
+        let rows = 1;
+        let x = 0;
+        indices.forEach(index => {
+            const size = sharedPdfData && sharedPdfData.sizes[index];
+            const itemWidth = thumbHeight * (size ? size[0] / size[1] : Math.SQRT1_2) + 30;
+            if (x > 0 && x + itemWidth > rowWidth) {
+                rows++;
+                x = 0;
+            }
+            x += itemWidth;
+        });
+        block.style.height = `${rows * (thumbHeight + 45)}px`;
+    }
+
+    // 表示していないブロックの高さを見積もり直す（サムネイルの大きさが変わった場合は測った高さも捨てる）
+    function refreshGalleryEstimates(discardMeasured) {
+        galleryViews.forEach(view => {
+            view.blocks.forEach(block => {
+                if (block.mounted) return;
+                if (discardMeasured) block.measuredHeight = 0;
+                estimateBlockHeight(view, block);
+            });
         });
     }
 
@@ -697,10 +1082,9 @@ document.addEventListener('DOMContentLoaded', () => {
         status.textContent = statusMessage;
         setEditButtonsState(false);
         try {
-            const response = await fetch(url, options);
-            const data = await response.json();
-            if (!response.ok) { throw new Error(data.error || 'サーバーエラー'); }
-            sharedPdfData = { page_count: data.page_count, thumbnails: data.thumbnails };
+            const { ok, data } = await fetchWithJob(url, options, statusMessage);
+            if (!ok) { throw new Error(data.error || 'サーバーエラー'); }
+            setSharedPdfData(data);
             resetAllSelections();
             forceRepopulateAllGalleries();
             status.textContent = data.message;
@@ -724,11 +1108,64 @@ document.addEventListener('DOMContentLoaded', () => {
         performManipulation('/split', '選択したページを分割中...', { 
             method: 'POST', 
             headers: { 'Content-Type': 'application/json' }, 
-            body: JSON.stringify({ pages_to_split: selectedPagesToSplit }) 
+            body: JSON.stringify({ pages_to_split: selectedPagesToSplit, async: true }) 
         });
     });
     splitAllButton.addEventListener('click', () => {
-        performManipulation('/split', '全ページを分割中...', { method: 'POST' });
+        performManipulation('/split', '全ページを分割中...', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ async: true })
+        });
+    });
+    // 表示中のサムネイルの選択表示を、選択されたページ番号のリストに合わせる
+    function markSelectedPages(gallery, className, indices) {
+        const selected = new Set(indices);
+        gallery.querySelectorAll('.page-container').forEach(c => {
+            c.classList.toggle(className, selected.has(parseInt(c.dataset.originalIndex, 10)));
+        });
+    }
+
+    // ページ内の文字を検索し、一致したページ番号と一致箇所を受け取る
+    async function searchPages(query) {
+        const response = await fetch(`/search?q=${encodeURIComponent(query)}`);
+        const data = await response.json();
+        if (!response.ok) throw new Error(data.error || '不明なエラー');
+        return data;
+    }
+
+    // 検索語を含むページを選択する（select には一致したページ番号のリストが渡される）
+    async function selectPagesBySearch(input, gallery, className, select) {
+        const query = input.value.trim();
+        if (!query) { status.textContent = '検索する語句を入力してください。'; return; }
+        status.textContent = `「${query}」を検索中...`;
+        try {
+            const data = await searchPages(query);
+            const indices = data.pages.map(page => page.index);
+            select(indices);
+            markSelectedPages(gallery, className, indices);
+            status.textContent = indices.length > 0
+                ? `「${query}」が${indices.length}ページ（${data.hit_count}箇所）で見つかりました。`
+                : `「${query}」は見つかりませんでした。`;
+        } catch (error) {
+            status.textContent = `エラー: ${error.message}`;
+        }
+    }
+
+    selectLandscapeButton.addEventListener('click', async () => {
+        // ページのメタデータから横長のページだけを問い合わせる（サムネイルやPDFは読み込まない）
+        try {
+            const response = await fetch('/pages/metadata?orientation=landscape');
+            const data = await response.json();
+            if (!response.ok) throw new Error(data.error || '不明なエラー');
+            selectedPagesToSplit = data.pages.map(page => page.index);
+            markSelectedPages(gallerySplit, 'selected-split', selectedPagesToSplit);
+            status.textContent = selectedPagesToSplit.length > 0
+                ? `${selectedPagesToSplit.length}ページの横長ページを選択しました。`
+                : '横長のページはありません。';
+        } catch (error) {
+            status.textContent = `エラー: ${error.message}`;
+        }
     });
     clearSelectionButtonSplit.addEventListener('click', () => {
         selectedPagesToSplit = [];
@@ -747,6 +1184,35 @@ document.addEventListener('DOMContentLoaded', () => {
         selectedPagesToDelete = [];
         document.querySelectorAll('#gallery-delete .page-container.selected-delete').forEach(c => c.classList.remove('selected-delete'));
     });
+    const searchForDelete = () => selectPagesBySearch(searchInputDelete, galleryDelete, 'selected-delete', indices => { selectedPagesToDelete = indices; });
+    searchButtonDelete.addEventListener('click', searchForDelete);
+    searchInputDelete.addEventListener('keydown', (e) => { if (e.key === 'Enter' && !searchButtonDelete.disabled) searchForDelete(); });
+
+    // 白紙ページ・重複ページを検出して選択する（pick には検出結果が渡され、選択するページ番号のリストを返す）
+    async function selectDetectedPages(pick, describe) {
+        status.textContent = 'ページを解析中...';
+        try {
+            const response = await fetch('/pages/analysis');
+            const data = await response.json();
+            if (!response.ok) throw new Error(data.error || '不明なエラー');
+            selectedPagesToDelete = pick(data);
+            markSelectedPages(galleryDelete, 'selected-delete', selectedPagesToDelete);
+            status.textContent = describe(data, selectedPagesToDelete.length);
+        } catch (error) {
+            status.textContent = `エラー: ${error.message}`;
+        }
+    }
+    selectBlankButton.addEventListener('click', () => selectDetectedPages(
+        data => data.blank,
+        (data, count) => count > 0 ? `${count}ページの白紙ページを選択しました。` : '白紙ページは見つかりませんでした。'
+    ));
+    // 重複ページは、まとまりごとに最初のページを残して残りを選択する
+    selectDuplicatesButton.addEventListener('click', () => selectDetectedPages(
+        data => data.duplicates.flatMap(group => group.slice(1)),
+        (data, count) => count > 0
+            ? `${data.duplicates.length}組の重複から、最初のページを除く${count}ページを選択しました。`
+            : '重複ページは見つかりませんでした。'
+    ));
 
     rotateLeftButton.addEventListener('click', () => rotatePages(-90));
     rotateRightButton.addEventListener('click', () => rotatePages(90));
@@ -762,6 +1228,9 @@ document.addEventListener('DOMContentLoaded', () => {
         selectedPagesToEdit = [];
         document.querySelectorAll('#gallery-edit .page-container.selected-edit').forEach(c => c.classList.remove('selected-edit'));
     });
+    const searchForEdit = () => selectPagesBySearch(searchInputEdit, galleryEdit, 'selected-edit', indices => { selectedPagesToEdit = indices; });
+    searchButtonEdit.addEventListener('click', searchForEdit);
+    searchInputEdit.addEventListener('keydown', (e) => { if (e.key === 'Enter' && !searchButtonEdit.disabled) searchForEdit(); });
     swapOddEvenButton.addEventListener('click', () => performManipulation('/swap_odd_even', '偶数・奇数ページを入れ替え中...'));
     reverseAllButton.addEventListener('click', () => performManipulation('/reverse_all', '全ページを逆順にしています...'));
 
@@ -823,7 +1292,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await fetch('/split_and_save', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ parts: partsData })
+                body: JSON.stringify({ parts: partsData, optimize: optimizeOption('file-split') })
             });
             const data = await response.json();
             if (!response.ok) { throw new Error(data.error || 'サーバーエラー'); }
@@ -838,7 +1307,8 @@ document.addEventListener('DOMContentLoaded', () => {
                 document.body.removeChild(link);
                 if (i < data.files.length - 1) await new Promise(resolve => setTimeout(resolve, 500));
             }
-            status.textContent = `${data.message}（${data.files.length}個のファイルをダウンロード開始）`;
+            const optimized = describeOptimization(data.optimization);
+            status.textContent = `${data.message}（${data.files.length}個のファイルをダウンロード開始${optimized ? '、' + optimized : ''}）`;
         } catch (error) {
             status.textContent = `エラー: ${error.message}`;
         } finally {
@@ -856,27 +1326,27 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     function updateGalleryOverlays() {
-        document.querySelectorAll('#gallery-reorder .page-container').forEach(container => {
-            const originalIndex = parseInt(container.dataset.originalIndex, 10);
-            const orderIndex = clickedOrder.indexOf(originalIndex);
-            const overlay = container.querySelector('.order-overlay');
-            if (orderIndex > -1) {
-                overlay.textContent = getCircledNumber(orderIndex + 1);
-                container.classList.add('ordered');
-            } else {
-                overlay.textContent = '';
-                container.classList.remove('ordered');
-            }
-        });
+        document.querySelectorAll('#gallery-reorder .page-container').forEach(updateOrderOverlay);
+    }
+    function updateOrderOverlay(container) {
+        const originalIndex = parseInt(container.dataset.originalIndex, 10);
+        const orderIndex = clickedOrder.indexOf(originalIndex);
+        const overlay = container.querySelector('.order-overlay');
+        if (orderIndex > -1) {
+            overlay.textContent = getCircledNumber(orderIndex + 1);
+            container.classList.add('ordered');
+        } else {
+            overlay.textContent = '';
+            container.classList.remove('ordered');
+        }
     }
     function updateReorderButtonsState() {
-        const allPages = Array.from(galleryReorder.children);
         const hasSelection = selectedPagesToMove.length > 0;
-        movePrevButton.disabled = !hasSelection || selectedPagesToMove.some(p => allPages.indexOf(p) === 0);
-        moveNextButton.disabled = !hasSelection || selectedPagesToMove.some(p => allPages.indexOf(p) === allPages.length - 1);
+        movePrevButton.disabled = !hasSelection || selectedPagesToMove.some(p => reorderOrder.indexOf(p) === 0);
+        moveNextButton.disabled = !hasSelection || selectedPagesToMove.some(p => reorderOrder.indexOf(p) === reorderOrder.length - 1);
     }
     clearSelectionButton.addEventListener('click', () => {
-        selectedPagesToMove.forEach(page => page.classList.remove('selected-reorder'));
+        document.querySelectorAll('#gallery-reorder .page-container.selected-reorder').forEach(c => c.classList.remove('selected-reorder'));
         selectedPagesToMove = [];
         clickedOrder = [];
         updateGalleryOverlays();
@@ -884,52 +1354,55 @@ document.addEventListener('DOMContentLoaded', () => {
     });
     applyOrderButton.addEventListener('click', () => {
         if (clickedOrder.length === 0) return;
-        const currentOrder = Array.from(galleryReorder.children).map(c => parseInt(c.dataset.originalIndex, 10));
+        const currentOrder = reorderOrder;
         const remainingPages = currentOrder.filter(index => !clickedOrder.includes(index));
         const newPageOrder = clickedOrder.concat(remainingPages);
-        populateGalleryReorder(newPageOrder);
         clickedOrder = [];
-        selectedPagesToMove = [];
+        populateGalleryReorder(newPageOrder);
     });
     movePrevButton.addEventListener('click', () => movePages('prev'));
     moveNextButton.addEventListener('click', () => movePages('next'));
+    // 選択したページをまとめて、前（後）のページの前（後）に移動する
     function movePages(direction) {
         if (selectedPagesToMove.length === 0) return;
-        const pages = Array.from(galleryReorder.children);
-        const selectedSorted = selectedPagesToMove.sort((a, b) => pages.indexOf(a) - pages.indexOf(b));
-        if (direction === 'prev') {
-            const firstSelected = selectedSorted[0];
-            const targetNode = firstSelected.previousElementSibling;
-            if (targetNode) selectedSorted.forEach(page => galleryReorder.insertBefore(page, targetNode));
-        } else {
-            const lastSelected = selectedSorted[selectedSorted.length - 1];
-            const targetNode = lastSelected.nextElementSibling;
-            if (targetNode) selectedSorted.reverse().forEach(page => galleryReorder.insertBefore(page, targetNode.nextElementSibling));
-        }
-        updateReorderButtonsState();
+        const selectedSorted = selectedPagesToMove.slice().sort((a, b) => reorderOrder.indexOf(a) - reorderOrder.indexOf(b));
+        const targetPosition = direction === 'prev'
+            ? reorderOrder.indexOf(selectedSorted[0]) - 1
+            : reorderOrder.indexOf(selectedSorted[selectedSorted.length - 1]) + 1;
+        const target = reorderOrder[targetPosition];
+        if (target === undefined) return;
+        const newOrder = reorderOrder.filter(index => !selectedSorted.includes(index));
+        const insertAt = newOrder.indexOf(target) + (direction === 'prev' ? 0 : 1);
+        newOrder.splice(insertAt, 0, ...selectedSorted);
+        reorderOrder = newOrder;
+        renderReorderGallery();
     }
 
     splitToFilesButton.addEventListener('click', async () => {
         if (!sharedPdfData || sharedPdfData.page_count === 0) { status.textContent = 'PDFがアップロードされていません。'; return; }
         const convertToImage = splitFilesAsImageCheckbox.checked;
         const dpi = convertToImage ? parseInt(splitFilesDpiSelect.value, 10) : 150;
-        status.textContent = convertToImage ? `PDFを画像PDFとして個別ファイルに分割中（${dpi} DPI）...` : 'PDFを個別ファイルに分割中...';
+        const statusMessage = convertToImage ? `PDFを画像PDFとして個別ファイルに分割中（${dpi} DPI）...` : 'PDFを個別ファイルに分割中...';
+        status.textContent = statusMessage;
         splitToFilesButton.disabled = true;
         try {
-            const response = await fetch('/split_to_files', {
+            const { ok, data } = await fetchWithJob('/split_to_files', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ convert_to_image: convertToImage, dpi: dpi })
-            });
-            const data = await response.json();
-            if (!response.ok) { throw new Error(data.error || 'サーバーエラー'); }
+                body: JSON.stringify({
+                    convert_to_image: convertToImage, dpi: dpi, encoding: splitFilesEncodingSelect.value,
+                    optimize: optimizeOption('split-files'), async: true
+                })
+            }, statusMessage);
+            if (!ok) { throw new Error(data.error || 'サーバーエラー'); }
             const link = document.createElement('a');
             link.href = data.download_url;
             link.download = data.filename;
             document.body.appendChild(link);
             link.click();
             document.body.removeChild(link);
-            status.textContent = `${data.message}（ZIPファイルとしてダウンロード開始）`;
+            const optimized = describeOptimization(data.optimization);
+            status.textContent = `${data.message}（${formatFileSize(data.output_size)}、ZIPファイルとしてダウンロード開始${optimized ? '、' + optimized : ''}）`;
         } catch (error) {
             status.textContent = `エラー: ${error.message}`;
         } finally {
@@ -957,8 +1430,9 @@ document.addEventListener('DOMContentLoaded', () => {
     modalDownloadButton.addEventListener('click', async () => {
         const customFilename = filenameInput.value.trim() || 'edited';
         filenameModal.classList.remove('show');
-        const pageContainers = Array.from(gallerySave.querySelectorAll('.page-container'));
-        const finalOrder = pageContainers.map(c => parseInt(c.dataset.originalIndex, 10));
+        const saveView = galleryViews.get(gallerySave);
+        if (!saveView) { return; }
+        const finalOrder = saveView.order;
         if (finalOrder.length !== sharedPdfData.page_count) { return; }
         status.textContent = 'PDFを生成中...';
         setEditButtonsState(false);
@@ -966,7 +1440,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await fetch('/reorder', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ order: finalOrder, filename: customFilename })
+                body: JSON.stringify({ order: finalOrder, filename: customFilename, optimize: optimizeOption('save') })
             });
             const data = await response.json();
             if (!response.ok) { throw new Error(data.error || 'サーバーエラー'); }
@@ -976,7 +1450,8 @@ document.addEventListener('DOMContentLoaded', () => {
             document.body.appendChild(link);
             link.click();
             document.body.removeChild(link);
-            status.textContent = 'PDFのダウンロードを開始しました！';
+            const optimized = describeOptimization(data.optimization);
+            status.textContent = optimized ? `PDFのダウンロードを開始しました！（${optimized}）` : 'PDFのダウンロードを開始しました！';
         } catch (error) {
             status.textContent = `エラー: ${error.message}`;
         } finally {
@@ -995,22 +1470,26 @@ document.addEventListener('DOMContentLoaded', () => {
             const filenameData = await filenameResponse.json();
             const baseFilename = filenameData.filename || 'image_pdf';
             const dpi = parseInt(imagePdfDpiSelect.value, 10);
-            status.textContent = `PDFを画像PDFに変換中（${dpi} DPI）...`;
+            const statusMessage = `PDFを画像PDFに変換中（${dpi} DPI）...`;
+            status.textContent = statusMessage;
             saveImagePdfButton.disabled = true;
-            const response = await fetch('/convert_to_image_pdf', {
+            const { ok, data } = await fetchWithJob('/convert_to_image_pdf', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ filename: baseFilename, dpi: dpi })
-            });
-            const data = await response.json();
-            if (!response.ok) { throw new Error(data.error || 'サーバーエラー'); }
+                body: JSON.stringify({
+                    filename: baseFilename, dpi: dpi, encoding: imagePdfEncodingSelect.value,
+                    optimize: document.getElementById('optimize-checkbox-image-pdf').checked, async: true
+                })
+            }, statusMessage);
+            if (!ok) { throw new Error(data.error || 'サーバーエラー'); }
             const link = document.createElement('a');
             link.href = data.download_url;
             link.download = data.filename;
             document.body.appendChild(link);
             link.click();
             document.body.removeChild(link);
-            status.textContent = data.message;
+            const optimized = describeOptimization(data.optimization);
+            status.textContent = `${data.message}（${formatFileSize(data.output_size)}${optimized ? '、' + optimized : ''}）`;
         } catch (error) {
             status.textContent = `エラー: ${error.message}`;
         } finally {
@@ -1021,12 +1500,52 @@ document.addEventListener('DOMContentLoaded', () => {
     // ========================================
     // ヘルパー関数
     // ========================================
+    function formatFileSize(bytes) {
+        if (bytes >= 1024 * 1024) return `${(bytes / 1024 / 1024).toFixed(1)}MB`;
+        return `${Math.ceil(bytes / 1024)}KB`;
+    }
+
+    // 各タブの「出力を最適化」の指定を /reorder などの optimize の形式にする（チェックされていなければ false）
+    function optimizeOption(suffix) {
+        if (!document.getElementById(`optimize-checkbox-${suffix}`).checked) return false;
+        const imageDpi = document.getElementById(`optimize-image-dpi-${suffix}`).value;
+        return imageDpi ? { image_dpi: parseInt(imageDpi, 10) } : true;
+    }
+
+    // 最適化の結果を「最適化: 1.2MB → 800KB（0.5秒）」の形で返す（最適化していなければ空文字）
+    function describeOptimization(optimization) {
+        if (!optimization) return '';
+        return `最適化: ${formatFileSize(optimization.bytes_before)} → ${formatFileSize(optimization.bytes_after)}（${optimization.seconds}秒）`;
+    }
+
+    function createThumbnailImage(originalIndex, thumbUrl) {
+        // アトラスがあれば、まとめた画像の該当部分を背景として表示する（ページごとの画像取得をしない）
+        const sprite = sharedPdfData && sharedPdfData.atlas ? sharedPdfData.atlas.pages[originalIndex] : null;
+        if (sprite) {
+            const [atlasNumber, x, y, width, height] = sprite;
+            const atlasImage = sharedPdfData.atlas.images[atlasNumber];
+            const div = document.createElement('div');
+            div.className = 'page-sprite';
+            div.style.aspectRatio = `${width} / ${height}`;
+            div.style.backgroundImage = `url(${atlasImage.url})`;
+            div.style.backgroundSize = `${atlasImage.width / width * 100}% ${atlasImage.height / height * 100}%`;
+            const posX = atlasImage.width > width ? x / (atlasImage.width - width) * 100 : 0;
+            const posY = atlasImage.height > height ? y / (atlasImage.height - height) * 100 : 0;
+            div.style.backgroundPosition = `${posX}% ${posY}%`;
+            return div;
+        }
+        const img = document.createElement('img');
+        // URLはページ内容ごとに異なるので、変更のないページはブラウザのキャッシュから表示される
+        img.src = thumbUrl;
+        return img;
+    }
+
     function createPageContainer(originalIndex, thumbUrl) {
         const pageContainer = document.createElement('div');
         pageContainer.className = 'page-container';
         pageContainer.dataset.originalIndex = originalIndex;
-        const img = document.createElement('img');
-        img.src = thumbUrl + '?t=' + new Date().getTime();
+        pageContainer.dataset.thumbnail = thumbUrl;
+        const img = createThumbnailImage(originalIndex, thumbUrl);
         const pageNum = document.createElement('div');
         pageNum.className = 'page-number';
         pageNum.textContent = `ページ ${originalIndex + 1}`;
@@ -1035,6 +1554,72 @@ document.addEventListener('DOMContentLoaded', () => {
         return pageContainer;
     }
 
+    function updatePageContainer(pageContainer, originalIndex) {
+        pageContainer.dataset.originalIndex = originalIndex;
+        pageContainer.querySelector('.page-number').textContent = `ページ ${originalIndex + 1}`;
+    }
+
+    // ========================================
+    // ページ情報の取得
+    // ========================================
+    // ページ数の多い文書では操作のレスポンスにサムネイルが含まれないため、
+    // 表示する範囲だけを /pages から GALLERY_BLOCK_SIZE ページ単位で取得する。
+
+    function setSharedPdfData(data) {
+        pageDataGeneration++;
+        pendingPageWindows.clear();
+        sharedPdfData = { page_count: data.page_count, thumbnails: [], sizes: [], atlas: { images: [], pages: [] } };
+        if (data.thumbnails) {
+            mergePageWindow({ start: 0, thumbnails: data.thumbnails, sizes: data.sizes, atlas: data.atlas });
+        }
+    }
+
+    function mergePageWindow(pageWindow) {
+        const atlasNumbers = (pageWindow.atlas ? pageWindow.atlas.images : []).map(image => {
+            const known = sharedPdfData.atlas.images.findIndex(other => other.url === image.url);
+            if (known > -1) return known;
+            sharedPdfData.atlas.images.push(image);
+            return sharedPdfData.atlas.images.length - 1;
+        });
+        pageWindow.thumbnails.forEach((url, i) => {
+            const index = pageWindow.start + i;
+            sharedPdfData.thumbnails[index] = url;
+            sharedPdfData.sizes[index] = pageWindow.sizes ? pageWindow.sizes[i] : null;
+            if (pageWindow.atlas) {
+                const [atlasNumber, ...placement] = pageWindow.atlas.pages[i];
+                sharedPdfData.atlas.pages[index] = [atlasNumbers[atlasNumber], ...placement];
+            }
+        });
+    }
+
+    function hasPages(indices) {
+        return indices.every(index => sharedPdfData.thumbnails[index] !== undefined);
+    }
+
+    // 指定したページの情報が揃うまで待つ（内容が変わって結果を捨てた場合は false）
+    function ensurePages(indices) {
+        const generation = pageDataGeneration;
+        const windowStarts = new Set(indices
+            .filter(index => sharedPdfData.thumbnails[index] === undefined)
+            .map(index => index - index % GALLERY_BLOCK_SIZE));
+        const requests = Array.from(windowStarts).map(start => {
+            if (!pendingPageWindows.has(start)) {
+                pendingPageWindows.set(start, fetch(`/pages?start=${start}&count=${GALLERY_BLOCK_SIZE}`)
+                    .then(response => response.json().then(data => {
+                        if (!response.ok) { throw new Error(data.error || 'サーバーエラー'); }
+                        if (generation !== pageDataGeneration) return false;
+                        mergePageWindow(data);
+                        return true;
+                    }))
+                    .finally(() => {
+                        if (generation === pageDataGeneration) pendingPageWindows.delete(start);
+                    }));
+            }
+            return pendingPageWindows.get(start);
+        });
+        return Promise.all(requests).then(results => results.every(Boolean) && generation === pageDataGeneration);
+    }
+
     // ========================================
     // マスキング機能
     // ========================================
@@ -1042,108 +1627,316 @@ document.addEventListener('DOMContentLoaded', () => {
     function loadMaskCanvas(pageIndex = 0) {
         if (!sharedPdfData || sharedPdfData.page_count === 0) return;
         if (pageIndex < 0 || pageIndex >= sharedPdfData.page_count) pageIndex = 0;
+        if (!hasPages([pageIndex])) {
+            ensurePages([pageIndex]).then(loaded => { if (loaded) loadMaskCanvas(pageIndex); })
+                .catch(error => { status.textContent = `エラー: ${error.message}`; });
+            return;
+        }
+        const loadCount = ++maskLoadCount;
         const pageThumb = sharedPdfData.thumbnails[pageIndex];
-        const img = new Image();
-        img.onload = function() {
-            maskCanvas.width = img.width;
-            maskCanvas.height = img.height;
-            maskCanvas.getContext('2d').drawImage(img, 0, 0);
+        fetch(`/pages/${pageIndex}/tiles`).then(response => response.json().then(info => {
+            if (!response.ok) { throw new Error(info.error || 'サーバーエラー'); }
+            const img = new Image();
+            img.onload = function() {
+                if (loadCount !== maskLoadCount) return;
+                maskPage = { ...info, thumbnail: img };
+                maskCanvas.width = Math.round(info.width);
+                maskCanvas.height = Math.round(info.height);
+                setMaskView(1, 0, 0);
+            };
+            img.src = pageThumb;
+        })).catch(error => {
+            status.textContent = `エラー: ${error.message}`;
+        });
+    }
+
+    // ========================================
+    // マスキング画面の拡大表示
+    // ========================================
+    // ページ全体はサムネイルで表示し、拡大したときは表示範囲のタイルだけをサーバーから取得して重ねる。
+
+    function maskScale() {
+        // キャンバスの1ピクセルあたりのポイント数の逆数（キャンバスはページ全体を1ポイント1ピクセルで表示する大きさ）
+        return maskCanvas.width / maskPage.width * maskZoom;
+    }
+
+    function setMaskView(zoom, offsetX, offsetY) {
+        const maxZoom = 2 ** maskPage.max_zoom;
+        maskZoom = Math.min(Math.max(zoom, 1), maxZoom);
+        // ページの外が表示されないように位置を制限する
+        maskOffsetX = Math.min(Math.max(offsetX, 0), maskPage.width - maskPage.width / maskZoom);
+        maskOffsetY = Math.min(Math.max(offsetY, 0), maskPage.height - maskPage.height / maskZoom);
+        maskZoomLabel.textContent = `${Math.round(maskZoom * 100)}%`;
+        maskZoomOutButton.disabled = maskZoom <= 1;
+        maskZoomInButton.disabled = maskZoom >= maxZoom;
+        drawMaskCanvas();
+    }
+
+    // キャンバス上の点（キャンバスのピクセル）を中心に拡大・縮小する
+    function zoomMaskAt(zoom, canvasX, canvasY) {
+        const pageX = maskOffsetX + canvasX / maskScale();
+        const pageY = maskOffsetY + canvasY / maskScale();
+        const newScale = maskCanvas.width / maskPage.width * Math.min(Math.max(zoom, 1), 2 ** maskPage.max_zoom);
+        setMaskView(zoom, pageX - canvasX / newScale, pageY - canvasY / newScale);
+    }
+
+    let maskRedrawScheduled = false;
+    function scheduleMaskRedraw() {
+        if (maskRedrawScheduled) return;
+        maskRedrawScheduled = true;
+        requestAnimationFrame(() => {
+            maskRedrawScheduled = false;
+            drawMaskCanvas();
+        });
+    }
+
+    function getMaskTile(url) {
+        let img = maskTileImages.get(url);
+        if (img) {
+            maskTileImages.delete(url);
+        } else {
+            img = new Image();
+            img.onload = scheduleMaskRedraw;
+            img.src = url;
+        }
+        maskTileImages.set(url, img);
+        if (maskTileImages.size > MASK_TILE_CACHE_SIZE) {
+            maskTileImages.delete(maskTileImages.keys().next().value);
+        }
+        return img;
+    }
+
+    function drawMaskCanvas() {
+        if (!maskPage) return;
+        const ctx = maskCanvas.getContext('2d');
+        const scale = maskScale();
+        ctx.fillStyle = '#fff';
+        ctx.fillRect(0, 0, maskCanvas.width, maskCanvas.height);
+        // 下地としてサムネイルを拡大して描く
+        ctx.drawImage(maskPage.thumbnail, -maskOffsetX * scale, -maskOffsetY * scale, maskPage.width * scale, maskPage.height * scale);
+        if (scale > 1) {
+            // 表示倍率以上の解像度のズーム段階のタイルを、読み込めたものから重ねる
+            const level = Math.min(maskPage.max_zoom, Math.ceil(Math.log2(scale)));
+            const levelScale = 2 ** level;
+            const span = maskPage.tile_size / levelScale;
+            const right = Math.min(maskPage.width, maskOffsetX + maskCanvas.width / scale);
+            const bottom = Math.min(maskPage.height, maskOffsetY + maskCanvas.height / scale);
+            for (let ty = Math.floor(maskOffsetY / span); ty * span < bottom; ty++) {
+                for (let tx = Math.floor(maskOffsetX / span); tx * span < right; tx++) {
+                    const url = maskPage.url.replace('{zoom}', level).replace('{x}', tx).replace('{y}', ty);
+                    const tile = getMaskTile(url);
+                    if (!tile.complete || tile.naturalWidth === 0) continue;
+                    ctx.drawImage(tile, (tx * span - maskOffsetX) * scale, (ty * span - maskOffsetY) * scale,
+                        tile.naturalWidth / levelScale * scale, tile.naturalHeight / levelScale * scale);
+                }
+            }
+        }
+        // リストに追加済みで、表示中のページが対象になっている領域を枠で示す
+        const pageCount = sharedPdfData ? sharedPdfData.page_count : 0;
+        ctx.save();
+        ctx.strokeStyle = '#17a2b8';
+        ctx.lineWidth = 2;
+        ctx.setLineDash([6, 4]);
+        maskRegions.filter(region => maskRuleIncludes(region.pages, currentMaskPageIndex, pageCount)).forEach(region => {
+            const r = region.rect;
+            ctx.strokeRect((r.x * maskPage.width - maskOffsetX) * scale, (r.y * maskPage.height - maskOffsetY) * scale,
+                r.width * maskPage.width * scale, r.height * maskPage.height * scale);
+        });
+        ctx.restore();
+        // 選択中はドラッグしている枠を表示したままにする
+        if (!isDrawing) drawMaskSelectionBox(maskSelection);
+    }
+
+    // 選択領域（ページに対する割合）を、現在の表示範囲に合わせて枠として表示する
+    function drawMaskSelectionBox(selection) {
+        if (!selection) {
+            if (maskSelectionBox) maskSelectionBox.style.display = 'none';
+            return;
+        }
+        if (!maskSelectionBox) {
+            maskSelectionBox = document.createElement('div');
+            maskSelectionBox.className = 'mask-selection-box';
+            maskCanvasContainer.appendChild(maskSelectionBox);
+        }
+        // 表示用の座標はキャンバスのピクセルから画面のピクセルに変換する（枠線の分ずらす）
+        const toScreen = maskScale() * maskCanvas.clientWidth / maskCanvas.width;
+        maskSelectionBox.style.display = 'block';
+        maskSelectionBox.style.left = (maskCanvas.clientLeft + (selection.x * maskPage.width - maskOffsetX) * toScreen) + 'px';
+        maskSelectionBox.style.top = (maskCanvas.clientTop + (selection.y * maskPage.height - maskOffsetY) * toScreen) + 'px';
+        maskSelectionBox.style.width = (selection.width * maskPage.width * toScreen) + 'px';
+        maskSelectionBox.style.height = (selection.height * maskPage.height * toScreen) + 'px';
+    }
+
+    // マウスの位置をキャンバスのピクセルとページ上の座標（ポイント）で返す
+    function maskPointer(e) {
+        const rect = maskCanvas.getBoundingClientRect();
+        const canvasX = (e.clientX - rect.left - maskCanvas.clientLeft) * maskCanvas.width / maskCanvas.clientWidth;
+        const canvasY = (e.clientY - rect.top - maskCanvas.clientTop) * maskCanvas.height / maskCanvas.clientHeight;
+        const scale = maskScale();
+        return {
+            canvasX: canvasX,
+            canvasY: canvasY,
+            x: Math.min(Math.max(maskOffsetX + canvasX / scale, 0), maskPage.width),
+            y: Math.min(Math.max(maskOffsetY + canvasY / scale, 0), maskPage.height)
+        };
+    }
+
+    function selectionBetween(start, end) {
+        return {
+            x: Math.min(start.x, end.x) / maskPage.width,
+            y: Math.min(start.y, end.y) / maskPage.height,
+            width: Math.abs(end.x - start.x) / maskPage.width,
+            height: Math.abs(end.y - start.y) / maskPage.height
         };
-        img.src = pageThumb;
     }
 
     let isDrawing = false;
-    let startX, startY;
+    let isPanning = false;
+    let dragStart = null;
 
     maskCanvas.addEventListener('mousedown', (e) => {
-        if (!sharedPdfData) return;
+        if (!sharedPdfData || !maskPage) return;
+        dragStart = maskPointer(e);
+        // Shift＋ドラッグまたは中ボタンのドラッグで表示範囲を移動する
+        if (e.shiftKey || e.button === 1) {
+            e.preventDefault();
+            isPanning = true;
+            dragStart.offsetX = maskOffsetX;
+            dragStart.offsetY = maskOffsetY;
+            return;
+        }
         isDrawing = true;
-        const rect = maskCanvas.getBoundingClientRect();
-        // キャンバスのスケール比を考慮して座標を計算
-        const scaleX = maskCanvas.width / rect.width;
-        const scaleY = maskCanvas.height / rect.height;
-        startX = (e.clientX - rect.left) * scaleX;
-        startY = (e.clientY - rect.top) * scaleY;
-        if (maskSelectionBox) maskSelectionBox.remove();
+        drawMaskSelectionBox(null);
     });
 
     maskCanvas.addEventListener('mousemove', (e) => {
-        if (!isDrawing) return;
-        const rect = maskCanvas.getBoundingClientRect();
-        const scaleX = maskCanvas.width / rect.width;
-        const scaleY = maskCanvas.height / rect.height;
-        const currentX = (e.clientX - rect.left) * scaleX;
-        const currentY = (e.clientY - rect.top) * scaleY;
-        const x = Math.min(startX, currentX);
-        const y = Math.min(startY, currentY);
-        const width = Math.abs(currentX - startX);
-        const height = Math.abs(currentY - startY);
-        if (!maskSelectionBox) {
-            maskSelectionBox = document.createElement('div');
-            maskSelectionBox.className = 'mask-selection-box';
-            maskCanvasContainer.appendChild(maskSelectionBox);
+        if (isPanning) {
+            const current = maskPointer(e);
+            const scale = maskScale();
+            setMaskView(maskZoom,
+                dragStart.offsetX - (current.canvasX - dragStart.canvasX) / scale,
+                dragStart.offsetY - (current.canvasY - dragStart.canvasY) / scale);
+            return;
         }
-        // 表示用の座標はスケールを逆変換
-        maskSelectionBox.style.left = (x / scaleX) + 'px';
-        maskSelectionBox.style.top = (y / scaleY) + 'px';
-        maskSelectionBox.style.width = (width / scaleX) + 'px';
-        maskSelectionBox.style.height = (height / scaleY) + 'px';
+        if (!isDrawing) return;
+        drawMaskSelectionBox(selectionBetween(dragStart, maskPointer(e)));
     });
 
     maskCanvas.addEventListener('mouseup', (e) => {
+        if (isPanning) {
+            isPanning = false;
+            return;
+        }
         if (!isDrawing) return;
         isDrawing = false;
-        const rect = maskCanvas.getBoundingClientRect();
-        const scaleX = maskCanvas.width / rect.width;
-        const scaleY = maskCanvas.height / rect.height;
-        const endX = (e.clientX - rect.left) * scaleX;
-        const endY = (e.clientY - rect.top) * scaleY;
-        const x = Math.min(startX, endX);
-        const y = Math.min(startY, endY);
-        const width = Math.abs(endX - startX);
-        const height = Math.abs(endY - startY);
+        const end = maskPointer(e);
         // 正規化された座標(0-1)に変換
-        maskSelection = {
-            x: x / maskCanvas.width,
-            y: y / maskCanvas.height,
-            width: width / maskCanvas.width,
-            height: height / maskCanvas.height
-        };
+        maskSelection = selectionBetween(dragStart, end);
+        drawMaskSelectionBox(maskSelection);
+        const x = Math.min(dragStart.x, end.x);
+        const y = Math.min(dragStart.y, end.y);
+        const width = Math.abs(end.x - dragStart.x);
+        const height = Math.abs(end.y - dragStart.y);
         maskInfo.textContent = `選択領域: (${Math.round(x)}, ${Math.round(y)}) - ${Math.round(width)} × ${Math.round(height)}px`;
         applyMaskButton.disabled = false;
+        addMaskRegionButton.disabled = false;
         clearMaskButton.disabled = false;
     });
 
+    maskCanvas.addEventListener('wheel', (e) => {
+        if (!maskPage) return;
+        e.preventDefault();
+        const pointer = maskPointer(e);
+        zoomMaskAt(maskZoom * (e.deltaY < 0 ? 1.25 : 0.8), pointer.canvasX, pointer.canvasY);
+    }, { passive: false });
+
+    maskZoomInButton.addEventListener('click', () => {
+        if (maskPage) zoomMaskAt(maskZoom * 2, maskCanvas.width / 2, maskCanvas.height / 2);
+    });
+    maskZoomOutButton.addEventListener('click', () => {
+        if (maskPage) zoomMaskAt(maskZoom / 2, maskCanvas.width / 2, maskCanvas.height / 2);
+    });
+    maskZoomResetButton.addEventListener('click', () => {
+        if (maskPage) setMaskView(1, 0, 0);
+    });
+
     clearMaskButton.addEventListener('click', () => {
         clearMaskSelection();
         clearMaskButton.disabled = true;
     });
 
-    applyMaskButton.addEventListener('click', async () => {
+    addMaskRegionButton.addEventListener('click', () => {
         if (!maskSelection) return;
-        const interval = parseInt(maskIntervalSelect.value, 10);
-        const offset = parseInt(maskOffsetSelect.value, 10);
-        status.textContent = `${interval}ページ毎に${offset}ページ目にマスキングを適用中...`;
+        const rule = currentMaskRule();
+        if (!rule) { status.textContent = 'ページ範囲は「1-3,5,8-」のように指定してください。'; return; }
+        maskRegions.push({ rect: maskSelection, ...rule });
+        clearMaskSelection();
+        clearMaskButton.disabled = true;
+        renderMaskRegionList();
+    });
+
+    maskSearchButton.addEventListener('click', async () => {
+        const query = maskSearchInput.value.trim();
+        if (!query) { status.textContent = '黒塗りする文字を入力してください。'; return; }
+        const statusMessage = `「${query}」の一致箇所をマスキング中...`;
+        status.textContent = statusMessage;
+        maskSearchButton.disabled = true;
+        try {
+            const { ok, data } = await fetchWithJob('/apply_mask', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ search: query, redact: maskRedactCheckbox.checked, async: true })
+            }, statusMessage);
+            if (!ok) { throw new Error(data.error || 'サーバーエラー'); }
+            setSharedPdfData(data);
+            forceRepopulateAllGalleries();
+            clearMaskSelection();
+            galleriesPopulated.mask = false;
+            loadMaskCanvas(currentMaskPageIndex);
+            status.textContent = data.message;
+            await updateHistoryButtons();
+        } catch (error) {
+            status.textContent = `エラー: ${error.message}`;
+        } finally {
+            maskSearchButton.disabled = false;
+        }
+    });
+    maskSearchInput.addEventListener('keydown', (e) => { if (e.key === 'Enter' && !maskSearchButton.disabled) maskSearchButton.click(); });
+
+    applyMaskButton.addEventListener('click', async () => {
+        // リストに追加した領域と、選択中の領域をまとめて1回で適用する
+        const masks = maskRegions.map(region => ({ rect: region.rect, pages: region.pages }));
+        if (maskSelection) {
+            const rule = currentMaskRule();
+            if (!rule) { status.textContent = 'ページ範囲は「1-3,5,8-」のように指定してください。'; return; }
+            masks.push({ rect: maskSelection, pages: rule.pages });
+        }
+        if (masks.length === 0) return;
+        const statusMessage = `${masks.length}個の領域にマスキングを適用中...`;
+        status.textContent = statusMessage;
         applyMaskButton.disabled = true;
+        addMaskRegionButton.disabled = true;
         clearMaskButton.disabled = true;
         try {
-            const response = await fetch('/apply_mask', {
+            const { ok, data } = await fetchWithJob('/apply_mask', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ mask: maskSelection, interval: interval, offset: offset })
-            });
-            const data = await response.json();
-            if (!response.ok) { throw new Error(data.error || 'サーバーエラー'); }
-            sharedPdfData = { page_count: data.page_count, thumbnails: data.thumbnails };
+                body: JSON.stringify({ masks: masks, redact: maskRedactCheckbox.checked, async: true })
+            }, statusMessage);
+            if (!ok) { throw new Error(data.error || 'サーバーエラー'); }
+            setSharedPdfData(data);
             forceRepopulateAllGalleries();
+            maskRegions = [];
+            renderMaskRegionList();
             clearMaskSelection();
             galleriesPopulated.mask = false;
-            loadMaskCanvas(parseInt(maskOffsetSelect.value, 10) - 1);
+            loadMaskCanvas(currentMaskPageIndex);
             status.textContent = data.message;
             await updateHistoryButtons();
         } catch (error) {
             status.textContent = `エラー: ${error.message}`;
             applyMaskButton.disabled = false;
+            addMaskRegionButton.disabled = !maskSelection;
             clearMaskButton.disabled = false;
         }
     });
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""テスト共通の設定（リポジトリのルートから python -m pytest で実行する）"""
+
+import os
+import sys
+
+import fitz  # PyMuPDF
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 署名鍵のファイルを作業ディレクトリに作らない
+os.environ.setdefault('SECRET_KEY', 'test')
+
+import app as app_module  # noqa: E402
+
+
+def make_pdf(path, page_count=3, landscape=()):
+    """ページ番号の文字を書いたPDFを作る（landscape に含まれるページは横長）"""
+    doc = fitz.open()
+    for i in range(page_count):
+        width, height = (842, 595) if i in landscape else (595, 842)
+        page = doc.new_page(width=width, height=height)
+        page.insert_text((72, 72), f'Page {i + 1}', fontsize=24)
+    doc.save(path)
+    doc.close()
+    return path
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """一時ディレクトリを作業ディレクトリにしたテスト用クライアント（レンダリングはプロセスを使わない）"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(app_module.app.config, 'RASTER_WORKERS', 1)
+    client = app_module.app.test_client()
+    client.get('/')
+    return client
+
+def upload(client, path, filename='test.pdf'):
+    """PDFを /upload でアップロードし、レスポンスのJSONを返す"""
+    with open(path, 'rb') as f:
+        response = client.post('/upload', data={'pdfFile': (f, filename)})
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
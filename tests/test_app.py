@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""app.py のテスト"""
+
+import io
+import json
+import os
+import threading
+import zlib
+
+import fitz  # PyMuPDF
+import pytest
+
+import app
+import pdf_engine
+from conftest import make_pdf, upload
+
+RECT = {'x': 0.1, 'y': 0.1, 'width': 0.2, 'height': 0.2}
+
+
+def test_page_metadata_without_stream_length():
+    """/Length がない・整数でないコンテンツストリームは、ストリームの実際の大きさを数える"""
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((72, 72), 'hello')
+    xref = page.get_contents()[0]
+    expected = len(doc.xref_stream_raw(xref))
+
+    doc.xref_set_key(xref, 'Length', 'null')
+    assert app._page_metadata(doc)['pages'][0]['content_bytes'] == expected
+    doc.xref_set_key(xref, 'Length', '/Broken')
+    assert app._page_metadata(doc)['pages'][0]['content_bytes'] == expected
+
+    # 間接参照の /Length は参照先の値を使う
+    length_xref = doc.get_new_xref()
+    doc.update_object(length_xref, '42')
+    doc.xref_set_key(xref, 'Length', f'{length_xref} 0 R')
+    assert app._page_metadata(doc)['pages'][0]['content_bytes'] == 42
+
+@pytest.mark.parametrize('params', [
+    {'masks': [{'rect': RECT, 'pages': {'interval': 0, 'offset': 1}}]},
+    {'masks': [{'rect': RECT, 'pages': 'all'}, {'rect': RECT, 'pages': {'interval': 2, 'offset': 0}}]},
+    {'mask': RECT, 'interval': 0},
+])
+def test_apply_mask_rejects_invalid_interval(client, tmp_path, params):
+    """間隔・オフセットが1未満の領域があれば 400 を返し、ページを変更しない"""
+    upload(client, make_pdf(tmp_path / 'a.pdf'))
+    before = client.get('/pages').get_json()['thumbnails']
+    response = client.post('/apply_mask', json=params)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+    assert client.get('/pages').get_json()['thumbnails'] == before
+
+def _describe(path):
+    """PDFの各ページの回転・大きさ・文字・低解像度の画像"""
+    with fitz.open(path) as doc:
+        return [(page.rotation, tuple(round(v, 1) for v in page.rect), page.get_text('text'),
+                 page.get_pixmap(dpi=20).samples) for page in doc]
+
+def test_pipeline_matches_recipe(client, tmp_path):
+    """同じ操作の並びを /pipeline とバッチ処理のレシピで実行すると、同じPDFになる"""
+    steps = [
+        {'op': 'rotate', 'rotation': 90},
+        {'op': 'rotate', 'pages': ['1'], 'rotation': 270},
+        {'op': 'split', 'pages_to_split': ['0', '2', '9']},
+        {'op': 'apply_mask', 'masks': [{'rect': RECT, 'pages': 'odd'},
+                                       {'rect': {'x': 0.5, 'y': 0.5, 'width': 0.3, 'height': 0.2}, 'pages': '2-', 'redact': True}]},
+        {'op': 'delete', 'pages_to_delete': [1]},
+        {'op': 'reverse_all'},
+    ]
+    source = make_pdf(tmp_path / 'a.pdf', 4, landscape=(1, 2))
+
+    output_base = str(tmp_path / 'batch' / 'a')
+    pdf_engine.process_file({'steps': steps, 'output': 'pdf'}, str(source), output_base)
+
+    upload(client, source)
+    response = client.post('/pipeline', json={'operations': steps})
+    assert response.status_code == 200, response.get_json()
+    page_count = response.get_json()['page_count']
+    response = client.post('/reorder', json={'order': list(range(page_count)), 'filename': 'web'})
+    web_path = tmp_path / 'web.pdf'
+    download = client.get(response.get_json()['download_url'])
+    web_path.write_bytes(download.data)
+    download.close()
+
+    assert _describe(web_path) == _describe(output_base + '.pdf')
+
+def test_convert_to_image_pdf_optimize(client, tmp_path):
+    """画像PDFも他の書き出しと同じ optimize の指定で最適化する"""
+    upload(client, make_pdf(tmp_path / 'a.pdf'))
+    response = client.post('/convert_to_image_pdf', json={'dpi': 300, 'optimize': {'image_dpi': 72}})
+    assert response.status_code == 200, response.get_json()
+    data = response.get_json()
+    assert data['optimization']['images_downsampled'] == 3
+    assert data['optimization']['bytes_after'] == data['output_size'] < data['optimization']['bytes_before']
+
+    assert client.post('/convert_to_image_pdf', json={'optimize': {'unknown': 1}}).status_code == 400
+    assert client.post('/convert_to_image_pdf', json={}).get_json()['optimization'] is None
+
+def test_upload_limits_each_file(client, tmp_path, monkeypatch):
+    """/upload の大きさの上限は、まとめて送ったファイルの合計ではなく1ファイルごとに適用する"""
+    paths = [make_pdf(tmp_path / f'{i}.pdf') for i in range(3)]
+    size = max(path.stat().st_size for path in paths)
+    monkeypatch.setitem(app.app.config, 'UPLOAD_FILE_MAX_BYTES', size)
+
+    files = [(io.BytesIO(path.read_bytes()), path.name) for path in paths]
+    response = client.post('/upload', data={'pdfFile': files})
+    assert response.status_code == 200, response.get_json()
+    assert response.get_json()['page_count'] == 9
+
+    large = tmp_path / 'large.pdf'
+    large.write_bytes(paths[0].read_bytes() + b'%' * size)
+    response = client.post('/upload', data={'pdfFile': [(io.BytesIO(large.read_bytes()), 'large.pdf')]})
+    assert response.status_code == 413
+    assert 'large.pdf' in response.get_json()['error']
+
+    monkeypatch.setitem(app.app.config, 'UPLOAD_BATCH_FILES', 2)
+    files = [(io.BytesIO(path.read_bytes()), path.name) for path in paths]
+    assert client.post('/upload', data={'pdfFile': files}).status_code == 400
+
+def test_atlases_reuse_cached_thumbnails(client, tmp_path, monkeypatch):
+    """アトラスはキャッシュ済みのサムネイルから作り、編集しても変わったページの分だけを作り直す"""
+    rendered = []
+    render_pages = app._render_pages
+    monkeypatch.setattr(app, '_render_pages', lambda tasks, *args, **kwargs: (
+        rendered.extend(tasks), render_pages(tasks, *args, **kwargs))[1])
+    composed = []
+    compose_atlases = app.rasterizer.compose_atlases
+    monkeypatch.setattr(app.rasterizer, 'compose_atlases', lambda jobs, **kwargs: (
+        composed.extend(jobs), compose_atlases(jobs, **kwargs))[1])
+
+    data = upload(client, make_pdf(tmp_path / 'a.pdf', 200))
+    assert len(rendered) == 200  # 各ページを1回だけレンダリングする
+    urls = {image['url'] for image in data['atlas']['images']}
+    assert sum(len(paths) for paths, *_ in composed) == 200
+
+    def edit(path, params):
+        rendered.clear()
+        composed.clear()
+        data = client.post(path, json=params).get_json()
+        assert data['page_count'] > 0, data
+        new_urls = {image['url'] for image in data['atlas']['images']}
+        return data, new_urls - urls
+
+    data, changed = edit('/rotate', {'pages': [120], 'rotation': 90})
+    assert len(rendered) == 1
+    assert len(changed) <= 2 and sum(len(paths) for paths, *_ in composed) <= 200 // 2
+
+    client.post('/undo')
+    data, changed = edit('/delete', {'pages_to_delete': [0]})
+    assert rendered == []
+    assert len(changed) <= 2 and len(composed) == len(changed)
+    _assert_atlas_matches_thumbnails(data)
+
+    data, changed = edit('/reverse_all', {})
+    assert rendered == []
+    _assert_atlas_matches_thumbnails(data)
+
+def _assert_atlas_matches_thumbnails(data):
+    """各ページのアトラス上の位置が、そのページのサムネイルを縮小した画像を指していること"""
+    assert len(data['atlas']['pages']) == len(data['thumbnails']) == data['page_count']
+    for url, (atlas_number, *placement) in zip(data['thumbnails'], data['atlas']['pages']):
+        name = data['atlas']['images'][atlas_number]['url'].rsplit('/', 1)[1][:-len('.jpg')]
+        with open(os.path.join('thumbnails', f'{name}.json'), encoding='utf-8') as f:
+            index = json.load(f)
+        fingerprint = url.rsplit('/', 1)[1][:-len('.png')]
+        assert index['placements'][index['fingerprints'].index(fingerprint)] == placement
+
+def test_read_endpoints_respond_while_job_runs(client, tmp_path, monkeypatch):
+    upload(client, make_pdf(str(tmp_path / 'in.pdf')))
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking_reporter(workspace, job):
+        def report(done, total):
+            started.set()
+            release.wait(10)
+        return report
+    monkeypatch.setattr(app, '_job_progress_reporter', blocking_reporter)
+
+    job = client.post('/convert_to_image_pdf', json={'async': True}).get_json()
+    try:
+        assert started.wait(10)
+        for path in ['/history_status', '/get_original_filename', '/pages', '/pages/metadata', '/search?q=Page']:
+            # ジョブのロックを待つと応答が返らないので、別スレッドで呼んで待ち時間を区切る
+            responses = []
+            request_thread = threading.Thread(target=lambda: responses.append(client.get(path)))
+            request_thread.start()
+            request_thread.join(5)
+            assert responses and responses[0].status_code == 200, path
+            responses[0].close()
+    finally:
+        release.set()
+    for _ in range(100):
+        if client.get(job['status_url']).get_json()['status'] not in ('queued', 'running'):
+            break
+        release.wait(0.1)
+    assert client.get(job['status_url']).get_json()['status'] == 'done'
+
+def test_tiles_served_outside_root_path(client, tmp_path):
+    # 作業ディレクトリ（キャッシュの置き場所）がアプリのフォルダと異なっていても返せること
+    assert os.getcwd() != app.app.root_path
+    upload(client, make_pdf(str(tmp_path / 'in.pdf')))
+    url = client.get('/pages/0/tiles').get_json()['url'].format(zoom=0, x=0, y=0)
+    response = client.get(url)
+    assert response.status_code == 200 and response.mimetype == 'image/png'
+    response.close()
+
+def test_thumbnails_served_outside_root_path(client, tmp_path):
+    assert os.getcwd() != app.app.root_path
+    upload(client, make_pdf(str(tmp_path / 'in.pdf')))
+    data = client.get('/pages').get_json()
+    for url in [data['thumbnails'][0], data['atlas']['images'][0]['url']]:
+        response = client.get(url)
+        assert response.status_code == 200, url
+        response.close()
+
+def test_clear_all_keeps_partial_uploads_on_page_load(client, tmp_path):
+    upload(client, make_pdf(str(tmp_path / 'in.pdf')))
+    started = client.post('/uploads', json={'filename': 'big.pdf', 'size': 10, 'key': 'big.pdf-10'}).get_json()
+    chunk = b'%PDF-1.4\n%'
+    response = client.put(f'/uploads/{started["upload_id"]}/chunks/0', data=chunk,
+                          headers={'X-Chunk-CRC32': f'{zlib.crc32(chunk):08x}'})
+    assert response.status_code == 200, response.get_json()
+
+    # ページを読み込み直したときの呼び出し：ページと履歴は消えるが、途中のアップロードは再開できる
+    assert client.post('/clear_all', json={'keep_partial_uploads': True}).status_code == 200
+    assert client.get('/pages').get_json()['page_count'] == 0
+    status = client.get(f'/uploads/{started["upload_id"]}').get_json()
+    assert status['received'] == [0]
+
+    # 「すべてクリア」ボタンでは途中のアップロードも消える
+    assert client.post('/clear_all').status_code == 200
+    assert client.get(f'/uploads/{started["upload_id"]}').status_code == 404
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""page_analysis.py のテスト"""
+
+import random
+
+import pytest
+
+import page_analysis
+
+
+def _image(width, height, stride, seed):
+    """行の末尾に詰め物のある、ランダムな模様のグレースケール画像"""
+    rng = random.Random(seed)
+    return bytes(rng.choice((0, 90, 200, 255)) if x < width else 17
+                 for y in range(height) for x in range(stride))
+
+@pytest.mark.parametrize('seed', range(5))
+def test_numpy_and_fallback_agree(monkeypatch, seed):
+    pytest.importorskip('numpy')
+    size = page_analysis.HASH_IMAGE_SIZE
+    page = _image(50, 70, 53, seed)
+    thumbnail = _image(size, size, size + 3, seed)
+    results = []
+    for numpy in (page_analysis.numpy, None):
+        monkeypatch.setattr(page_analysis, 'numpy', numpy)
+        results.append((page_analysis.ink_coverage(page, 50, 70, 53), page_analysis.perceptual_hash(thumbnail, size + 3)))
+    (coverage, hash_value), (fallback_coverage, fallback_hash) = results
+    assert coverage == pytest.approx(fallback_coverage)
+    assert hash_value == fallback_hash
+
+def test_fallback_blank_and_hash(monkeypatch):
+    monkeypatch.setattr(page_analysis, 'numpy', None)
+    size = page_analysis.HASH_IMAGE_SIZE
+    assert page_analysis.ink_coverage(bytes([255]) * 100 * 100, 100, 100) == 0.0
+    assert page_analysis.perceptual_hash(_image(size, size, size, 0)) \
+        == page_analysis.perceptual_hash(_image(size, size, size, 0))
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""pdf_engine.py のテスト"""
+
+import pytest
+
+import pdf_engine
+
+
+def test_select_pages_interval():
+    assert pdf_engine.select_pages(7, {'interval': 3, 'offset': 2}) == [1, 4]
+    assert pdf_engine.select_pages(5, '2-3,5-') == [1, 2, 4]
+
+@pytest.mark.parametrize('rule', [{'interval': 0}, {'offset': 0}, {'interval': -2}, {'interval': 'x'}, {'offset': None}])
+def test_select_pages_rejects_invalid_interval(rule):
+    with pytest.raises(ValueError):
+        pdf_engine.select_pages(5, rule)